@@ -0,0 +1,196 @@
+# batch.py
+# 批量模式:从 JSONL 文件读取多个需求,用线程池或进程池并行运行流水线,并输出汇总 JSONL
+import json
+import os
+import re
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+from runs import create_run_dir
+
+EXECUTORS = ('thread', 'process')
+
+
+def load_jobs(path: str) -> List[Dict]:
+    """
+    读取批量需求文件
+
+    每行一个 JSON 对象: {"id": "todo-api", "requirement": "...", "max_iterations": 2,
+    "stream": false, "fanout": true},只有 requirement 必填;也可以直接写 JSON 字符串。
+    空行与 # 开头的行会被忽略。
+
+    Args:
+        path: JSONL 文件路径
+
+    Returns:
+        任务列表,每个任务都带有唯一的 id
+    """
+    jobs = []
+    seen = set()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f'{path}:{line_no} 不是合法的 JSON: {str(e)}')
+            job = {'requirement': item} if isinstance(item, str) else dict(item)
+            if not job.get('requirement'):
+                raise ValueError(f'{path}:{line_no} 缺少 requirement')
+
+            # id 用作输出子目录名,只保留安全字符
+            job_id = re.sub(r'[^\w.-]+', '-', str(job.get('id') or f'job-{len(jobs) + 1:04d}')).strip('-.')
+            if job_id in seen:
+                raise ValueError(f'{path}:{line_no} 任务 id 重复: {job_id}')
+            seen.add(job_id)
+            job['id'] = job_id
+            jobs.append(job)
+    return jobs
+
+
+def run_job(job: Dict, batch_dir: str, log_to_file: bool = False) -> Dict:
+    """
+    运行一个任务,返回汇总记录
+
+    Args:
+        job: load_jobs 返回的任务
+        batch_dir: 本次批量运行的目录,任务输出写入 batch_dir/<id>/
+        log_to_file: 是否把任务输出重定向到 batch_dir/<id>/pipeline.log (进程池模式)
+    """
+    from orchestrator import main
+
+    output_dir = os.path.join(batch_dir, job['id'])
+    os.makedirs(output_dir, exist_ok=True)
+    record = {'id': job['id'], 'requirement': job['requirement'], 'output_dir': output_dir}
+
+    stdout, stderr = sys.stdout, sys.stderr
+    log = open(os.path.join(output_dir, 'pipeline.log'), 'w', encoding='utf-8') if log_to_file else None
+    if log:
+        sys.stdout = sys.stderr = log
+    started_at = time.perf_counter()
+    try:
+        outcome = main(
+            job['requirement'],
+            job.get('max_iterations', 2),
+            stream=job.get('stream'),
+            fanout=job.get('fanout'),
+            output_dir=output_dir
+        )
+        record.update(outcome)
+    except Exception as e:
+        traceback.print_exc()
+        record.update({'status': 'error', 'passed': False, 'error': str(e)})
+    finally:
+        if log:
+            sys.stdout, sys.stderr = stdout, stderr
+            log.close()
+    record['elapsed'] = round(time.perf_counter() - started_at, 3)
+    return record
+
+
+def configure_in_flight(max_in_flight: Optional[int]):
+    """限制 LLM 并发请求数:启用限流器并设置每个端点的并发上限 (须在创建 LLMClient 之前调用)"""
+    if max_in_flight:
+        os.environ['LLM_RATE_LIMIT'] = 'true'
+        os.environ['LLM_MAX_CONCURRENCY'] = str(max_in_flight)
+
+
+def _process_init(max_in_flight: Optional[int]):
+    configure_in_flight(max_in_flight)
+
+
+def run_batch(
+    path: str,
+    workers: Optional[int] = None,
+    executor: Optional[str] = None,
+    output_root: Optional[str] = None,
+    max_in_flight: Optional[int] = None,
+    summary_path: Optional[str] = None
+) -> List[Dict]:
+    """
+    批量运行流水线
+
+    - thread: 所有任务共享进程内的客户端池、限流器、重试策略与端点统计,
+      各任务的输出会交错打印到控制台
+    - process: 每个进程独立运行,任务输出写入各自目录下的 pipeline.log;
+      限流器各进程独立 (可设置 LLM_RATE_LIMIT_DB 共享 RPM / TPM 令牌桶)
+
+    Args:
+        path: 需求 JSONL 文件
+        workers: 同时运行的任务数 (PIPELINE_BATCH_WORKERS, 默认 4)
+        executor: 'thread' 或 'process' (PIPELINE_BATCH_EXECUTOR, 默认 thread)
+        output_root: 输出根目录,本次批量运行的目录为 <输出根目录>/batches/<batch ID>/,每个任务一个子目录
+        max_in_flight: 同时进行的 LLM 请求数上限 (PIPELINE_BATCH_MAX_IN_FLIGHT),
+            进程池模式下按进程数均分 (进程数超过上限时降为上限)
+        summary_path: 汇总 JSONL 路径,默认为批量运行目录下的 batch_summary.jsonl
+
+    Returns:
+        各任务的汇总记录 (与输入顺序一致)
+    """
+    jobs = load_jobs(path)
+    workers = max(1, workers or int(os.getenv('PIPELINE_BATCH_WORKERS', '4')))
+    executor = executor or os.getenv('PIPELINE_BATCH_EXECUTOR', 'thread')
+    if executor not in EXECUTORS:
+        raise ValueError(f'不支持的 executor: {executor} (可选 {", ".join(EXECUTORS)})')
+    if max_in_flight is None and os.getenv('PIPELINE_BATCH_MAX_IN_FLIGHT'):
+        max_in_flight = int(os.getenv('PIPELINE_BATCH_MAX_IN_FLIGHT'))
+    if executor == 'process' and max_in_flight and workers > max_in_flight:
+        # 进程之间不共享限流器,每个进程至少占用 1 个并发名额
+        print(f'⚠️  进程数 {workers} 超过 LLM 并发请求上限 {max_in_flight},进程数降为 {max_in_flight}')
+        workers = max_in_flight
+    batch_id, batch_dir = create_run_dir(output_root, kind='batches')
+    summary_path = summary_path or os.path.join(batch_dir, 'batch_summary.jsonl')
+
+    print('\n' + '='*60)
+    print(f'批量模式: {len(jobs)} 个需求, {workers} 个 {executor} worker')
+    if max_in_flight:
+        print(f'LLM 并发请求上限: {max_in_flight}')
+    print(f'Batch ID: {batch_id}')
+    print(f'输出目录: {batch_dir}')
+    print('='*60)
+
+    records: Dict[str, Dict] = {}
+    started_at = time.perf_counter()
+
+    if executor == 'process':
+        per_process = max_in_flight // workers if max_in_flight else None
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_process_init, initargs=(per_process,))
+        submit = lambda job: pool.submit(run_job, job, batch_dir, True)
+    else:
+        configure_in_flight(max_in_flight)
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch')
+        submit = lambda job: pool.submit(run_job, job, batch_dir, False)
+
+    # 每完成一个任务就追加一行汇总,中途中断也能保留已完成的结果
+    with pool, open(summary_path, 'w', encoding='utf-8') as summary:
+        futures = {submit(job): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                record = {'id': job['id'], 'requirement': job['requirement'],
+                          'status': 'error', 'passed': False, 'error': str(e)}
+            records[job['id']] = record
+            summary.write(json.dumps(record, ensure_ascii=False) + '\n')
+            summary.flush()
+            icon = '✓' if record.get('passed') else '✗'
+            print(f'{icon} [{len(records)}/{len(jobs)}] {job["id"]}: {record.get("status")} '
+                  f'({record.get("elapsed", 0):.1f}s)')
+
+    elapsed = time.perf_counter() - started_at
+    results = [records[job['id']] for job in jobs]
+    passed = sum(1 for r in results if r.get('passed'))
+    job_time = sum(r.get('elapsed', 0) for r in results)
+    tokens = sum(r.get('prompt_tokens', 0) + r.get('completion_tokens', 0) for r in results)
+
+    print('\n' + '='*60)
+    print(f'批量完成: {passed}/{len(jobs)} 个通过审查, 总耗时 {elapsed:.1f}s (各任务耗时合计 {job_time:.1f}s)')
+    print(f'Token 用量 (估算): {tokens}')
+    print(f'汇总: {summary_path}')
+    return results
@@ -0,0 +1,109 @@
+# checkpoint.py
+# 断点续跑:复用运行目录中已保存的步骤结果 (提示词与配置指纹一致时),从第一个未完成的步骤继续
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from typing import Dict, List, Optional
+
+# 步骤执行顺序: srs, code, review_0, fix_1, review_1, fix_2, ...
+STEP_PATTERN = re.compile(r'^step\d_(srs|code|review|fix)(?:_(\d+))?$')
+STEP_NAMES = ('srs', 'code', 'review', 'fix')
+
+
+def fingerprint(stage: str, prompt: str, models: List[str], **options) -> str:
+    """步骤输入的指纹:阶段、完整提示词、模型与影响输出的选项"""
+    payload = json.dumps({'stage': stage, 'prompt': prompt, 'models': list(models), 'options': options},
+                         ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def step_position(name: str) -> int:
+    """
+    步骤在执行顺序中的位置
+
+    Args:
+        name: 步骤文件名 (step3_review_1) 或 --from-step 参数 (srs / code / review / fix / review_1 / fix_2)
+    """
+    match = STEP_PATTERN.match(name) or re.match(r'^(srs|code|review|fix)(?:_(\d+))?$', name)
+    if not match:
+        raise ValueError(f'无法识别的步骤: {name} (可选 {", ".join(STEP_NAMES)},或 review_<n> / fix_<n>)')
+    kind, index = match.group(1), match.group(2)
+    if kind == 'srs':
+        return 0
+    if kind == 'code':
+        return 1
+    if kind == 'review':
+        return 2 + 2 * int(index or 0)
+    return 1 + 2 * int(index or 1)
+
+
+class Checkpoint:
+    """
+    运行目录中已保存的步骤结果
+
+    load() 在步骤结果存在且指纹一致时返回保存的数据;指纹不一致 (提示词或配置变化)
+    或位于 --from-step 之后时,该步骤及其后所有步骤的结果移入 superseded/<时间>/,重新执行。
+    """
+
+    def __init__(self, run_dir: str, from_step: Optional[str] = None):
+        """
+        Args:
+            run_dir: 要续跑的运行目录
+            from_step: 从该步骤起重新执行 (之前的步骤照常复用)
+        """
+        self.run_dir = run_dir
+        self.from_position = step_position(from_step) if from_step else None
+        self.reused: List[str] = []
+        self._lock = threading.Lock()
+
+    def load(self, step: str, expected: str) -> Optional[Dict]:
+        """
+        读取可复用的步骤结果
+
+        Args:
+            step: 步骤名称 (保存文件名,不含 .json)
+            expected: 本次运行计算出的指纹
+
+        Returns:
+            保存的数据,不可复用时返回 None
+        """
+        path = os.path.join(self.run_dir, f'{step}.json')
+        position = step_position(step)
+        with self._lock:
+            if not os.path.exists(path):
+                return None
+            if self.from_position is not None and position >= self.from_position:
+                self._supersede(position)
+                return None
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                data = {}
+            if data.get('fingerprint') != expected:
+                print(f'⚠️  {step}.json 的提示词或配置已变化,重新执行')
+                self._supersede(position)
+                return None
+            self.reused.append(step)
+        print(f'↺ 复用已保存的结果: {step}.json')
+        return data
+
+    def _supersede(self, position: int):
+        """把位于 position 及之后的步骤结果移入 superseded/<时间>/"""
+        stale = []
+        for path in glob.glob(os.path.join(self.run_dir, 'step*.json')):
+            name = os.path.splitext(os.path.basename(path))[0]
+            if STEP_PATTERN.match(name) and step_position(name) >= position:
+                stale.append(path)
+        if not stale:
+            return
+        target = os.path.join(self.run_dir, 'superseded', time.strftime('%Y%m%d-%H%M%S'))
+        os.makedirs(target, exist_ok=True)
+        for path in stale:
+            shutil.move(path, os.path.join(target, os.path.basename(path)))
+        print(f'  已将 {len(stale)} 个过期结果移至 {target}')
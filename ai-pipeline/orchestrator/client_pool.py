@@ -0,0 +1,255 @@
+# client_pool.py
+# LLM SDK 客户端池:复用长连接 (keep-alive / HTTP/2),并统计连接复用情况
+import asyncio
+import os
+import threading
+import weakref
+from typing import Dict, Optional, Tuple
+
+
+class PoolConfig:
+    """HTTP 连接池配置,默认值从环境变量读取"""
+
+    def __init__(
+        self,
+        max_connections: Optional[int] = None,
+        max_keepalive_connections: Optional[int] = None,
+        keepalive_expiry: Optional[float] = None,
+        http2: Optional[bool] = None,
+        timeout: Optional[float] = None,
+        max_retries: Optional[int] = None
+    ):
+        """
+        初始化连接池配置
+
+        Args:
+            max_connections: 最大连接数 (LLM_HTTP_MAX_CONNECTIONS, 默认 100)
+            max_keepalive_connections: 最大空闲长连接数 (LLM_HTTP_MAX_KEEPALIVE, 默认 20)
+            keepalive_expiry: 空闲长连接保留秒数 (LLM_HTTP_KEEPALIVE_EXPIRY, 默认 60)
+            http2: 是否启用 HTTP/2 (LLM_HTTP2, 默认 false, 需要安装 h2)
+            timeout: 请求超时秒数 (LLM_HTTP_TIMEOUT, 默认 600)
+            max_retries: SDK 内置重试次数 (LLM_SDK_MAX_RETRIES, 默认 0);
+                         LLMClient 的重试由 call_with_retry (retry_policy) 负责,429 与 5xx 需要经过
+                         限流器、AIMD 并发调整与熔断器;SDK 内部重试发生在同一个限流许可与同一次尝试内,
+                         这些组件看不到,与 call_with_retry 叠加时一次逻辑调用最多会发出 (1 + N) × 尝试次数 个请求
+        """
+        self.max_connections = max_connections if max_connections is not None else \
+            int(os.getenv('LLM_HTTP_MAX_CONNECTIONS', '100'))
+        self.max_keepalive_connections = max_keepalive_connections if max_keepalive_connections is not None else \
+            int(os.getenv('LLM_HTTP_MAX_KEEPALIVE', '20'))
+        self.keepalive_expiry = keepalive_expiry if keepalive_expiry is not None else \
+            float(os.getenv('LLM_HTTP_KEEPALIVE_EXPIRY', '60'))
+        self.http2 = http2 if http2 is not None else \
+            os.getenv('LLM_HTTP2', 'false').lower() == 'true'
+        self.timeout = timeout if timeout is not None else \
+            float(os.getenv('LLM_HTTP_TIMEOUT', '600'))
+        self.max_retries = max_retries if max_retries is not None else \
+            int(os.getenv('LLM_SDK_MAX_RETRIES', '0'))
+
+
+class ClientPool:
+    """
+    长生命周期的 SDK 客户端池
+
+    同一 (提供商, API Key, base_url) 只创建一个 SDK 客户端,底层 httpx 连接池
+    在多次调用、多条流水线之间复用,避免每次调用都重新建立 TCP/TLS 连接。
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, config: Optional[PoolConfig] = None):
+        """
+        初始化客户端池
+
+        Args:
+            config: 连接池配置,为空时从环境变量读取
+        """
+        self.config = config or PoolConfig()
+        self._clients: Dict[Tuple[str, str, str], object] = {}
+        # 异步客户端的连接绑定在事件循环上,按事件循环分别缓存
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._stats = {
+            'requests': 0,
+            'new_connections': 0,
+            'clients_created': 0,
+        }
+
+    @classmethod
+    def shared(cls) -> 'ClientPool':
+        """获取进程内共享的客户端池 (多条流水线共用同一组连接)"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def get_openai(self, api_key: str, base_url: Optional[str] = None):
+        """获取 (或创建) 复用连接的 OpenAI 客户端"""
+        key = ('openai', api_key or '', base_url or '')
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                import openai
+
+                client_kwargs = {
+                    'api_key': api_key,
+                    'max_retries': self.config.max_retries,
+                    'http_client': self._build_http_client(openai.DefaultHttpxClient),
+                }
+                if base_url:
+                    client_kwargs['base_url'] = base_url
+                client = openai.OpenAI(**client_kwargs)
+                self._register(key, client)
+            return client
+
+    def get_anthropic(self, api_key: str):
+        """获取 (或创建) 复用连接的 Anthropic 客户端"""
+        key = ('anthropic', api_key or '', '')
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                import anthropic
+
+                client = anthropic.Anthropic(
+                    api_key=api_key,
+                    max_retries=self.config.max_retries,
+                    http_client=self._build_http_client(anthropic.DefaultHttpxClient),
+                )
+                self._register(key, client)
+            return client
+
+    def get_async_openai(self, api_key: str, base_url: Optional[str] = None):
+        """获取当前事件循环内复用连接的 AsyncOpenAI 客户端"""
+        key = ('openai', api_key or '', base_url or '')
+        loop_clients = self._loop_clients()
+        with self._lock:
+            client = loop_clients.get(key)
+            if client is None:
+                import openai
+
+                client_kwargs = {
+                    'api_key': api_key,
+                    'max_retries': self.config.max_retries,
+                    'http_client': self._build_http_client(openai.DefaultAsyncHttpxClient, is_async=True),
+                }
+                if base_url:
+                    client_kwargs['base_url'] = base_url
+                client = openai.AsyncOpenAI(**client_kwargs)
+                loop_clients[key] = client
+                self._stats['clients_created'] += 1
+            return client
+
+    def get_async_anthropic(self, api_key: str):
+        """获取当前事件循环内复用连接的 AsyncAnthropic 客户端"""
+        key = ('anthropic', api_key or '', '')
+        loop_clients = self._loop_clients()
+        with self._lock:
+            client = loop_clients.get(key)
+            if client is None:
+                import anthropic
+
+                client = anthropic.AsyncAnthropic(
+                    api_key=api_key,
+                    max_retries=self.config.max_retries,
+                    http_client=self._build_http_client(anthropic.DefaultAsyncHttpxClient, is_async=True),
+                )
+                loop_clients[key] = client
+                self._stats['clients_created'] += 1
+            return client
+
+    async def aclose(self):
+        """关闭当前事件循环内的异步客户端"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            clients = list(self._async_clients.pop(loop, {}).values())
+        for client in clients:
+            try:
+                await client.close()
+            except Exception:
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        """
+        连接复用统计
+
+        Returns:
+            包含 requests / new_connections / reused_connections / clients_created 的字典
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['reused_connections'] = max(0, stats['requests'] - stats['new_connections'])
+        return stats
+
+    def close(self):
+        """关闭池中所有客户端及其连接"""
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients.clear()
+        for client in clients:
+            try:
+                client.close()
+            except Exception:
+                pass
+
+    def _register(self, key: Tuple[str, str, str], client: object):
+        """登记新建的客户端 (调用方需持有锁)"""
+        self._clients[key] = client
+        self._stats['clients_created'] += 1
+
+    def _loop_clients(self) -> Dict[Tuple[str, str, str], object]:
+        """返回当前运行中事件循环对应的异步客户端缓存"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            loop_clients = self._async_clients.get(loop)
+            if loop_clients is None:
+                loop_clients = {}
+                self._async_clients[loop] = loop_clients
+            return loop_clients
+
+    def _build_http_client(self, client_cls, is_async: bool = False):
+        """构建带连接池限制、keep-alive 与连接统计的 httpx 客户端"""
+        import httpx
+
+        http2 = self.config.http2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                print('⚠️  未安装 h2,HTTP/2 已禁用 (pip install h2)')
+                http2 = False
+
+        limits = httpx.Limits(
+            max_connections=self.config.max_connections,
+            max_keepalive_connections=self.config.max_keepalive_connections,
+            keepalive_expiry=self.config.keepalive_expiry,
+        )
+        return client_cls(
+            limits=limits,
+            http2=http2,
+            timeout=self.config.timeout,
+            event_hooks={'request': [self._aon_request if is_async else self._on_request]},
+        )
+
+    def _on_request(self, request):
+        """请求钩子:计数并挂载 trace 回调,用于识别是否新建了连接"""
+        self._count('requests')
+        request.extensions['trace'] = self._trace
+
+    async def _aon_request(self, request):
+        """异步请求钩子 (httpx.AsyncClient 要求钩子为协程)"""
+        self._count('requests')
+        request.extensions['trace'] = self._atrace
+
+    def _trace(self, event_name: str, info: dict):
+        """httpcore trace 回调: 出现 connect_tcp 即表示本次请求新建了连接"""
+        if event_name in ('connection.connect_tcp.started', 'connection.connect_unix_socket.started'):
+            self._count('new_connections')
+
+    async def _atrace(self, event_name: str, info: dict):
+        """httpcore 异步 trace 回调"""
+        self._trace(event_name, info)
+
+    def _count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
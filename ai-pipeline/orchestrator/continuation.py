@@ -0,0 +1,183 @@
+# continuation.py
+# 自动续写:输出因 max_tokens 截断时发起续写请求,并把各段输出拼接为一个完整响应
+from typing import AsyncIterator, Callable, Iterator, List, Optional, Tuple
+
+from token_budget import REQUEST_OVERHEAD_TOKENS, TokenBudget, context_window, count_tokens
+
+# finish_reason (OpenAI) / stop_reason (Anthropic) 中表示输出被截断的取值
+TRUNCATED_REASONS = {'length', 'max_tokens'}
+
+CONTINUE_PROMPT = ('你的上一条回复因长度限制被截断。请从截断处直接继续输出,不要重复已输出的内容,'
+                   '不要添加任何说明;如果截断发生在代码块中间,不要重新开始代码块。')
+
+# 检查续写开头与已有文本重复的最大长度,以及认定为重复的最小长度 (过短的重合可能只是巧合)
+OVERLAP_WINDOW = 200
+MIN_OVERLAP = 10
+# 代码块首行的路径标记 (与 streaming.CODE_BLOCK_PATTERN 一致)
+PATH_MARKERS = ('# path:', '// path:', '<!-- path:')
+
+
+class LLMText(str):
+    """
+    模型输出文本,附带结束原因与续写次数 (可以当作普通 str 使用)
+
+    continuation_prompt_tokens 为各次续写请求的提示词 token 数之和 (TokenBudget.record 计入报告);
+    continuation_error 为续写失败的原因 (此时文本是截断的部分输出)。
+    """
+
+    def __new__(cls, text: str, finish_reason: Optional[str] = None, continuations: int = 0,
+                continuation_prompt_tokens: int = 0, continuation_error: Optional[str] = None):
+        obj = super().__new__(cls, text)
+        obj.finish_reason = finish_reason
+        obj.continuations = continuations
+        obj.continuation_prompt_tokens = continuation_prompt_tokens
+        obj.continuation_error = continuation_error
+        return obj
+
+
+class TextStream:
+    """流式响应迭代器,迭代结束后可以读取 finish_reason / continuations"""
+
+    def __init__(self, produce: Callable[['TextStream'], Iterator[str]]):
+        self.finish_reason: Optional[str] = None
+        self.continuations = 0
+        self.continuation_prompt_tokens = 0
+        self.continuation_error: Optional[str] = None
+        self._chunks = produce(self)
+
+    def __iter__(self) -> 'TextStream':
+        return self
+
+    def __next__(self) -> str:
+        return next(self._chunks)
+
+    def close(self):
+        self._chunks.close()
+
+
+class AsyncTextStream:
+    """TextStream 的异步版本"""
+
+    def __init__(self, produce: Callable[['AsyncTextStream'], AsyncIterator[str]]):
+        self.finish_reason: Optional[str] = None
+        self.continuations = 0
+        self.continuation_prompt_tokens = 0
+        self.continuation_error: Optional[str] = None
+        self._chunks = produce(self)
+
+    def __aiter__(self) -> 'AsyncTextStream':
+        return self
+
+    async def __anext__(self) -> str:
+        return await self._chunks.__anext__()
+
+    async def aclose(self):
+        await self._chunks.aclose()
+
+
+def is_truncated(finish_reason: Optional[str]) -> bool:
+    """输出是否因达到 max_tokens 被截断"""
+    return finish_reason in TRUNCATED_REASONS
+
+
+def continuation_request(provider: str, request: dict, text: str) -> dict:
+    """
+    构建续写请求
+
+    - Anthropic: 把已输出内容作为 assistant 预填充,模型从截断处直接接着写
+      (预填充内容不能以空白结尾)
+    - OpenAI 兼容接口: 追加 assistant 已输出内容和一条要求继续的 user 消息
+    """
+    messages = list(request['messages'])
+    if provider == 'anthropic':
+        messages.append({'role': 'assistant', 'content': text.rstrip()})
+    else:
+        messages.append({'role': 'assistant', 'content': text})
+        messages.append({'role': 'user', 'content': CONTINUE_PROMPT})
+    return dict(request, messages=messages)
+
+
+def fit_continuation(request: dict, models: List[str]) -> Tuple[Optional[dict], int]:
+    """
+    按上下文窗口剩余空间重新确定续写请求的 max_tokens
+
+    续写请求包含原提示词与已输出的全部文本,沿用原来的 max_tokens 可能超出上下文窗口。
+    安全余量与最小输出沿用 TokenBudget 的配置 (LLM_TOKEN_SAFETY_MARGIN / LLM_MIN_OUTPUT_TOKENS)。
+
+    Args:
+        request: continuation_request 构建的续写请求
+        models: 本次调用可能使用的模型 (多端点路由时取上下文窗口最小者)
+
+    Returns:
+        (调整 max_tokens 后的续写请求, 提示词 token 数);剩余空间不足时请求为 None (停止续写)
+    """
+    model = min(models, key=context_window) if models else request.get('model', '')
+    text = '\n'.join(str(message.get('content') or '') for message in request['messages'])
+    prompt_tokens = count_tokens(text + str(request.get('system') or ''), model)[0] + REQUEST_OVERHEAD_TOKENS
+    limits = TokenBudget()
+    available = context_window(model) - prompt_tokens - limits.safety_margin
+    if available < limits.min_output:
+        return None, prompt_tokens
+    return dict(request, max_tokens=min(request['max_tokens'], available)), prompt_tokens
+
+
+def continuation_base(provider: str, text: str) -> str:
+    """续写内容要拼接到的文本 (Anthropic 预填充时去掉了末尾空白)"""
+    return text.rstrip() if provider == 'anthropic' else text
+
+
+def trim_continuation(provider: str, text: str, more: str) -> str:
+    """
+    整理续写内容,返回应追加到 text 之后的部分
+
+    OpenAI 兼容接口的续写可能重新打开被截断的代码块 (```lang 或 ``` 加 path 标记行),
+    也可能重复已输出内容的末尾,这两种情况都去掉。Anthropic 预填充续写无需处理。
+    """
+    if provider == 'anthropic':
+        return more
+
+    if text.count('```') % 2 == 1:
+        stripped = more.lstrip()
+        if stripped.startswith('```'):
+            first_line, _, rest = stripped.partition('\n')
+            has_path = rest.lstrip().startswith(PATH_MARKERS)
+            if first_line.strip() != '```' or has_path:
+                more = rest.lstrip().partition('\n')[2] if has_path else rest
+
+    for size in range(min(len(text), len(more), OVERLAP_WINDOW), MIN_OVERLAP - 1, -1):
+        if text.endswith(more[:size]):
+            return more[size:]
+    return more
+
+
+class StreamStitcher:
+    """
+    流式续写拼接
+
+    续写流的开头先缓存 OVERLAP_WINDOW 个字符,确定重复部分后再产出,之后直接透传。
+    """
+
+    def __init__(self, provider: str, text: str, continuation: bool):
+        self.provider = provider
+        self.text = continuation_base(provider, text) if continuation else text
+        self._pending = '' if continuation else None
+
+    def feed(self, piece: str) -> str:
+        """追加一段流式文本,返回可以立即产出的部分"""
+        if self._pending is None:
+            self.text += piece
+            return piece
+        self._pending += piece
+        if len(self._pending) < OVERLAP_WINDOW:
+            return ''
+        return self._release()
+
+    def flush(self) -> str:
+        """流结束时产出剩余缓存"""
+        return self._release() if self._pending is not None else ''
+
+    def _release(self) -> str:
+        out = trim_continuation(self.provider, self.text, self._pending)
+        self._pending = None
+        self.text += out
+        return out
@@ -0,0 +1,146 @@
+# convergence.py
+# 修复循环的收敛判断:跟踪每轮代码内容与缺陷集合的指纹,无进展或来回振荡时提前停止,
+# 并按本次运行的剩余时间与 token 预算判断是否值得再进行一轮修复
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+from fanout import normalize_path
+from fix_scope import Defect
+from review_shards import defect_key
+
+# 停止原因
+STOP_REASONS = {
+    'passed': '审查通过',
+    'max_iterations': '达到最大修复次数',
+    'no_defects': '没有具体的缺陷信息',
+    'no_change': '修复后的代码与上一轮完全相同',
+    'same_defects': '修复后审查报告的缺陷与上一轮相同',
+    'oscillation': '代码或缺陷回到了之前某一轮的状态 (来回振荡)',
+    'time_budget': '剩余时间不足以完成下一轮修复',
+    'token_budget': '剩余 token 预算不足以完成下一轮修复',
+}
+
+
+def code_fingerprint(code_blocks: List[Tuple[str, str]]) -> str:
+    """代码块集合的内容指纹 (与顺序无关)"""
+    payload = json.dumps(sorted((normalize_path(p), c) for p, c in code_blocks), ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def defect_fingerprint(defects: List[Defect]) -> str:
+    """缺陷集合的指纹 (按文件与归一化描述,忽略顺序、严重程度与措辞中的空白标点)"""
+    payload = json.dumps(sorted({defect_key(d) for d in defects}), ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+class FixLoopTracker:
+    """
+    修复循环的收敛跟踪
+
+    每次审查 (含本地测试) 结束后调用 observe() 记录本轮状态,返回是否进入下一轮修复及原因:
+    修复没有改变代码、缺陷集合与上一轮相同、代码或缺陷回到更早某轮的状态时停止;
+    按已完成各轮的平均耗时与 token 用量估算下一轮的花费,超出剩余的时间或 token 预算时停止。
+    """
+
+    def __init__(self, max_iterations: int, deadline: float = 0, max_tokens: int = 0):
+        """
+        Args:
+            max_iterations: 最大修复次数
+            deadline: 本次运行的时间预算 (秒,PIPELINE_RUN_DEADLINE,0 表示不限)
+            max_tokens: 本次运行的 token 预算 (输入 + 输出,PIPELINE_RUN_MAX_TOKENS,0 表示不限)
+        """
+        self.max_iterations = max_iterations
+        self.deadline = deadline
+        self.max_tokens = max_tokens
+        self.history: List[Dict] = []
+        self.reason: Optional[str] = None
+
+    @classmethod
+    def from_env(cls, max_iterations: int) -> 'FixLoopTracker':
+        """从环境变量创建 (PIPELINE_RUN_DEADLINE / PIPELINE_RUN_MAX_TOKENS)"""
+        return cls(max_iterations,
+                   deadline=float(os.getenv('PIPELINE_RUN_DEADLINE', '0')),
+                   max_tokens=int(os.getenv('PIPELINE_RUN_MAX_TOKENS', '0')))
+
+    def observe(self, iteration: int, code_blocks: List[Tuple[str, str]], review_result: Dict,
+                elapsed: float, tokens: int) -> Tuple[bool, str]:
+        """
+        记录一轮审查后的状态并决定是否继续修复
+
+        Args:
+            iteration: 本轮的修复序号 (0 为首次审查)
+            code_blocks: 本轮审查的代码
+            review_result: 本轮的审查结果 (含本地测试缺陷)
+            elapsed: 本次运行已用时间 (秒)
+            tokens: 本次运行已用 token (输入 + 输出)
+
+        Returns:
+            (是否进入下一轮修复, 原因,见 STOP_REASONS;继续时为 continue)
+        """
+        defects = review_result.get('defects', [])
+        entry = {
+            'iteration': iteration,
+            'code': code_fingerprint(code_blocks),
+            'defects': defect_fingerprint(defects),
+            'defect_count': len(defects),
+            'elapsed': round(elapsed, 3),
+            'tokens': tokens,
+        }
+        previous = self.history[:]
+        self.history.append(entry)
+
+        reason = self._stop_reason(entry, previous, review_result)
+        entry['decision'] = reason or 'continue'
+        if reason:
+            self.reason = reason
+        return reason is None, entry['decision']
+
+    def _stop_reason(self, entry: Dict, previous: List[Dict], review_result: Dict) -> Optional[str]:
+        if review_result.get('passed'):
+            return 'passed'
+        if entry['iteration'] >= self.max_iterations:
+            return 'max_iterations'
+        if not entry['defect_count']:
+            return 'no_defects'
+        if previous:
+            last = previous[-1]
+            if entry['code'] == last['code']:
+                return 'no_change'
+            if entry['defects'] == last['defects']:
+                return 'same_defects'
+            earlier = previous[:-1]
+            if any(entry['code'] == e['code'] or entry['defects'] == e['defects'] for e in earlier):
+                return 'oscillation'
+
+        time_cost, token_cost = self.next_round_cost()
+        if self.deadline and entry['elapsed'] + time_cost > self.deadline:
+            return 'time_budget'
+        if self.max_tokens and entry['tokens'] + token_cost > self.max_tokens:
+            return 'token_budget'
+        return None
+
+    def next_round_cost(self) -> Tuple[float, int]:
+        """
+        估算下一轮修复 (修复 + 复审) 的耗时与 token
+
+        已有完成的修复轮次时取各轮的平均值;否则以首次审查前的全部花费 (生成 + 审查) 为上界估计。
+        """
+        if len(self.history) > 1:
+            rounds = len(self.history) - 1
+            return ((self.history[-1]['elapsed'] - self.history[0]['elapsed']) / rounds,
+                    (self.history[-1]['tokens'] - self.history[0]['tokens']) // rounds)
+        first = self.history[0]
+        return first['elapsed'], first['tokens']
+
+    def report(self) -> Dict:
+        """保存为 fix_loop.json 的收敛记录"""
+        return {
+            'reason': self.reason,
+            'description': STOP_REASONS.get(self.reason),
+            'max_iterations': self.max_iterations,
+            'deadline': self.deadline,
+            'max_tokens': self.max_tokens,
+            'history': self.history,
+        }
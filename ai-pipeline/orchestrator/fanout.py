@@ -0,0 +1,140 @@
+# fanout.py
+# 按任务并行生成代码的辅助逻辑:任务分组、文件归属与路径冲突处理
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+# 并行生成时追加到代码生成提示词末尾的范围说明
+FANOUT_SCOPE_NOTE = """
+---
+
+**本次生成范围:**
+
+项目由多位工程师并行实现,你只负责上面任务列表中的任务,只输出以下文件:
+{{OWN_FILES}}
+
+项目的完整文件清单如下 (其他文件由其他工程师实现,可以按 SRS 约定直接导入,不要输出这些文件):
+{{ALL_FILES}}
+"""
+
+
+def normalize_path(path: str) -> str:
+    """统一路径写法 (去掉 ./ 与开头的 /,使用正斜杠),用于比较不同任务生成的文件"""
+    path = path.strip().replace('\\', '/')
+    while path.startswith('./'):
+        path = path[2:]
+    return os.path.normpath(path.lstrip('/')).replace('\\', '/')
+
+
+def group_tasks(tasks: List[Dict], max_groups: int) -> List[List[Dict]]:
+    """
+    把任务按目标文件分组
+
+    同一文件的任务放在同一组;没有 file 字段的任务按 module 分组。
+    分组数超过 max_groups 时按顺序合并相邻分组。
+
+    Args:
+        tasks: SRS 任务列表 [{'module', 'file', 'task'}, ...]
+        max_groups: 最大分组数 (即最多并发生成的请求数)
+
+    Returns:
+        分组后的任务列表
+    """
+    groups: Dict[str, List[Dict]] = {}
+    for task in tasks:
+        key = normalize_path(task['file']) if task.get('file') else f'module:{task.get("module", "")}'
+        groups.setdefault(key, []).append(task)
+
+    ordered = list(groups.values())
+    max_groups = max(1, max_groups)
+    if len(ordered) <= max_groups:
+        return ordered
+
+    size = -(-len(ordered) // max_groups)
+    return [sum(ordered[i:i + size], []) for i in range(0, len(ordered), size)]
+
+
+def task_files(tasks: List[Dict]) -> List[str]:
+    """任务列表中声明的目标文件 (去重,保持顺序)"""
+    files = []
+    for task in tasks:
+        if task.get('file'):
+            path = normalize_path(task['file'])
+            if path not in files:
+                files.append(path)
+    return files
+
+
+class PathClaims:
+    """
+    并行生成时的文件归属登记
+
+    任务列表声明了目标文件的分组是该文件的归属者。某个文件被多个分组输出时:
+    归属者的版本优先;都不是归属者时先到先得。被丢弃的版本记录在 conflicts 中。
+    """
+
+    def __init__(self, groups: List[List[Dict]]):
+        self.owners: Dict[str, int] = {}
+        for index, group in enumerate(groups):
+            for path in task_files(group):
+                self.owners.setdefault(path, index)
+        self.claimed: Dict[str, int] = {}
+        self.conflicts: List[Dict] = []
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def claim(self, path: str, group: int) -> bool:
+        """
+        登记分组 group 输出的文件
+
+        Returns:
+            是否采用该分组的版本
+        """
+        path = normalize_path(path)
+        with self._lock:
+            if (path, group) in self._seen:
+                return self.claimed.get(path) == group
+            self._seen.add((path, group))
+
+            holder = self.claimed.get(path)
+            if holder is None or holder == group:
+                self.claimed[path] = group
+                return True
+
+            owner = self.owners.get(path)
+            if owner == group:
+                self.claimed[path] = group
+                self.conflicts.append({'path': path, 'kept_group': group, 'dropped_group': holder})
+                print(f'⚠️  路径冲突: {path} 由任务组 {holder + 1} 和 {group + 1} 同时生成,采用归属任务组 {group + 1} 的版本')
+                return True
+
+            self.conflicts.append({'path': path, 'kept_group': holder, 'dropped_group': group})
+            print(f'⚠️  路径冲突: {path} 由任务组 {holder + 1} 和 {group + 1} 同时生成,保留任务组 {holder + 1} 的版本')
+            return False
+
+
+def merge_blocks(results: List[Optional[List[Tuple[str, str]]]], claims: PathClaims) -> List[Tuple[str, str]]:
+    """
+    合并各分组生成的代码块
+
+    Args:
+        results: 各分组的代码块列表 (按分组顺序,失败的分组为 None)
+        claims: 文件归属登记 (流式模式下生成过程中已经登记过的不会重复登记)
+
+    Returns:
+        合并后的代码块,每个路径只保留被采用的版本 (按首次出现的顺序)
+    """
+    for group, blocks in enumerate(results):
+        for path, _ in blocks or []:
+            claims.claim(path, group)
+
+    merged: Dict[str, Tuple[str, str]] = {}
+    order: List[str] = []
+    for group, blocks in enumerate(results):
+        for path, content in blocks or []:
+            key = normalize_path(path)
+            if key not in order:
+                order.append(key)
+            if claims.claimed.get(key) == group:
+                merged[key] = (path, content)
+    return [merged[key] for key in order if key in merged]
@@ -0,0 +1,156 @@
+# fix_candidates.py
+# 并行修复候选:以不同温度 / 模型同时生成多个修复候选并各自验证,采用最先通过验证的候选,取消其余候选
+# (用 token 换取墙钟时间,候选的总花费受上限约束)
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from token_budget import count_tokens
+
+# 未配置 LLM_FIX_CANDIDATE_TEMPERATURES 时各候选依次使用的温度
+DEFAULT_TEMPERATURES = (0.2, 0.7, 1.0)
+
+
+class CandidateCancelled(Exception):
+    """候选已被取消 (其他候选已通过验证)"""
+
+
+def candidate_variants(count: int, temperatures: Optional[List[float]] = None,
+                       models: Optional[List[str]] = None) -> List[Dict]:
+    """
+    各候选使用的温度与模型 (列表长度不足时循环使用)
+
+    Returns:
+        [{'temperature': 温度, 'model': 模型名或 None}, ...]
+    """
+    temperatures = temperatures or list(DEFAULT_TEMPERATURES)
+    return [{'temperature': temperatures[i % len(temperatures)],
+             'model': models[i % len(models)] if models else None} for i in range(count)]
+
+
+def variants_from_env() -> List[Dict]:
+    """
+    从环境变量读取候选配置
+
+    LLM_FIX_CANDIDATES (候选数,1 表示不启用)、LLM_FIX_CANDIDATE_TEMPERATURES、
+    LLM_FIX_CANDIDATE_MODELS (逗号分隔)
+    """
+    count = int(os.getenv('LLM_FIX_CANDIDATES', '1'))
+    temperatures = [float(t) for t in os.getenv('LLM_FIX_CANDIDATE_TEMPERATURES', '').split(',') if t.strip()]
+    models = [m.strip() for m in os.getenv('LLM_FIX_CANDIDATE_MODELS', '').split(',') if m.strip()]
+    return candidate_variants(count, temperatures, models) if count > 1 else []
+
+
+class SpendMeter:
+    """
+    候选调用的 token 花费上限
+
+    每次调用前按最坏情况 (提示词 + max_tokens) 预留,调用结束后按实际用量结算;
+    预留会超出上限的调用不发起,因此总花费不会超过上限。
+    """
+
+    def __init__(self, cap: int = 0):
+        """
+        Args:
+            cap: 花费上限 (提示词 + 输出 token,0 表示不限)
+        """
+        self.cap = cap
+        self.spent = 0
+        self.reserved = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: int) -> bool:
+        """预留一次调用的最坏情况花费,超出上限时返回 False"""
+        with self._lock:
+            if self.cap and self.spent + self.reserved + tokens > self.cap:
+                return False
+            self.reserved += tokens
+            return True
+
+    def settle(self, reserved: int, used: int):
+        """释放预留并计入实际花费"""
+        with self._lock:
+            self.reserved -= reserved
+            self.spent += used
+
+
+def consume(chunks: Iterable[str], cancel: threading.Event) -> str:
+    """
+    消费流式响应,取消时立即关闭流 (断开连接,服务端停止生成)
+
+    Raises:
+        CandidateCancelled: 接收过程中被取消 (异常的 partial 属性为已接收的文本)
+    """
+    parts: List[str] = []
+    try:
+        for chunk in chunks:
+            parts.append(chunk)
+            if cancel.is_set():
+                error = CandidateCancelled()
+                error.partial = ''.join(parts)
+                raise error
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+    return ''.join(parts)
+
+
+def call_cost(prompt: str, max_tokens: int, model: Optional[str]) -> int:
+    """一次调用的最坏情况花费 (提示词 + max_tokens)"""
+    return count_tokens(prompt, model)[0] + max_tokens
+
+
+def race(count: int, run: Callable[[int, threading.Event], Dict]) -> Tuple[Optional[int], List[Dict]]:
+    """
+    并行运行各候选 (生成 + 验证),采用最先通过验证的候选
+
+    有候选通过后设置取消信号:尚未开始的候选不再运行,正在流式生成的候选断开连接,
+    其余仍在进行的候选结果被忽略 (后台线程自行结束)。
+
+    Args:
+        count: 候选数
+        run: run(序号, 取消信号) → {'passed': bool, ...} (可以用 status 字段给出其他状态);
+             被取消时抛出 CandidateCancelled
+
+    Returns:
+        (通过验证的候选序号或 None, 各候选的记录
+         {'index', 'status': passed / failed / skipped / cancelled / error, 'elapsed', ... run 的返回值})
+    """
+    cancel = threading.Event()
+    records: List[Dict] = [{'index': i, 'status': 'cancelled', 'elapsed': None} for i in range(count)]
+    started_at = time.perf_counter()
+
+    def attempt(index: int) -> Dict:
+        if cancel.is_set():
+            raise CandidateCancelled()
+        outcome = run(index, cancel)
+        return dict(outcome, status=outcome.get('status') or ('passed' if outcome.get('passed') else 'failed'))
+
+    winner = None
+    executor = ThreadPoolExecutor(max_workers=count, thread_name_prefix='fix-candidate')
+    futures = {executor.submit(attempt, i): i for i in range(count)}
+    pending = set(futures)
+    try:
+        while pending and winner is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = futures[future]
+                record = records[index]
+                record['elapsed'] = round(time.perf_counter() - started_at, 3)
+                try:
+                    record.update(future.result())
+                except CandidateCancelled:
+                    record['status'] = 'cancelled'
+                except Exception as e:
+                    record.update(status='error', error=str(e))
+                if record['status'] == 'passed' and winner is None:
+                    winner = index
+    finally:
+        cancel.set()
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+    return winner, records
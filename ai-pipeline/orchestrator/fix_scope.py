@@ -0,0 +1,150 @@
+# fix_scope.py
+# 缺陷修复范围:把缺陷映射到涉及的文件,只把这些文件交给模型修复,其余文件提供接口摘要,修复结果合并回完整文件集
+import ast
+import os
+import re
+from typing import Dict, List, Tuple, Union
+
+from fanout import normalize_path
+
+Defect = Union[str, Dict]
+
+# 非 Python 文件中视为接口声明的行 (函数、类、导出、路由等)
+DECLARATION_PATTERN = re.compile(
+    r'^\s*(?:export\s+|public\s+|async\s+)*(?:def|class|function|interface|type|func|const|let|var|'
+    r'struct|enum|module|@app\.route|@router\.|router\.\w+\()\b.*$',
+    re.MULTILINE
+)
+MAX_SUMMARY_LINES = 40
+
+
+def implicated_files(defect: Defect, paths: List[str]) -> List[str]:
+    """
+    缺陷涉及的文件
+
+    优先使用缺陷的 file 字段 (允许相对路径前缀不同),再在描述文本中查找完整路径或唯一的文件名。
+
+    Args:
+        defect: 审查返回的缺陷 (字典或字符串)
+        paths: 当前代码块的路径列表
+
+    Returns:
+        涉及的文件路径 (取自 paths)
+    """
+    normalized = {normalize_path(p): p for p in paths}
+    found: List[str] = []
+
+    def add(path: str):
+        if path not in found:
+            found.append(path)
+
+    if isinstance(defect, dict):
+        text = ' '.join(str(v) for v in defect.values())
+        target = normalize_path(str(defect.get('file') or ''))
+        if target and target != '.':
+            for norm, path in normalized.items():
+                if norm == target or norm.endswith('/' + target) or target.endswith('/' + norm):
+                    add(path)
+    else:
+        text = str(defect)
+
+    basenames: Dict[str, List[str]] = {}
+    for norm, path in normalized.items():
+        basenames.setdefault(os.path.basename(norm), []).append(path)
+        if _mentions(text, norm):
+            add(path)
+    for name, owners in basenames.items():
+        if len(owners) == 1 and _mentions(text, name):
+            add(owners[0])
+    return found
+
+
+def _mentions(text: str, name: str) -> bool:
+    return re.search(r'(?<![\w.-])' + re.escape(name) + r'(?![\w-])', text) is not None
+
+
+def fix_targets(defects: List[Defect], code_blocks: List[Tuple[str, str]]) -> List[str]:
+    """
+    需要修复的文件
+
+    Returns:
+        涉及的文件路径;存在无法定位到文件的缺陷时返回全部文件 (需要完整上下文才能修复)
+    """
+    paths = [path for path, _ in code_blocks]
+    targets: List[str] = []
+    for defect in defects:
+        files = implicated_files(defect, paths)
+        if not files:
+            return paths
+        targets.extend(f for f in files if f not in targets)
+    return [path for path in paths if path in targets]
+
+
+def interface_summary(path: str, content: str) -> str:
+    """
+    文件的接口摘要 (供修复其他文件时参考)
+
+    Python 文件列出导入、常量、函数与类的签名及文档字符串首行;其他文件列出声明行。
+    """
+    if path.endswith('.py'):
+        try:
+            return _python_summary(ast.parse(content))
+        except SyntaxError:
+            pass
+    lines = [line.rstrip() for line in DECLARATION_PATTERN.findall(content)]
+    if len(lines) > MAX_SUMMARY_LINES:
+        lines = lines[:MAX_SUMMARY_LINES] + [f'... (共 {len(lines)} 处声明)']
+    return '\n'.join(lines) or f'(无可提取的声明,共 {content.count(chr(10)) + 1} 行)'
+
+
+def _python_summary(tree: ast.Module) -> str:
+    lines = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            lines.append(ast.unparse(node))
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            names = [t.id for t in targets if isinstance(t, ast.Name)]
+            if any(name.isupper() for name in names):
+                lines.append(ast.unparse(node)[:120])
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            lines.extend(_function_summary(node, ''))
+        elif isinstance(node, ast.ClassDef):
+            bases = ', '.join(ast.unparse(b) for b in node.bases)
+            lines.append(f'class {node.name}({bases}):' if bases else f'class {node.name}:')
+            lines.extend(_docstring_line(node, '    '))
+            for item in node.body:
+                if isinstance(item, (ast.FunctionDef, ast.AsyncFunctionDef)) and \
+                        (not item.name.startswith('_') or item.name == '__init__'):
+                    lines.extend(_function_summary(item, '    '))
+    if len(lines) > MAX_SUMMARY_LINES:
+        lines = lines[:MAX_SUMMARY_LINES] + ['...']
+    return '\n'.join(lines) or '(无公开接口)'
+
+
+def _function_summary(node: Union[ast.FunctionDef, ast.AsyncFunctionDef], indent: str) -> List[str]:
+    prefix = 'async def' if isinstance(node, ast.AsyncFunctionDef) else 'def'
+    returns = f' -> {ast.unparse(node.returns)}' if node.returns else ''
+    decorators = [f'{indent}@{ast.unparse(d)}' for d in node.decorator_list]
+    signature = f'{indent}{prefix} {node.name}({ast.unparse(node.args)}){returns}:'
+    docstring = _docstring_line(node, indent + '    ')
+    return decorators + ([signature] + docstring if docstring else [signature + ' ...'])
+
+
+def _docstring_line(node: ast.AST, indent: str) -> List[str]:
+    docstring = ast.get_docstring(node)
+    return [f'{indent}"""{docstring.strip().splitlines()[0]}"""'] if docstring and docstring.strip() else []
+
+
+def merge_fixed(code_blocks: List[Tuple[str, str]], fixed_blocks: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+    """
+    把修复后的文件合并回完整文件集
+
+    同一路径用修复后的内容替换 (保持原有顺序),模型新增的文件追加在最后。
+    """
+    fixed = {normalize_path(path): (path, content) for path, content in fixed_blocks}
+    merged = []
+    for path, content in code_blocks:
+        key = normalize_path(path)
+        merged.append((path, fixed.pop(key)[1]) if key in fixed else (path, content))
+    return merged + list(fixed.values())
@@ -0,0 +1,416 @@
+# job_queue.py
+# 持久化任务队列:基于 SQLite 的流水线任务队列 (状态、租约、重试、优先级、背压) 与消费它的 worker 池;
+# worker 崩溃后租约过期,任务由其他 worker 从运行目录中已保存的步骤结果续跑,而不是从头开始
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from runs import create_run_dir, output_root, read_run_info
+
+QUEUE_STATES = ('queued', 'running', 'done', 'failed')
+# 流水线运行结果中视为基础设施故障、值得重试的状态 (passed / failed 是审查结论,不重试)
+RETRYABLE_STATUSES = ('error', 'aborted')
+
+
+class QueueFullError(RuntimeError):
+    """排队中的任务已达上限 (背压),提交方应稍后重试"""
+
+
+def job_key(requirement: str, options: Dict) -> str:
+    """任务键: 需求与影响输出的配置 (相同的键在排队或运行中时不重复入队)"""
+    payload = json.dumps({'requirement': requirement, 'options': options}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+class JobQueue:
+    """
+    SQLite 持久化任务队列
+
+    状态: queued → running → done / failed。worker 认领任务时获得租约,运行期间定期续约;
+    租约过期 (worker 崩溃或失联) 的任务重新排队,由下一个 worker 在原运行目录中续跑。
+    运行出错 (error / aborted) 的任务按指数退避重试,超过最大尝试次数后记为 failed。
+    排队中的任务达到上限时提交方收到 QueueFullError (背压)。
+    存储使用 SQLite WAL 模式,多个进程可以同时提交与消费同一个队列文件。
+    """
+
+    def __init__(self, path: Optional[str] = None, max_pending: Optional[int] = None,
+                 lease_seconds: Optional[float] = None, max_attempts: Optional[int] = None,
+                 retry_delay: Optional[float] = None, root: Optional[str] = None):
+        """
+        Args:
+            path: SQLite 文件路径 (PIPELINE_QUEUE_DB, 默认为输出根目录下的 job_queue.sqlite3)
+            max_pending: 排队中的任务上限 (PIPELINE_QUEUE_MAX_PENDING, 默认 100)
+            lease_seconds: 租约时长 (PIPELINE_QUEUE_LEASE, 默认 120 秒,worker 每 1/3 租约时长续约一次)
+            max_attempts: 最大尝试次数 (PIPELINE_QUEUE_MAX_ATTEMPTS, 默认 3)
+            retry_delay: 重试退避基数 (PIPELINE_QUEUE_RETRY_DELAY, 默认 30 秒,第 n 次重试等待 基数 × 2^(n-1))
+            root: 输出根目录,任务的运行目录为 <输出根目录>/runs/<任务 ID>/
+        """
+        self.root = root
+        self.path = path or os.getenv('PIPELINE_QUEUE_DB') or os.path.join(output_root(root), 'job_queue.sqlite3')
+        self.max_pending = max_pending if max_pending is not None else \
+            int(os.getenv('PIPELINE_QUEUE_MAX_PENDING', '100'))
+        self.lease_seconds = lease_seconds or float(os.getenv('PIPELINE_QUEUE_LEASE', '120'))
+        self.max_attempts = max_attempts or int(os.getenv('PIPELINE_QUEUE_MAX_ATTEMPTS', '3'))
+        self.retry_delay = retry_delay if retry_delay is not None else \
+            float(os.getenv('PIPELINE_QUEUE_RETRY_DELAY', '30'))
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # journal_mode 不能在事务中切换
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+        finally:
+            conn.close()
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                ' id TEXT PRIMARY KEY,'
+                ' key TEXT NOT NULL,'
+                ' requirement TEXT NOT NULL,'
+                ' options TEXT NOT NULL,'
+                ' priority INTEGER NOT NULL DEFAULT 0,'
+                ' state TEXT NOT NULL,'
+                ' attempts INTEGER NOT NULL DEFAULT 0,'
+                ' max_attempts INTEGER NOT NULL,'
+                ' output_dir TEXT NOT NULL,'
+                ' lease_owner TEXT,'
+                ' lease_expires REAL,'
+                ' available_at REAL NOT NULL,'
+                ' outcome TEXT,'
+                ' error TEXT,'
+                ' created_at REAL NOT NULL,'
+                ' updated_at REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs(state, priority, created_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_key ON jobs(key, state)')
+
+    def submit(self, requirement: str, options: Optional[Dict] = None, priority: int = 0,
+               wait: float = 0) -> Dict:
+        """
+        提交任务
+
+        相同需求与配置的任务已在排队或运行中时直接返回该任务 (不重复入队)。
+
+        Args:
+            requirement: 需求描述
+            options: 运行参数 {max_iterations, stream, fanout}
+            priority: 优先级 (越大越先运行,同优先级按提交顺序)
+            wait: 队列已满时最多等待的秒数 (0 表示立即失败)
+
+        Returns:
+            任务记录 (带 created: 是否新建)
+
+        Raises:
+            QueueFullError: 等待后队列仍然已满
+        """
+        options = dict(options or {})
+        key = job_key(requirement, options)
+        deadline = time.time() + wait
+        while True:
+            with self._connect(immediate=True) as conn:
+                row = conn.execute("SELECT * FROM jobs WHERE key = ? AND state IN ('queued', 'running') "
+                                   'ORDER BY created_at LIMIT 1', (key,)).fetchone()
+                if row:
+                    return dict(self._record(row), created=False)
+                pending = conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+                if not self.max_pending or pending < self.max_pending:
+                    job_id, output_dir = create_run_dir(self.root)
+                    now = time.time()
+                    conn.execute(
+                        'INSERT INTO jobs (id, key, requirement, options, priority, state, max_attempts, output_dir,'
+                        ' available_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (job_id, key, requirement, json.dumps(options, ensure_ascii=False), priority, 'queued',
+                         self.max_attempts, output_dir, now, now, now)
+                    )
+                    return dict(self.get(job_id, conn), created=True)
+            if time.time() >= deadline:
+                raise QueueFullError(f'任务队列已满 ({pending}/{self.max_pending} 个任务排队中),请稍后重试')
+            time.sleep(min(1.0, max(0.0, deadline - time.time())))
+
+    def claim(self, worker: str) -> Optional[Dict]:
+        """
+        认领下一个可运行的任务 (优先级最高、最早提交),并先回收租约已过期的任务
+
+        Args:
+            worker: worker 标识 (租约持有者)
+
+        Returns:
+            任务记录,没有可运行的任务时返回 None
+        """
+        now = time.time()
+        with self._connect(immediate=True) as conn:
+            self._reclaim(conn, now)
+            row = conn.execute("SELECT id FROM jobs WHERE state = 'queued' AND available_at <= ? "
+                               'ORDER BY priority DESC, created_at ASC LIMIT 1', (now,)).fetchone()
+            if not row:
+                return None
+            conn.execute("UPDATE jobs SET state = 'running', attempts = attempts + 1, lease_owner = ?,"
+                         ' lease_expires = ?, updated_at = ? WHERE id = ?',
+                         (worker, now + self.lease_seconds, now, row[0]))
+            return self.get(row[0], conn)
+
+    def heartbeat(self, job_id: str, worker: str) -> bool:
+        """续约,租约已被回收 (不再由该 worker 持有) 时返回 False"""
+        now = time.time()
+        with self._connect() as conn:
+            updated = conn.execute("UPDATE jobs SET lease_expires = ?, updated_at = ? "
+                                   "WHERE id = ? AND lease_owner = ? AND state = 'running'",
+                                   (now + self.lease_seconds, now, job_id, worker)).rowcount
+        return bool(updated)
+
+    def complete(self, job_id: str, worker: str, outcome: Dict) -> str:
+        """
+        记录运行结果: 审查结论 (passed / failed) 记为 done;运行出错时按剩余尝试次数重试或记为 failed
+
+        Returns:
+            任务的新状态 (租约已不由该 worker 持有时结果被忽略,返回当前状态)
+        """
+        if outcome.get('status') in RETRYABLE_STATUSES:
+            return self.fail(job_id, worker, outcome.get('error') or outcome.get('status'), outcome)
+        now = time.time()
+        with self._connect(immediate=True) as conn:
+            updated = conn.execute("UPDATE jobs SET state = 'done', outcome = ?, error = NULL, lease_owner = NULL,"
+                                   " lease_expires = NULL, updated_at = ? WHERE id = ? AND lease_owner = ?"
+                                   " AND state = 'running'",
+                                   (json.dumps(outcome, ensure_ascii=False), now, job_id, worker)).rowcount
+            return 'done' if updated else self.get(job_id, conn)['state']
+
+    def fail(self, job_id: str, worker: str, error: str, outcome: Optional[Dict] = None) -> str:
+        """运行失败: 还有尝试次数时退避后重新排队,否则记为 failed;返回任务的新状态"""
+        now = time.time()
+        with self._connect(immediate=True) as conn:
+            job = self.get(job_id, conn)
+            if not job or job['lease_owner'] != worker or job['state'] != 'running':
+                return job['state'] if job else 'failed'
+            retry = job['attempts'] < job['max_attempts']
+            conn.execute('UPDATE jobs SET state = ?, available_at = ?, outcome = ?, error = ?, lease_owner = NULL,'
+                         ' lease_expires = NULL, updated_at = ? WHERE id = ?',
+                         ('queued' if retry else 'failed',
+                          now + self.retry_delay * 2 ** (job['attempts'] - 1) if retry else now,
+                          json.dumps(outcome, ensure_ascii=False) if outcome else None, error, now, job_id))
+            return 'queued' if retry else 'failed'
+
+    def get(self, job_id: str, conn: Optional[sqlite3.Connection] = None) -> Optional[Dict]:
+        """读取任务记录"""
+        if conn is None:
+            with self._connect() as conn:
+                return self.get(job_id, conn)
+        row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._record(row) if row else None
+
+    def list(self, state: Optional[str] = None, limit: int = 100) -> List[Dict]:
+        """任务列表 (最近提交的在前)"""
+        with self._connect() as conn:
+            if state:
+                rows = conn.execute('SELECT * FROM jobs WHERE state = ? ORDER BY created_at DESC LIMIT ?',
+                                    (state, limit)).fetchall()
+            else:
+                rows = conn.execute('SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?', (limit,)).fetchall()
+        return [self._record(row) for row in rows]
+
+    def stats(self) -> Dict[str, int]:
+        """各状态的任务数"""
+        with self._connect() as conn:
+            counts = dict(conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+        return {state: counts.get(state, 0) for state in QUEUE_STATES}
+
+    def _reclaim(self, conn: sqlite3.Connection, now: float):
+        """
+        租约过期的任务: 还有尝试次数时重新排队 (续跑),否则记为 failed
+
+        重新排队的任务再等待一个租约时长才能被认领:原 worker 若仍在运行,会在下一次续约 (每 1/3 租约时长)
+        时发现租约已被回收并中止,等执行中的阶段结束后再由其他 worker 在同一运行目录中续跑。
+        """
+        conn.execute("UPDATE jobs SET state = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,"
+                     " error = 'worker 租约过期 (崩溃或失联)', lease_owner = NULL, lease_expires = NULL,"
+                     " available_at = ?, updated_at = ? WHERE state = 'running' AND lease_expires < ?",
+                     (now + self.lease_seconds, now, now))
+
+    @staticmethod
+    def _record(row: sqlite3.Row) -> Dict:
+        record = dict(row)
+        record['options'] = json.loads(record['options'])
+        record['outcome'] = json.loads(record['outcome']) if record['outcome'] else None
+        return record
+
+    @contextmanager
+    def _connect(self, immediate: bool = False) -> Iterator[sqlite3.Connection]:
+        """
+        每次操作使用独立连接并在一个事务内完成
+
+        immediate 时事务开始即获取写锁,读取与更新之间不会被其他进程插入 (认领、提交时使用)。
+        """
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+
+
+def enqueue(jobs: List[Dict], queue: Optional[JobQueue] = None, priority: int = 0,
+            wait: Optional[float] = None) -> List[Dict]:
+    """
+    把需求提交到队列
+
+    Args:
+        jobs: 任务列表 (与 batch.load_jobs 的格式相同,可以带 priority 字段)
+        queue: 任务队列,为空时按环境变量创建
+        priority: 未指定 priority 的任务使用的优先级
+        wait: 队列已满时每个任务最多等待的秒数 (PIPELINE_QUEUE_SUBMIT_WAIT, 默认 0)
+
+    Raises:
+        QueueFullError: 等待后队列仍然已满 (之前的任务已入队)
+    """
+    queue = queue or JobQueue()
+    wait = wait if wait is not None else float(os.getenv('PIPELINE_QUEUE_SUBMIT_WAIT', '0'))
+    records = []
+    for job in jobs:
+        options = {'max_iterations': job.get('max_iterations', 2), 'stream': job.get('stream'),
+                   'fanout': job.get('fanout')}
+        record = queue.submit(job['requirement'], options, priority=job.get('priority', priority), wait=wait)
+        records.append(record)
+        if record['created']:
+            print(f'✓ 已入队: {record["id"]} (优先级 {record["priority"]}) {job["requirement"][:40]}')
+        else:
+            print(f'⚠️  相同的任务已在队列中 ({record["state"]}): {record["id"]}')
+    print(f'任务队列: {queue.stats()}')
+    return records
+
+
+def run_queued_job(queue: JobQueue, job: Dict, worker: str, client=None) -> str:
+    """
+    运行一个已认领的任务,运行期间定期续约
+
+    运行目录中已有 run.json (之前的尝试中断或出错) 时以续跑方式运行,复用已保存的步骤结果。
+    租约被回收时中止运行: 不再启动新的阶段,也不再写入运行目录。
+
+    Returns:
+        任务的新状态
+    """
+    from orchestrator import main
+
+    finished = threading.Event()
+    lost = threading.Event()
+
+    def keep_lease():
+        while not finished.wait(queue.lease_seconds / 3):
+            try:
+                renewed = queue.heartbeat(job['id'], worker)
+            except sqlite3.Error as e:
+                # 暂时无法访问队列文件 (如被锁定) 时下一次继续续约
+                print(f'⚠️  任务 {job["id"]} 续约失败,稍后重试: {str(e)}')
+                continue
+            if not renewed:
+                print(f'⚠️  任务 {job["id"]} 的租约已被回收,中止运行 (运行目录由其他 worker 接管)')
+                lost.set()
+                return
+
+    heartbeat = threading.Thread(target=keep_lease, name=f'lease-{job["id"]}', daemon=True)
+    heartbeat.start()
+    options = job['options']
+    resume = job['output_dir'] if read_run_info(job['output_dir']) else None
+    try:
+        outcome = main(None if resume else job['requirement'], options.get('max_iterations', 2),
+                       stream=options.get('stream'), fanout=options.get('fanout'),
+                       output_dir=None if resume else job['output_dir'], resume=resume, client=client, stop=lost)
+        return queue.complete(job['id'], worker, outcome)
+    except Exception as e:
+        return queue.fail(job['id'], worker, str(e))
+    finally:
+        finished.set()
+
+
+def run_workers(queue: Optional[JobQueue] = None, workers: Optional[int] = None,
+                max_in_flight: Optional[int] = None, poll_interval: Optional[float] = None,
+                stop: Optional[threading.Event] = None, drain: bool = False):
+    """
+    启动 worker 池消费队列 (阻塞,Ctrl+C 停止认领新任务并等待运行中的任务结束)
+
+    所有 worker 共用一个 LLM 客户端与限流器;max_in_flight 限制同时进行的 LLM 请求数。
+
+    Args:
+        queue: 任务队列,为空时按环境变量创建
+        workers: worker 数 (PIPELINE_QUEUE_WORKERS, 默认 2)
+        max_in_flight: 同时进行的 LLM 请求数上限 (PIPELINE_QUEUE_MAX_IN_FLIGHT)
+        poll_interval: 队列为空时的轮询间隔 (秒,PIPELINE_QUEUE_POLL, 默认 2)
+        stop: 停止信号
+        drain: 队列中没有排队中 (包括等待重试) 与运行中的任务时退出
+    """
+    from batch import configure_in_flight
+    from llm_client import LLMClient
+
+    queue = queue or JobQueue()
+    workers = max(1, workers or int(os.getenv('PIPELINE_QUEUE_WORKERS', '2')))
+    if max_in_flight is None and os.getenv('PIPELINE_QUEUE_MAX_IN_FLIGHT'):
+        max_in_flight = int(os.getenv('PIPELINE_QUEUE_MAX_IN_FLIGHT'))
+    poll_interval = poll_interval or float(os.getenv('PIPELINE_QUEUE_POLL', '2'))
+    stop = stop or threading.Event()
+
+    # 须在创建 LLM 客户端之前设置并发上限
+    configure_in_flight(max_in_flight)
+    client = LLMClient(provider=os.getenv('LLM_PROVIDER', 'openai'))
+    host = f'{socket.gethostname()}-{os.getpid()}'
+    busy = [False] * workers
+
+    print(f'✓ 任务队列 worker 已启动: {workers} 个 worker, 队列 {queue.path}'
+          + (f', LLM 并发请求上限 {max_in_flight}' if max_in_flight else ''))
+
+    def work(index: int):
+        worker = f'{host}-{index}'
+        while not stop.is_set():
+            job = queue.claim(worker)
+            if job is None:
+                stats = queue.stats()
+                if drain and not any(busy) and not stats['running'] and not stats['queued']:
+                    return
+                stop.wait(poll_interval)
+                continue
+            busy[index] = True
+            print(f'\n▶ [{worker}] 任务 {job["id"]} (第 {job["attempts"]} 次尝试, 优先级 {job["priority"]})')
+            try:
+                state = run_queued_job(queue, job, worker, client)
+            finally:
+                busy[index] = False
+            icon = '✓' if state == 'done' else ('↻' if state == 'queued' else '✗')
+            print(f'{icon} [{worker}] 任务 {job["id"]}: {state}')
+
+    threads = [threading.Thread(target=work, args=(i,), name=f'queue-worker-{i}', daemon=True)
+               for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(0.5)
+    except KeyboardInterrupt:
+        print('\n正在停止 worker,等待运行中的任务结束 (再次 Ctrl+C 立即退出,任务租约过期后由其他 worker 续跑)...')
+        stop.set()
+        for thread in threads:
+            thread.join()
+    print(f'任务队列: {queue.stats()}')
+
+
+if __name__ == '__main__':
+    # 查看队列状态: python orchestrator/job_queue.py [状态]
+    job_queue = JobQueue()
+    print(f'队列 {job_queue.path}: {job_queue.stats()}')
+    for item in job_queue.list(sys.argv[1] if len(sys.argv) > 1 else None, limit=20):
+        status = (item['outcome'] or {}).get('status', '')
+        print(f'{item["id"]}  {item["state"]:<8} 优先级 {item["priority"]:<3} 尝试 {item["attempts"]}/'
+              f'{item["max_attempts"]}  {status:<8} {item["requirement"][:40]}'
+              + (f'  ({item["error"]})' if item['error'] else ''))
@@ -0,0 +1,174 @@
+# llm_cache.py
+# LLM 响应缓存:基于内容哈希的本地 SQLite 存储,支持 LRU 容量淘汰与 TTL 过期
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'ai-pipeline', 'llm_cache.sqlite3')
+
+
+class LLMCache:
+    """
+    LLM 响应缓存
+
+    缓存键为请求内容 (提供商、base_url、模型、提示词、max_tokens、temperature 等)
+    的 SHA-256 哈希。存储使用 SQLite WAL 模式,多个进程可以同时读写同一个缓存文件。
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_bytes: Optional[int] = None,
+        ttl: Optional[float] = None
+    ):
+        """
+        初始化缓存
+
+        Args:
+            path: SQLite 文件路径 (LLM_CACHE_PATH, 默认 ~/.cache/ai-pipeline/llm_cache.sqlite3)
+            max_bytes: 缓存总大小上限,超出后按最近最少使用淘汰 (LLM_CACHE_MAX_MB, 默认 200MB)
+            ttl: 条目有效期秒数,0 表示永不过期 (LLM_CACHE_TTL, 默认 7 天)
+        """
+        self.path = path or os.getenv('LLM_CACHE_PATH', DEFAULT_CACHE_PATH)
+        self.max_bytes = max_bytes if max_bytes is not None else \
+            int(float(os.getenv('LLM_CACHE_MAX_MB', '200')) * 1024 * 1024)
+        self.ttl = ttl if ttl is not None else float(os.getenv('LLM_CACHE_TTL', str(7 * 24 * 3600)))
+
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS llm_cache ('
+                ' key TEXT PRIMARY KEY,'
+                ' response TEXT NOT NULL,'
+                ' size INTEGER NOT NULL,'
+                ' created_at REAL NOT NULL,'
+                ' last_access REAL NOT NULL,'
+                ' hits INTEGER NOT NULL DEFAULT 0)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache(last_access)')
+
+    @staticmethod
+    def make_key(provider: str, base_url: Optional[str], request: dict) -> str:
+        """
+        计算缓存键
+
+        Args:
+            provider: 提供商名称
+            base_url: API 端点 (默认端点为空)
+            request: 请求参数 (model / messages / max_tokens / temperature 等)
+
+        Returns:
+            SHA-256 十六进制摘要
+        """
+        payload = json.dumps(
+            {'provider': provider, 'base_url': base_url or '', 'request': request},
+            ensure_ascii=False, sort_keys=True
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        读取缓存,命中时刷新最近访问时间
+
+        Returns:
+            缓存的响应文本,未命中或已过期时返回 None
+        """
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT response, created_at FROM llm_cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row and self.ttl and now - row[1] > self.ttl:
+                conn.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+                row = None
+            if row:
+                conn.execute(
+                    'UPDATE llm_cache SET last_access = ?, hits = hits + 1 WHERE key = ?', (now, key)
+                )
+
+        self._count('hits' if row else 'misses')
+        return row[0] if row else None
+
+    def put(self, key: str, response: str):
+        """写入缓存,必要时淘汰最近最少使用的条目"""
+        if not response:
+            return
+        now = time.time()
+        size = len(response.encode('utf-8'))
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO llm_cache (key, response, size, created_at, last_access, hits) '
+                'VALUES (?, ?, ?, ?, ?, 0)',
+                (key, response, size, now, now)
+            )
+            evicted = self._evict(conn, now)
+
+        self._count('writes')
+        if evicted:
+            self._count('evictions', evicted)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        缓存统计
+
+        Returns:
+            hits / misses / hit_rate / writes / evictions (本实例) 以及 entries / bytes (整个缓存文件)
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        with self._connect() as conn:
+            entries, total = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache').fetchone()
+        stats['entries'] = entries
+        stats['bytes'] = total
+        return stats
+
+    def clear(self):
+        """清空缓存"""
+        with self._connect() as conn:
+            conn.execute('DELETE FROM llm_cache')
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        """每次操作使用独立连接并在一个事务内完成;timeout 用于等待其他进程释放写锁"""
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> int:
+        """删除过期条目,并按 last_access 淘汰直到总大小不超过上限"""
+        evicted = 0
+        if self.ttl:
+            evicted += conn.execute('DELETE FROM llm_cache WHERE created_at < ?', (now - self.ttl,)).rowcount
+
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM llm_cache').fetchone()[0]
+        if total <= self.max_bytes:
+            return evicted
+
+        excess = total - self.max_bytes
+        victims = []
+        for key, size in conn.execute('SELECT key, size FROM llm_cache ORDER BY last_access ASC'):
+            victims.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        conn.executemany('DELETE FROM llm_cache WHERE key = ?', victims)
+        return evicted + len(victims)
+
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self._stats[name] += amount
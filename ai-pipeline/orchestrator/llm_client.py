@@ -1,19 +1,76 @@
-# llm_client_v2.py
+# llm_client.py
 # LLM 客户端封装,支持 OpenAI、Anthropic Claude 和第三方 API
+import asyncio
+import copy
+import inspect
 import os
-import json
-from typing import Optional
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Callable, Iterator, List, Optional, Tuple
+
+from client_pool import ClientPool
+from continuation import (
+    AsyncTextStream,
+    LLMText,
+    StreamStitcher,
+    TextStream,
+    continuation_base,
+    continuation_request,
+    fit_continuation,
+    is_truncated,
+    trim_continuation
+)
+from llm_cache import LLMCache
+from rate_limiter import RateLimiter, error_status_and_headers, estimate_request_tokens
+from retry_policy import CircuitOpenError, LLMAPIError, RetryPolicy, is_retryable
+from router import Endpoint, EndpointRouter
+
+CODEX_SYSTEM_PROMPT = '你是一个专业的软件工程师和需求分析师。'
+CLAUDE_SYSTEM_PROMPT = '你是一个资深软件工程师,擅长编写高质量、可维护的代码。'
+CLAUDE_MODEL = 'claude-3-5-sonnet-20241022'
+OPENAI_DEFAULT_BASE = 'https://api.openai.com/v1'
+ANTHROPIC_DEFAULT_BASE = 'https://api.anthropic.com'
+
+
+async def _aparse(raw):
+    """解析异步原始响应 (不同 SDK 版本的 parse() 可能是协程,也可能直接返回结果)"""
+    parsed = raw.parse()
+    if inspect.isawaitable(parsed):
+        parsed = await parsed
+    return parsed
+
+
+class _CallSlot:
+    """限流上下文中的一次调用,用于回传响应头"""
+
+    def __init__(self):
+        self.headers = None
 
 
 class LLMClient:
-    """统一的 LLM 客户端接口,支持第三方 API"""
+    """
+    统一的 LLM 客户端接口,支持第三方 API
 
-    def __init__(self, provider: str = 'openai'):
+    同步方法 (call_*) 与异步方法 (acall_*) 共用同一套请求构建和响应解析逻辑,
+    区别仅在于使用同步还是异步 SDK 客户端。异步方法可以在同一个事件循环中
+    并发驱动多条流水线。
+    """
+
+    def __init__(self, provider: str = 'openai', pool: Optional[ClientPool] = None,
+                 cache: Optional[LLMCache] = None, rate_limiter: Optional[RateLimiter] = None,
+                 retry_policy: Optional[RetryPolicy] = None, router: Optional[EndpointRouter] = None):
         """
         初始化 LLM 客户端
 
         Args:
             provider: LLM 提供商 ('openai' 或 'anthropic')
+            pool: SDK 客户端池,为空时使用进程内共享池
+                  (LLM_SHARE_CLIENTS=false 时为本实例单独创建)
+            cache: 响应缓存,为空且 LLM_CACHE=true 时自动创建
+            rate_limiter: 限流调度器,为空时使用按环境变量创建的进程内共享实例 (未配置则不限流)
+            retry_policy: 重试 / 熔断 / 对冲策略,为空时使用进程内共享实例
+            router: OpenAI 兼容端点路由器,为空时使用 LLM_ENDPOINTS 创建的进程内共享实例
+                    (未配置则只使用 OPENAI_API_BASE)
         """
         self.provider = provider.lower()
         self.openai_key = os.getenv('OPENAI_API_KEY')
@@ -22,11 +79,41 @@ class LLMClient:
         # 支持第三方 API 和自定义配置
         self.openai_base_url = os.getenv('OPENAI_API_BASE')  # 第三方 API 端点
         self.openai_model = os.getenv('OPENAI_MODEL', 'gpt-4-turbo-preview')  # 自定义模型
+        self.claude_model = CLAUDE_MODEL
+        self.temperature = 0.7
+
+        # 输出因 max_tokens 截断时的最大自动续写次数 (0 表示不续写)
+        self.max_continuations = int(os.getenv('LLM_MAX_CONTINUATIONS', '3'))
 
         # 调试模式
         self.debug = os.getenv('DEBUG', 'false').lower() == 'true'
 
-        if self.provider == 'openai' and not self.openai_key:
+        # 长连接客户端池,多次调用 / 多条流水线之间复用连接
+        self._owns_pool = pool is None and os.getenv('LLM_SHARE_CLIENTS', 'true').lower() != 'true'
+        if pool is not None:
+            self.pool = pool
+        elif self._owns_pool:
+            self.pool = ClientPool()
+        else:
+            self.pool = ClientPool.shared()
+
+        # 响应缓存 (可选):相同请求直接返回缓存结果,不发起网络调用
+        if cache is None and os.getenv('LLM_CACHE', 'false').lower() == 'true':
+            cache = LLMCache()
+        self.cache = cache
+        # 跳过缓存读取 (仍会写入最新结果)
+        self.cache_bypass = os.getenv('LLM_CACHE_BYPASS', 'false').lower() == 'true'
+
+        # 限流 (可选):同一进程内所有 LLMClient 共享按端点 + 模型划分的配额
+        self.rate_limiter = rate_limiter or RateLimiter.shared()
+
+        # 重试策略:熔断状态与延迟统计在同一进程的所有 LLMClient 之间共享
+        self.retry_policy = retry_policy or RetryPolicy.shared()
+
+        # 多端点路由 (可选):在多个 OpenAI 兼容网关之间按延迟 / 错误率选择并自动故障转移
+        self.router = router or EndpointRouter.shared()
+
+        if self.provider == 'openai' and not self.openai_key and self.router is None:
             raise ValueError('需要设置 OPENAI_API_KEY 环境变量')
         if self.provider == 'anthropic' and not self.claude_key:
             raise ValueError('需要设置 CLAUDE_API_KEY 环境变量')
@@ -47,39 +134,8 @@ class LLMClient:
         Returns:
             模型生成的文本
         """
-        if self.provider == 'openai':
-            try:
-                import openai
-
-                # 创建客户端,支持自定义 base_url
-                client_kwargs = {'api_key': self.openai_key}
-                if self.openai_base_url:
-                    client_kwargs['base_url'] = self.openai_base_url
-                    if self.debug:
-                        print(f'[DEBUG] 使用第三方 API: {self.openai_base_url}')
-
-                client = openai.OpenAI(**client_kwargs)
-
-                response = client.chat.completions.create(
-                    model=self.openai_model,
-                    messages=[
-                        {"role": "system", "content": "你是一个专业的软件工程师和需求分析师。"},
-                        {"role": "user", "content": prompt}
-                    ],
-                    max_tokens=max_tokens,
-                    temperature=0.7,
-                )
-                # 兼容不同响应格式
-                if isinstance(response, str):
-                    return response
-                elif hasattr(response, 'choices'):
-                    return response.choices[0].message.content
-                else:
-                    return str(response)
-            except Exception as e:
-                raise RuntimeError(f'OpenAI API 调用失败: {str(e)}')
-        else:
-            raise NotImplementedError(f'Provider {self.provider} 不支持 Codex 调用')
+        self._check_codex_provider()
+        return self._call_openai_chat(CODEX_SYSTEM_PROMPT, prompt, max_tokens)
 
     def call_claude(self, prompt: str, max_tokens: int = 4000) -> str:
         """
@@ -93,75 +149,857 @@ class LLMClient:
             模型生成的文本
         """
         if self.provider == 'anthropic':
-            try:
-                import anthropic
-                client = anthropic.Anthropic(api_key=self.claude_key)
-
-                response = client.messages.create(
-                    model='claude-3-5-sonnet-20241022',
-                    max_tokens=max_tokens,
-                    messages=[
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.7,
-                )
-                return response.content[0].text
-            except Exception as e:
-                raise RuntimeError(f'Claude API 调用失败: {str(e)}')
+            return self._call_anthropic(prompt, max_tokens)
         elif self.provider == 'openai':
             # 使用 OpenAI 作为 Claude 的替代
-            try:
-                import openai
-
-                # 创建客户端,支持自定义 base_url
-                client_kwargs = {'api_key': self.openai_key}
-                if self.openai_base_url:
-                    client_kwargs['base_url'] = self.openai_base_url
-
-                client = openai.OpenAI(**client_kwargs)
-
-                response = client.chat.completions.create(
-                    model=self.openai_model,
-                    messages=[
-                        {"role": "system", "content": "你是一个资深软件工程师,擅长编写高质量、可维护的代码。"},
-                        {"role": "user", "content": prompt}
-                    ],
-                    max_tokens=max_tokens,
-                    temperature=0.7,
-                )
-                # 兼容不同响应格式
-                if isinstance(response, str):
-                    return response
-                elif hasattr(response, 'choices'):
-                    return response.choices[0].message.content
-                else:
-                    return str(response)
-            except Exception as e:
-                raise RuntimeError(f'OpenAI API 调用失败: {str(e)}')
+            return self._call_openai_chat(CLAUDE_SYSTEM_PROMPT, prompt, max_tokens)
+        else:
+            raise NotImplementedError(f'Provider {self.provider} 不支持 Claude 调用')
+
+    async def acall_codex(self, prompt: str, max_tokens: int = 1500) -> str:
+        """
+        异步调用 Codex 模型,参数与返回值同 call_codex
+        """
+        self._check_codex_provider()
+        return await self._acall_openai_chat(CODEX_SYSTEM_PROMPT, prompt, max_tokens)
+
+    async def acall_claude(self, prompt: str, max_tokens: int = 4000) -> str:
+        """
+        异步调用 Claude 模型,参数与返回值同 call_claude
+        """
+        if self.provider == 'anthropic':
+            return await self._acall_anthropic(prompt, max_tokens)
+        elif self.provider == 'openai':
+            return await self._acall_openai_chat(CLAUDE_SYSTEM_PROMPT, prompt, max_tokens)
+        else:
+            raise NotImplementedError(f'Provider {self.provider} 不支持 Claude 调用')
+
+    def stream_codex(self, prompt: str, max_tokens: int = 1500) -> TextStream:
+        """
+        流式调用 Codex 模型,逐段产出生成的文本
+
+        Args:
+            prompt: 输入提示词
+            max_tokens: 最大生成 token 数
+
+        Returns:
+            TextStream,逐段产出增量文本;迭代结束后可读取 finish_reason / continuations
+        """
+        self._check_codex_provider()
+        return TextStream(lambda info: self._stream_openai_chat(CODEX_SYSTEM_PROMPT, prompt, max_tokens, info))
+
+    def stream_claude(self, prompt: str, max_tokens: int = 4000) -> TextStream:
+        """
+        流式调用 Claude 模型,逐段产出生成的文本
+
+        Args:
+            prompt: 输入提示词
+            max_tokens: 最大生成 token 数
+
+        Returns:
+            TextStream,逐段产出增量文本;迭代结束后可读取 finish_reason / continuations
+        """
+        if self.provider == 'anthropic':
+            return TextStream(lambda info: self._stream_anthropic(prompt, max_tokens, info))
+        elif self.provider == 'openai':
+            return TextStream(lambda info: self._stream_openai_chat(CLAUDE_SYSTEM_PROMPT, prompt, max_tokens, info))
+        else:
+            raise NotImplementedError(f'Provider {self.provider} 不支持 Claude 调用')
+
+    def astream_codex(self, prompt: str, max_tokens: int = 1500) -> AsyncTextStream:
+        """stream_codex 的异步版本"""
+        self._check_codex_provider()
+        return AsyncTextStream(lambda info: self._astream_openai_chat(CODEX_SYSTEM_PROMPT, prompt, max_tokens, info))
+
+    def astream_claude(self, prompt: str, max_tokens: int = 4000) -> AsyncTextStream:
+        """stream_claude 的异步版本"""
+        if self.provider == 'anthropic':
+            return AsyncTextStream(lambda info: self._astream_anthropic(prompt, max_tokens, info))
+        elif self.provider == 'openai':
+            return AsyncTextStream(
+                lambda info: self._astream_openai_chat(CLAUDE_SYSTEM_PROMPT, prompt, max_tokens, info)
+            )
         else:
             raise NotImplementedError(f'Provider {self.provider} 不支持 Claude 调用')
 
-    def call_with_retry(self, func, *args, max_retries: int = 3, **kwargs) -> str:
+    def models(self, kind: str) -> List[str]:
+        """
+        某类调用可能使用的模型,用于估算上下文窗口
+
+        Args:
+            kind: 'codex' 或 'claude'
+
+        Returns:
+            模型名列表 (多端点路由时为全部端点的模型)
+        """
+        if kind == 'claude' and self.provider == 'anthropic':
+            return [self.claude_model]
+        if self.router is not None:
+            return [e.model for e in self.router.endpoints]
+        return [self.openai_model]
+
+    def variant(self, temperature: Optional[float] = None, model: Optional[str] = None) -> 'LLMClient':
+        """
+        使用不同温度或模型的客户端副本 (用于并行生成多个候选)
+
+        副本与本实例共用客户端池、缓存、限流器、重试策略与端点路由;
+        多端点路由时模型由各端点决定,model 参数不生效。
+        """
+        clone = copy.copy(self)
+        clone._owns_pool = False
+        if temperature is not None:
+            clone.temperature = temperature
+        if model:
+            clone.openai_model = model
+            clone.claude_model = model
+        return clone
+
+    def _check_codex_provider(self):
+        """Codex 调用仅支持 OpenAI 兼容接口"""
+        if self.provider != 'openai':
+            raise NotImplementedError(f'Provider {self.provider} 不支持 Codex 调用')
+        if self.debug and self.openai_base_url:
+            print(f'[DEBUG] 使用第三方 API: {self.openai_base_url}')
+
+    def _openai_request(self, system_prompt: str, prompt: str, max_tokens: int) -> dict:
+        """构建 OpenAI chat completion 请求参数"""
+        return {
+            'model': self.openai_model,
+            'messages': [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt}
+            ],
+            'max_tokens': max_tokens,
+            'temperature': self.temperature,
+        }
+
+    def _anthropic_request(self, prompt: str, max_tokens: int) -> dict:
+        """构建 Anthropic messages 请求参数"""
+        return {
+            'model': self.claude_model,
+            'max_tokens': max_tokens,
+            'messages': [
+                {"role": "user", "content": prompt}
+            ],
+            'temperature': self.temperature,
+        }
+
+    @staticmethod
+    def _openai_text(response) -> str:
+        """从 OpenAI 响应中提取文本,兼容不同响应格式"""
+        if isinstance(response, str):
+            return response
+        elif hasattr(response, 'choices'):
+            return response.choices[0].message.content
+        else:
+            return str(response)
+
+    @staticmethod
+    def _openai_finish(response) -> Optional[str]:
+        """从 OpenAI 响应或流式分片中提取 finish_reason"""
+        choices = getattr(response, 'choices', None)
+        return getattr(choices[0], 'finish_reason', None) if choices else None
+
+    @staticmethod
+    def _openai_delta(chunk) -> str:
+        """从 OpenAI 流式分片中提取增量文本"""
+        if not getattr(chunk, 'choices', None):
+            return ''
+        return chunk.choices[0].delta.content or ''
+
+    def _call_openai_chat(self, system_prompt: str, prompt: str, max_tokens: int) -> str:
+        """
+        通过池化的 OpenAI 客户端发起 chat completion 调用
+
+        Args:
+            system_prompt: 系统提示词
+            prompt: 用户提示词
+            max_tokens: 最大生成 token 数
+
+        Returns:
+            模型生成的文本 (LLMText,输出被截断时已自动续写)
+        """
+        request = self._openai_request(system_prompt, prompt, max_tokens)
+        cache_key = self._cache_key('openai', request)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            return cached
+
+        text = self._complete('openai', request, self._send_openai_chat)
+        self._cache_put(cache_key, text)
+        return text
+
+    async def _acall_openai_chat(self, system_prompt: str, prompt: str, max_tokens: int) -> str:
+        """_call_openai_chat 的异步版本"""
+        request = self._openai_request(system_prompt, prompt, max_tokens)
+        cache_key = self._cache_key('openai', request)
+        cached = await self._acache_get(cache_key)
+        if cached is not None:
+            return cached
+
+        text = await self._acomplete('openai', request, self._asend_openai_chat)
+        await self._acache_put(cache_key, text)
+        return text
+
+    def _call_anthropic(self, prompt: str, max_tokens: int) -> str:
+        """通过池化的 Anthropic 客户端发起调用"""
+        request = self._anthropic_request(prompt, max_tokens)
+        cache_key = self._cache_key('anthropic', request)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            return cached
+
+        text = self._complete('anthropic', request, self._send_anthropic)
+        self._cache_put(cache_key, text)
+        return text
+
+    async def _acall_anthropic(self, prompt: str, max_tokens: int) -> str:
+        """_call_anthropic 的异步版本"""
+        request = self._anthropic_request(prompt, max_tokens)
+        cache_key = self._cache_key('anthropic', request)
+        cached = await self._acache_get(cache_key)
+        if cached is not None:
+            return cached
+
+        text = await self._acomplete('anthropic', request, self._asend_anthropic)
+        await self._acache_put(cache_key, text)
+        return text
+
+    def _stream_openai_chat(self, system_prompt: str, prompt: str, max_tokens: int,
+                            info: TextStream) -> Iterator[str]:
+        """通过池化的 OpenAI 客户端发起流式 chat completion 调用 (缓存命中时一次性产出)"""
+        request = self._openai_request(system_prompt, prompt, max_tokens)
+        cache_key = self._cache_key('openai', request)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+        yield from self._stream_complete('openai', request, self._send_openai_stream, info, cache_key)
+
+    async def _astream_openai_chat(self, system_prompt: str, prompt: str, max_tokens: int,
+                                   info: AsyncTextStream) -> AsyncIterator[str]:
+        """_stream_openai_chat 的异步版本"""
+        request = self._openai_request(system_prompt, prompt, max_tokens)
+        cache_key = self._cache_key('openai', request)
+        cached = await self._acache_get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+        async for text in self._astream_complete('openai', request, self._asend_openai_stream, info, cache_key):
+            yield text
+
+    def _stream_anthropic(self, prompt: str, max_tokens: int, info: TextStream) -> Iterator[str]:
+        """通过池化的 Anthropic 客户端发起流式调用 (缓存命中时一次性产出)"""
+        request = self._anthropic_request(prompt, max_tokens)
+        cache_key = self._cache_key('anthropic', request)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+        yield from self._stream_complete('anthropic', request, self._send_anthropic_stream, info, cache_key)
+
+    async def _astream_anthropic(self, prompt: str, max_tokens: int, info: AsyncTextStream) -> AsyncIterator[str]:
+        """_stream_anthropic 的异步版本"""
+        request = self._anthropic_request(prompt, max_tokens)
+        cache_key = self._cache_key('anthropic', request)
+        cached = await self._acache_get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+        async for text in self._astream_complete('anthropic', request, self._asend_anthropic_stream, info, cache_key):
+            yield text
+
+    def _complete(self, provider: str, request: dict,
+                  send: Callable[[dict], Tuple[str, Optional[str]]]) -> LLMText:
+        """
+        发起调用,输出因 max_tokens 截断时自动发起续写请求并拼接
+
+        每次续写按上下文窗口剩余空间重新确定 max_tokens (空间不足时停止续写);
+        续写失败时返回已拼接的截断输出 (finish_reason 仍为截断),不丢弃已收到的内容。
+
+        Args:
+            provider: 'openai' 或 'anthropic' (决定续写请求的构建方式)
+            request: 原始请求参数
+            send: 发起单次请求的函数,返回 (文本, 结束原因)
+
+        Returns:
+            LLMText,附带最终结束原因与续写次数
+        """
+        text, finish_reason = send(request)
+        continuations, prompt_tokens, error = 0, 0, None
+        while is_truncated(finish_reason) and continuations < self.max_continuations:
+            current, tokens = self._next_continuation(provider, request, text)
+            if current is None:
+                break
+            continuations += 1
+            prompt_tokens += tokens
+            self._log_continuation(continuations, text)
+            try:
+                more, more_reason = send(current)
+            except Exception as e:
+                error = self._continuation_failed(continuations, e)
+                break
+            finish_reason = more_reason
+            base = continuation_base(provider, text)
+            text = base + trim_continuation(provider, base, more)
+        self._warn_truncated(finish_reason, continuations)
+        return LLMText(text, finish_reason, continuations, prompt_tokens, error)
+
+    async def _acomplete(self, provider: str, request: dict, send) -> LLMText:
+        """_complete 的异步版本"""
+        text, finish_reason = await send(request)
+        continuations, prompt_tokens, error = 0, 0, None
+        while is_truncated(finish_reason) and continuations < self.max_continuations:
+            current, tokens = self._next_continuation(provider, request, text)
+            if current is None:
+                break
+            continuations += 1
+            prompt_tokens += tokens
+            self._log_continuation(continuations, text)
+            try:
+                more, more_reason = await send(current)
+            except Exception as e:
+                error = self._continuation_failed(continuations, e)
+                break
+            finish_reason = more_reason
+            base = continuation_base(provider, text)
+            text = base + trim_continuation(provider, base, more)
+        self._warn_truncated(finish_reason, continuations)
+        return LLMText(text, finish_reason, continuations, prompt_tokens, error)
+
+    def _stream_complete(self, provider: str, request: dict, send, info: TextStream,
+                         cache_key: Optional[str]) -> Iterator[str]:
+        """流式版本的自动续写:续写内容接着原来的流继续产出,结束后写入缓存"""
+        text = ''
+        current = request
+        while True:
+            meta = {}
+            stitcher = StreamStitcher(provider, text, continuation=current is not request)
+            try:
+                for piece in send(current, meta):
+                    out = stitcher.feed(piece)
+                    if out:
+                        yield out
+            except Exception as e:
+                if current is request:
+                    raise
+                # 续写失败时保留已接收的部分,以截断的输出结束 (finish_reason 仍为截断)
+                info.continuation_error = self._continuation_failed(info.continuations, e)
+                out = stitcher.flush()
+                if out:
+                    yield out
+                text = stitcher.text
+                break
+            out = stitcher.flush()
+            if out:
+                yield out
+            text = stitcher.text
+            info.finish_reason = meta.get('finish_reason')
+            if not is_truncated(info.finish_reason) or info.continuations >= self.max_continuations:
+                break
+            current, tokens = self._next_continuation(provider, request, text)
+            if current is None:
+                break
+            info.continuations += 1
+            info.continuation_prompt_tokens += tokens
+            self._log_continuation(info.continuations, text)
+
+        self._warn_truncated(info.finish_reason, info.continuations)
+        if not info.continuation_error:
+            self._cache_put(cache_key, text)
+
+    async def _astream_complete(self, provider: str, request: dict, send, info: AsyncTextStream,
+                                cache_key: Optional[str]) -> AsyncIterator[str]:
+        """_stream_complete 的异步版本"""
+        text = ''
+        current = request
+        while True:
+            meta = {}
+            stitcher = StreamStitcher(provider, text, continuation=current is not request)
+            try:
+                async for piece in send(current, meta):
+                    out = stitcher.feed(piece)
+                    if out:
+                        yield out
+            except Exception as e:
+                if current is request:
+                    raise
+                # 续写失败时保留已接收的部分,以截断的输出结束 (finish_reason 仍为截断)
+                info.continuation_error = self._continuation_failed(info.continuations, e)
+                out = stitcher.flush()
+                if out:
+                    yield out
+                text = stitcher.text
+                break
+            out = stitcher.flush()
+            if out:
+                yield out
+            text = stitcher.text
+            info.finish_reason = meta.get('finish_reason')
+            if not is_truncated(info.finish_reason) or info.continuations >= self.max_continuations:
+                break
+            current, tokens = self._next_continuation(provider, request, text)
+            if current is None:
+                break
+            info.continuations += 1
+            info.continuation_prompt_tokens += tokens
+            self._log_continuation(info.continuations, text)
+
+        self._warn_truncated(info.finish_reason, info.continuations)
+        if not info.continuation_error:
+            await self._acache_put(cache_key, text)
+
+    def _next_continuation(self, provider: str, request: dict, text: str) -> Tuple[Optional[dict], int]:
+        """
+        构建续写请求,并按上下文窗口剩余空间重新确定 max_tokens
+
+        Returns:
+            (续写请求, 提示词 token 数);剩余空间不足时请求为 None (停止续写)
+        """
+        models = [self.claude_model] if provider == 'anthropic' else self.models('codex')
+        current, prompt_tokens = fit_continuation(continuation_request(provider, request, text), models)
+        if current is None:
+            print(f'⚠️  续写请求约 {prompt_tokens} tokens,上下文窗口剩余空间不足,停止续写')
+        return current, prompt_tokens
+
+    @staticmethod
+    def _continuation_failed(count: int, error: Exception) -> str:
+        print(f'⚠️  第 {count} 次续写失败,返回截断的输出: {str(error)}')
+        return str(error)
+
+    @staticmethod
+    def _log_continuation(count: int, text: str):
+        print(f'⚠️  输出达到 max_tokens 上限 (已输出 {len(text)} 字符),发起第 {count} 次续写')
+
+    def _warn_truncated(self, finish_reason: Optional[str], continuations: int):
+        if is_truncated(finish_reason):
+            print(f'⚠️  已续写 {continuations} 次,输出仍不完整 (续写上限 LLM_MAX_CONTINUATIONS={self.max_continuations})')
+
+    def _send_openai_chat(self, request: dict) -> Tuple[str, Optional[str]]:
+        """
+        发起单次 chat completion 请求 (多端点时按路由顺序故障转移)
+
+        Returns:
+            (文本, finish_reason)
+        """
+        routes = self._routes()
+        for index, endpoint in enumerate(routes):
+            routed = dict(request, model=endpoint.model)
+            started = time.monotonic()
+            try:
+                client = self.pool.get_openai(endpoint.api_key, endpoint.base_url)
+                with self._guarded('openai', routed, endpoint.base_url) as slot:
+                    raw = client.chat.completions.with_raw_response.create(**routed)
+                    slot.headers = raw.headers
+                response = raw.parse()
+            except Exception as e:
+                error = LLMAPIError.wrap('OpenAI API 调用失败', e)
+                self._route_done(endpoint, started, error)
+                if index == len(routes) - 1:
+                    raise error from e
+                self._log_failover(endpoint, routes[index + 1], error)
+                continue
+
+            self._route_done(endpoint, started)
+            return self._openai_text(response), self._openai_finish(response)
+
+    async def _asend_openai_chat(self, request: dict) -> Tuple[str, Optional[str]]:
+        """_send_openai_chat 的异步版本"""
+        routes = self._routes()
+        for index, endpoint in enumerate(routes):
+            routed = dict(request, model=endpoint.model)
+            started = time.monotonic()
+            try:
+                client = self.pool.get_async_openai(endpoint.api_key, endpoint.base_url)
+                async with self._aguarded('openai', routed, endpoint.base_url) as slot:
+                    raw = await client.chat.completions.with_raw_response.create(**routed)
+                    slot.headers = raw.headers
+                response = await _aparse(raw)
+            except Exception as e:
+                error = LLMAPIError.wrap('OpenAI API 调用失败', e)
+                self._route_done(endpoint, started, error)
+                if index == len(routes) - 1:
+                    raise error from e
+                self._log_failover(endpoint, routes[index + 1], error)
+                continue
+
+            self._route_done(endpoint, started)
+            return self._openai_text(response), self._openai_finish(response)
+
+    def _send_anthropic(self, request: dict) -> Tuple[str, Optional[str]]:
+        """发起单次 Anthropic messages 请求,返回 (文本, stop_reason)"""
+        try:
+            client = self.pool.get_anthropic(self.claude_key)
+            with self._guarded('anthropic', request) as slot:
+                raw = client.messages.with_raw_response.create(**request)
+                slot.headers = raw.headers
+            message = raw.parse()
+        except Exception as e:
+            raise LLMAPIError.wrap('Claude API 调用失败', e) from e
+        return message.content[0].text, message.stop_reason
+
+    async def _asend_anthropic(self, request: dict) -> Tuple[str, Optional[str]]:
+        """_send_anthropic 的异步版本"""
+        try:
+            client = self.pool.get_async_anthropic(self.claude_key)
+            async with self._aguarded('anthropic', request) as slot:
+                raw = await client.messages.with_raw_response.create(**request)
+                slot.headers = raw.headers
+            message = await _aparse(raw)
+        except Exception as e:
+            raise LLMAPIError.wrap('Claude API 调用失败', e) from e
+        return message.content[0].text, message.stop_reason
+
+    def _send_openai_stream(self, request: dict, meta: dict) -> Iterator[str]:
+        """
+        发起单次流式 chat completion 请求,finish_reason 写入 meta
+
+        已经产出部分文本后无法切换端点,故障转移只发生在首个分片之前
+        """
+        emitted = False
+        routes = self._routes()
+        for index, endpoint in enumerate(routes):
+            routed = dict(request, model=endpoint.model)
+            started = time.monotonic()
+            try:
+                client = self.pool.get_openai(endpoint.api_key, endpoint.base_url)
+                with self._guarded('openai', routed, endpoint.base_url) as slot:
+                    raw = client.chat.completions.with_raw_response.create(stream=True, **routed)
+                    slot.headers = raw.headers
+                    for chunk in raw.parse():
+                        meta['finish_reason'] = self._openai_finish(chunk) or meta.get('finish_reason')
+                        text = self._openai_delta(chunk)
+                        if text:
+                            emitted = True
+                            yield text
+            except Exception as e:
+                error = LLMAPIError.wrap('OpenAI API 调用失败', e)
+                self._route_done(endpoint, started, error)
+                if emitted or index == len(routes) - 1:
+                    raise error from e
+                self._log_failover(endpoint, routes[index + 1], error)
+                continue
+
+            self._route_done(endpoint, started)
+            return
+
+    async def _asend_openai_stream(self, request: dict, meta: dict) -> AsyncIterator[str]:
+        """_send_openai_stream 的异步版本"""
+        emitted = False
+        routes = self._routes()
+        for index, endpoint in enumerate(routes):
+            routed = dict(request, model=endpoint.model)
+            started = time.monotonic()
+            try:
+                client = self.pool.get_async_openai(endpoint.api_key, endpoint.base_url)
+                async with self._aguarded('openai', routed, endpoint.base_url) as slot:
+                    raw = await client.chat.completions.with_raw_response.create(stream=True, **routed)
+                    slot.headers = raw.headers
+                    async for chunk in await _aparse(raw):
+                        meta['finish_reason'] = self._openai_finish(chunk) or meta.get('finish_reason')
+                        text = self._openai_delta(chunk)
+                        if text:
+                            emitted = True
+                            yield text
+            except Exception as e:
+                error = LLMAPIError.wrap('OpenAI API 调用失败', e)
+                self._route_done(endpoint, started, error)
+                if emitted or index == len(routes) - 1:
+                    raise error from e
+                self._log_failover(endpoint, routes[index + 1], error)
+                continue
+
+            self._route_done(endpoint, started)
+            return
+
+    def _send_anthropic_stream(self, request: dict, meta: dict) -> Iterator[str]:
+        """发起单次 Anthropic 流式请求,stop_reason 写入 meta"""
+        try:
+            client = self.pool.get_anthropic(self.claude_key)
+            with self._guarded('anthropic', request), client.messages.stream(**request) as stream:
+                for text in stream.text_stream:
+                    yield text
+                meta['finish_reason'] = stream.get_final_message().stop_reason
+        except Exception as e:
+            raise LLMAPIError.wrap('Claude API 调用失败', e) from e
+
+    async def _asend_anthropic_stream(self, request: dict, meta: dict) -> AsyncIterator[str]:
+        """_send_anthropic_stream 的异步版本"""
+        try:
+            client = self.pool.get_async_anthropic(self.claude_key)
+            async with self._aguarded('anthropic', request), client.messages.stream(**request) as stream:
+                async for text in stream.text_stream:
+                    yield text
+                meta['finish_reason'] = (await stream.get_final_message()).stop_reason
+        except Exception as e:
+            raise LLMAPIError.wrap('Claude API 调用失败', e) from e
+
+    def _endpoint(self, provider: str, base_url: Optional[str] = None) -> str:
+        """限流与熔断使用的端点标识"""
+        if provider == 'openai':
+            return base_url or self.openai_base_url or OPENAI_DEFAULT_BASE
+        return os.getenv('ANTHROPIC_BASE_URL') or ANTHROPIC_DEFAULT_BASE
+
+    def _routes(self) -> List[Endpoint]:
+        """
+        OpenAI 兼容调用的端点尝试顺序
+
+        配置了多端点路由时由路由器按延迟 / 错误率排序 (熔断中的端点排在最后),
+        否则只有 OPENAI_API_BASE + OPENAI_MODEL 一个端点。
+        """
+        if self.router is None:
+            return [Endpoint(self.openai_base_url, self.openai_model, self.openai_key)]
+        return self.router.ranked(
+            lambda e: self.retry_policy.breaker(self._endpoint('openai', e.base_url)).available()
+        )
+
+    def _route_done(self, endpoint: Endpoint, started: float, error: Optional[BaseException] = None):
+        """把调用结果计入路由统计 (熔断拒绝的请求没有真正发出,不计入)"""
+        if self.router is None or isinstance(error, CircuitOpenError):
+            return
+        self.router.record(endpoint, time.monotonic() - started, error is None)
+
+    def _log_failover(self, failed: Endpoint, following: Endpoint, error: BaseException):
+        print(f'⚠️  端点 {failed.name} 调用失败,切换到 {following.name}: {str(error)}')
+
+    def _breaker_failed(self, breaker, error: BaseException):
+        """可重试的错误 (5xx、超时、连接错误) 计入熔断;429 由限流器处理,客户端错误说明端点正常"""
+        status, _ = error_status_and_headers(error)
+        if status == 429 or not is_retryable(error):
+            # 端点有响应: 半开状态下的探测也算成功,否则熔断会一直停在半开
+            breaker.record_success()
+            return
+        breaker.record_failure()
+
+    @contextmanager
+    def _guarded(self, provider: str, request: dict, base_url: Optional[str] = None) -> Iterator[_CallSlot]:
+        """
+        在熔断检查和限流许可内执行一次调用
+
+        端点熔断时直接抛出 CircuitOpenError;异常时把状态码和响应头交给限流器,
+        并按错误类型更新熔断状态。半开状态下的探测名额在任何退出路径上都会释放。
+        """
+        slot = _CallSlot()
+        endpoint = self._endpoint(provider, base_url)
+        breaker = self.retry_policy.breaker(endpoint)
+        breaker.before_call()
+
+        limiter = None
+        permit = None
+        try:
+            if self.rate_limiter is not None:
+                limiter = self.rate_limiter.for_endpoint(endpoint, request['model'])
+                permit = limiter.acquire(estimate_request_tokens(request))
+            try:
+                yield slot
+            except BaseException as e:
+                if limiter is not None:
+                    status, headers = error_status_and_headers(e)
+                    limiter.release(permit, headers, status, failed=True)
+                if isinstance(e, Exception):
+                    self._breaker_failed(breaker, e)
+                raise
+            if limiter is not None:
+                limiter.release(permit, slot.headers)
+            breaker.record_success()
+        finally:
+            # 被取消、流被关闭 (GeneratorExit) 或等待许可时出错,探测没有结论
+            breaker.release_probe()
+
+    @asynccontextmanager
+    async def _aguarded(self, provider: str, request: dict,
+                        base_url: Optional[str] = None) -> AsyncIterator[_CallSlot]:
+        """_guarded 的异步版本"""
+        slot = _CallSlot()
+        endpoint = self._endpoint(provider, base_url)
+        breaker = self.retry_policy.breaker(endpoint)
+        breaker.before_call()
+
+        limiter = None
+        permit = None
+        try:
+            if self.rate_limiter is not None:
+                limiter = self.rate_limiter.for_endpoint(endpoint, request['model'])
+                permit = await limiter.aacquire(estimate_request_tokens(request))
+            try:
+                yield slot
+            except BaseException as e:
+                if limiter is not None:
+                    status, headers = error_status_and_headers(e)
+                    limiter.release(permit, headers, status, failed=True)
+                if isinstance(e, Exception):
+                    self._breaker_failed(breaker, e)
+                raise
+            if limiter is not None:
+                limiter.release(permit, slot.headers)
+            breaker.record_success()
+        finally:
+            # 被取消、流被关闭 (GeneratorExit) 或等待许可时出错,探测没有结论
+            breaker.release_probe()
+
+    def _cache_key(self, provider: str, request: dict) -> Optional[str]:
+        """
+        计算请求的缓存键,未启用缓存时返回 None
+
+        多端点路由时端点在查缓存之后才选定,且 request['model'] 不是实际使用的模型,
+        因此键中使用路由器的全部端点 (网关 + 模型),端点配置不同的请求不会共用缓存。
+        """
+        if self.cache is None:
+            return None
+        base_url = None
+        if provider == 'openai':
+            if self.router is not None:
+                base_url = ','.join(sorted(f'{e.base_url or ""}|{e.model}' for e in self.router.endpoints))
+            else:
+                base_url = self.openai_base_url
+        return self.cache.make_key(provider, base_url, request)
+
+    def _cache_get(self, cache_key: Optional[str]) -> Optional[str]:
+        """读取缓存 (未启用或 bypass 时返回 None)"""
+        if cache_key is None or self.cache_bypass:
+            return None
+        try:
+            cached = self.cache.get(cache_key)
+        except Exception as e:
+            print(f'⚠️  读取 LLM 缓存失败: {str(e)}')
+            return None
+        if cached is not None and self.debug:
+            print(f'[DEBUG] 命中 LLM 缓存: {cache_key[:12]}')
+        return cached
+
+    def _cache_put(self, cache_key: Optional[str], text: str):
+        """写入缓存,缓存故障不影响主流程 (续写失败的部分输出不缓存)"""
+        if cache_key is None or getattr(text, 'continuation_error', None):
+            return
+        try:
+            self.cache.put(cache_key, text)
+        except Exception as e:
+            print(f'⚠️  写入 LLM 缓存失败: {str(e)}')
+
+    async def _acache_get(self, cache_key: Optional[str]) -> Optional[str]:
+        """异步读取缓存 (SQLite 可能等待其他进程的写锁,放到线程中执行)"""
+        if cache_key is None or self.cache_bypass:
+            return None
+        return await asyncio.to_thread(self._cache_get, cache_key)
+
+    async def _acache_put(self, cache_key: Optional[str], text: str):
+        """异步写入缓存"""
+        if cache_key is None:
+            return
+        await asyncio.to_thread(self._cache_put, cache_key, text)
+
+    def connection_stats(self) -> dict:
+        """返回底层连接池的复用统计 (请求数、新建连接数、复用连接数)"""
+        return self.pool.stats()
+
+    def rate_limit_stats(self) -> Optional[dict]:
+        """返回各端点的限流统计,未启用限流时返回 None"""
+        return self.rate_limiter.stats() if self.rate_limiter is not None else None
+
+    def cache_stats(self) -> Optional[dict]:
+        """返回响应缓存的命中统计,未启用缓存时返回 None"""
+        return self.cache.stats() if self.cache is not None else None
+
+    def close(self):
+        """关闭本实例独占的客户端池 (共享池由进程统一管理,不在此关闭)"""
+        if self._owns_pool:
+            self.pool.close()
+
+    async def aclose(self):
+        """关闭本实例独占的客户端池在当前事件循环中的异步客户端"""
+        if self._owns_pool:
+            await self.pool.aclose()
+
+    def router_stats(self) -> Optional[dict]:
+        """返回各路由端点的请求数、错误数与延迟 / 错误率 EWMA,未配置多端点时返回 None"""
+        return self.router.stats() if self.router is not None else None
+
+    def retry_stats(self) -> dict:
+        """返回重试、对冲与各端点熔断状态的统计"""
+        return self.retry_policy.stats()
+
+    def call_with_retry(self, func, *args, max_retries: Optional[int] = None,
+                        hedge: Optional[bool] = None, **kwargs) -> str:
         """
         带重试机制的 API 调用
 
+        只重试可恢复的错误 (429、5xx、超时、连接错误),配置错误和鉴权失败等立即抛出;
+        退避使用全抖动并遵守 Retry-After。可选的单次超时 / 整体截止时间和对冲请求
+        由 retry_policy 配置。
+
         Args:
             func: 要调用的函数
-            max_retries: 最大重试次数
+            max_retries: 最大尝试次数,为空时使用 LLM_MAX_RETRIES (默认 3)
+            hedge: 是否允许对冲请求,为空时使用 LLM_HEDGE;有副作用的调用应传 False
+            *args, **kwargs: 传递给函数的参数
+
+        Returns:
+            函数返回值
+        """
+        policy = self.retry_policy
+        attempts = max_retries or policy.max_attempts
+        hedge = policy.hedge if hedge is None else hedge
+        key = self._latency_key(func)
+        started = time.monotonic()
+
+        for attempt in range(attempts):
+            try:
+                timeout = policy.attempt_timeout_for(time.monotonic() - started)
+                policy.count('attempts')
+                return policy.run_attempt(key, func, args, kwargs, timeout, hedge)
+            except Exception as e:
+                delay = policy.next_delay(e, attempt, attempts, time.monotonic() - started)
+                if delay is None:
+                    raise
+                print(f'API 调用失败 (尝试 {attempt + 1}/{attempts}): {str(e)},{delay:.1f}s 后重试')
+                time.sleep(delay)
+
+        raise RuntimeError('API 调用重试次数耗尽')
+
+    async def acall_with_retry(self, func, *args, max_retries: Optional[int] = None,
+                               timeout: Optional[float] = None, hedge: Optional[bool] = None,
+                               **kwargs) -> str:
+        """
+        带重试机制的异步 API 调用
+
+        重试判定与 call_with_retry 相同。退避期间使用 asyncio.sleep,不阻塞事件循环;
+        任务被取消时 (asyncio.CancelledError) 立即向上传播,不会被当作失败重试。
+        超时或对冲落后的请求会被取消。
+
+        Args:
+            func: 要调用的协程函数 (如 acall_codex / acall_claude)
+            max_retries: 最大尝试次数,为空时使用 LLM_MAX_RETRIES (默认 3)
+            timeout: 单次尝试超时秒数,为空时使用 LLM_ATTEMPT_TIMEOUT
+            hedge: 是否允许对冲请求,为空时使用 LLM_HEDGE
             *args, **kwargs: 传递给函数的参数
 
         Returns:
             函数返回值
         """
-        import time
+        policy = self.retry_policy
+        attempts = max_retries or policy.max_attempts
+        hedge = policy.hedge if hedge is None else hedge
+        key = self._latency_key(func)
+        started = time.monotonic()
 
-        for attempt in range(max_retries):
+        for attempt in range(attempts):
             try:
-                return func(*args, **kwargs)
+                attempt_timeout = policy.attempt_timeout_for(time.monotonic() - started, timeout)
+                policy.count('attempts')
+                return await policy.arun_attempt(key, func, args, kwargs, attempt_timeout, hedge)
             except Exception as e:
-                if attempt == max_retries - 1:
+                delay = policy.next_delay(e, attempt, attempts, time.monotonic() - started)
+                if delay is None:
                     raise
-                print(f'API 调用失败 (尝试 {attempt + 1}/{max_retries}): {str(e)}')
-                time.sleep(2 ** attempt)  # 指数退避
+                print(f'API 调用失败 (尝试 {attempt + 1}/{attempts}): {str(e)},{delay:.1f}s 后重试')
+                await asyncio.sleep(delay)
 
         raise RuntimeError('API 调用重试次数耗尽')
+
+    def _latency_key(self, func) -> str:
+        """延迟统计按提供商 + 调用方法区分 (codex 与 claude 的耗时分布不同)"""
+        return f'{self.provider}:{getattr(func, "__name__", "call")}'
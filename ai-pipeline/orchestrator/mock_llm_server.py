@@ -0,0 +1,565 @@
+# mock_llm_server.py
+# 本地 LLM 替身服务:兼容 OpenAI / Anthropic 接口,回放录制的响应或按模板生成响应,
+# 可配置延迟、抖动、错误率与流式输出,用于离线、可复现地运行和压测真实流水线
+#
+# 用法:
+#   python orchestrator/mock_llm_server.py --port 8800 --recordings recordings.jsonl
+#   OPENAI_API_BASE=http://127.0.0.1:8800/v1 OPENAI_API_KEY=mock python run.py --requirement "..."
+#   (Anthropic 提供商: ANTHROPIC_BASE_URL=http://127.0.0.1:8800)
+import argparse
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+from streaming import CODE_BLOCK_PATTERN
+
+
+def request_key(messages: List[Dict]) -> str:
+    """录制/回放使用的请求键:只取消息内容,与模型、max_tokens 等参数无关"""
+    payload = json.dumps(
+        [{'role': m.get('role'), 'content': _content_text(m.get('content'))} for m in messages],
+        ensure_ascii=False, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数 (约 4 字符 / token),仅用于 usage 字段和 max_tokens 截断"""
+    return max(1, (len(text) + 3) // 4)
+
+
+class MockConfig:
+    """替身服务行为配置"""
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 500,
+        retry_after: Optional[float] = None,
+        chunk_size: int = 16,
+        chunk_delay: float = 0.0,
+        review_failures: int = 0,
+        seed: Optional[int] = None
+    ):
+        """
+        Args:
+            latency: 每个请求的基础延迟 (秒)
+            jitter: 延迟随机抖动上限 (秒),实际延迟为 latency + uniform(0, jitter)
+            error_rate: 随机返回错误的概率 (0-1)
+            error_status: 注入错误使用的 HTTP 状态码 (如 429 / 500 / 503)
+            retry_after: 注入错误时返回的 Retry-After 头 (秒)
+            chunk_size: 流式输出每个分片的字符数
+            chunk_delay: 流式分片之间的间隔 (秒)
+            review_failures: 模板模式下前 N 次代码审查返回未通过,用于触发修复循环
+            seed: 随机种子,固定后延迟和错误注入可复现
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.chunk_size = max(1, chunk_size)
+        self.chunk_delay = chunk_delay
+        self.review_failures = review_failures
+        self.seed = seed
+
+
+class ResponseStore:
+    """
+    响应来源:录制文件 + 内置模板
+
+    录制文件为 JSONL,每行一条:
+      {"key": "<request_key>", "response": "..."}   按请求内容精确匹配
+      {"match": "关键字", "response": "..."}          提示词包含关键字即匹配 (手写夹具)
+    """
+
+    def __init__(self, recordings_path: Optional[str] = None, review_failures: int = 0):
+        self.recordings_path = recordings_path
+        self.exact: Dict[str, str] = {}
+        self.patterns: List[Dict] = []
+        self._lock = threading.Lock()
+        self._review_failures = review_failures
+        self._reviews = 0
+        if recordings_path:
+            self._load(recordings_path)
+
+    def lookup(self, messages: List[Dict]) -> str:
+        """按 精确录制 → 关键字夹具 → 模板 的顺序返回响应文本"""
+        key = request_key(messages)
+        if key in self.exact:
+            return self.exact[key]
+
+        prompt = '\n'.join(_content_text(m.get('content')) for m in messages)
+        for entry in self.patterns:
+            if entry['match'] in prompt:
+                return entry['response']
+
+        return self._template(prompt)
+
+    def record(self, messages: List[Dict], response: str):
+        """追加一条录制结果"""
+        key = request_key(messages)
+        with self._lock:
+            self.exact[key] = response
+            if self.recordings_path:
+                with open(self.recordings_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps({'key': key, 'response': response}, ensure_ascii=False) + '\n')
+
+    def _load(self, path: str):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    entry = json.loads(line)
+                    if 'key' in entry:
+                        self.exact[entry['key']] = entry['response']
+                    elif 'match' in entry:
+                        self.patterns.append(entry)
+            print(f'✓ 已加载录制响应: {len(self.exact)} 条精确匹配, {len(self.patterns)} 条关键字匹配')
+        except FileNotFoundError:
+            print(f'⚠️  录制文件不存在,将在录制模式下创建: {path}')
+
+    def _template(self, prompt: str) -> str:
+        """根据提示词识别流水线阶段,返回对应格式的模板响应"""
+        if '请修复以下代码中的缺陷' in prompt:
+            return _template_fix(prompt)
+        if '代码审查' in prompt and '"passed"' in prompt:
+            with self._lock:
+                self._reviews += 1
+                failed = self._reviews <= self._review_failures
+            return _template_review(prompt, failed)
+        if '"tasks"' in prompt and '用户原始需求' in prompt:
+            return _template_srs(prompt)
+        if 'path:' in prompt:
+            return _template_code(prompt)
+        return '这是来自本地 LLM 替身服务的模板响应。'
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    """处理 OpenAI chat completions 与 Anthropic messages 请求"""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'MockLLM/1.0'
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self._send_json(200, {'object': 'list', 'data': [{'id': 'mock-model', 'object': 'model'}]})
+        elif self.path.rstrip('/').endswith('/health'):
+            self._send_json(200, {'status': 'ok', 'stats': self.server.stats()})
+        else:
+            self._send_json(404, {'error': {'message': 'not found'}})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except json.JSONDecodeError:
+            self._send_json(400, {'error': {'message': 'invalid json', 'type': 'invalid_request_error'}})
+            return
+
+        path = self.path.split('?')[0].rstrip('/')
+        if path.endswith('/chat/completions'):
+            api = 'openai'
+        elif path.endswith('/messages'):
+            api = 'anthropic'
+        else:
+            self._send_json(404, {'error': {'message': f'unknown endpoint {self.path}'}})
+            return
+
+        self.server.count('requests')
+        config = self.server.config
+        self.server.sleep(config.latency + self.server.uniform(config.jitter))
+
+        if self.server.should_fail():
+            self.server.count('errors')
+            headers = {}
+            if config.retry_after is not None:
+                headers['Retry-After'] = str(config.retry_after)
+            self._send_json(config.error_status, {
+                'type': 'error',
+                'error': {'message': 'injected error', 'type': 'mock_error', 'code': config.error_status}
+            }, headers)
+            return
+
+        messages = list(body.get('messages', []))
+        if api == 'anthropic' and body.get('system'):
+            messages.insert(0, {'role': 'system', 'content': body['system']})
+
+        # 续写请求:对话中已有 assistant 的部分输出,返回完整响应中剩余的部分
+        partial = None
+        assistant = [i for i, m in enumerate(messages) if m.get('role') == 'assistant']
+        if assistant:
+            partial = _content_text(messages[assistant[-1]].get('content'))
+            messages = messages[:assistant[-1]]
+
+        text = self.server.respond(messages, body, api, dict(self.headers))
+        if text is None:
+            self._send_json(502, {'error': {'message': 'upstream recording failed'}})
+            return
+        if partial and text.startswith(partial.rstrip()):
+            text = text[len(partial.rstrip()):] if api == 'anthropic' else text[len(partial):]
+
+        truncated = False
+        max_tokens = body.get('max_tokens')
+        if max_tokens and estimate_tokens(text) > max_tokens:
+            text = text[:max_tokens * 4]
+            truncated = True
+
+        model = body.get('model', 'mock-model')
+        usage_in = estimate_tokens(json.dumps(messages, ensure_ascii=False))
+        usage_out = estimate_tokens(text)
+        if api == 'openai':
+            finish = 'length' if truncated else 'stop'
+            if body.get('stream'):
+                self._stream_openai(text, model, finish)
+            else:
+                self._send_json(200, {
+                    'id': f'chatcmpl-{uuid.uuid4().hex[:24]}',
+                    'object': 'chat.completion',
+                    'created': int(time.time()),
+                    'model': model,
+                    'choices': [{
+                        'index': 0,
+                        'message': {'role': 'assistant', 'content': text},
+                        'finish_reason': finish
+                    }],
+                    'usage': {'prompt_tokens': usage_in, 'completion_tokens': usage_out,
+                              'total_tokens': usage_in + usage_out}
+                })
+        else:
+            stop = 'max_tokens' if truncated else 'end_turn'
+            if body.get('stream'):
+                self._stream_anthropic(text, model, stop, usage_in, usage_out)
+            else:
+                self._send_json(200, {
+                    'id': f'msg_{uuid.uuid4().hex[:24]}',
+                    'type': 'message',
+                    'role': 'assistant',
+                    'model': model,
+                    'content': [{'type': 'text', 'text': text}],
+                    'stop_reason': stop,
+                    'stop_sequence': None,
+                    'usage': {'input_tokens': usage_in, 'output_tokens': usage_out}
+                })
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, payload: dict, headers: Optional[Dict[str, str]] = None):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _start_sse(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def _write_chunk(self, data: str):
+        raw = data.encode('utf-8')
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(raw), raw))
+        self.wfile.flush()
+
+    def _end_sse(self):
+        self.wfile.write(b'0\r\n\r\n')
+        self.wfile.flush()
+
+    def _pieces(self, text: str):
+        size = self.server.config.chunk_size
+        for i in range(0, len(text), size):
+            if i and self.server.config.chunk_delay:
+                time.sleep(self.server.config.chunk_delay)
+            yield text[i:i + size]
+
+    def _stream_openai(self, text: str, model: str, finish: str):
+        chunk_id = f'chatcmpl-{uuid.uuid4().hex[:24]}'
+        created = int(time.time())
+
+        def event(delta: dict, finish_reason=None) -> str:
+            return 'data: ' + json.dumps({
+                'id': chunk_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]
+            }, ensure_ascii=False) + '\n\n'
+
+        self._start_sse()
+        self._write_chunk(event({'role': 'assistant', 'content': ''}))
+        for piece in self._pieces(text):
+            self._write_chunk(event({'content': piece}))
+        self._write_chunk(event({}, finish))
+        self._write_chunk('data: [DONE]\n\n')
+        self._end_sse()
+
+    def _stream_anthropic(self, text: str, model: str, stop: str, usage_in: int, usage_out: int):
+        def event(name: str, payload: dict) -> str:
+            return f'event: {name}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n'
+
+        self._start_sse()
+        self._write_chunk(event('message_start', {'type': 'message_start', 'message': {
+            'id': f'msg_{uuid.uuid4().hex[:24]}', 'type': 'message', 'role': 'assistant', 'model': model,
+            'content': [], 'stop_reason': None, 'stop_sequence': None,
+            'usage': {'input_tokens': usage_in, 'output_tokens': 0}
+        }}))
+        self._write_chunk(event('content_block_start', {
+            'type': 'content_block_start', 'index': 0, 'content_block': {'type': 'text', 'text': ''}
+        }))
+        for piece in self._pieces(text):
+            self._write_chunk(event('content_block_delta', {
+                'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': piece}
+            }))
+        self._write_chunk(event('content_block_stop', {'type': 'content_block_stop', 'index': 0}))
+        self._write_chunk(event('message_delta', {
+            'type': 'message_delta', 'delta': {'stop_reason': stop, 'stop_sequence': None},
+            'usage': {'output_tokens': usage_out}
+        }))
+        self._write_chunk(event('message_stop', {'type': 'message_stop'}))
+        self._end_sse()
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    """
+    LLM 替身服务
+
+    可以作为独立进程运行,也可以在测试 / 压测脚本中进程内启动:
+        server = MockLLMServer(config=MockConfig(latency=0.2))
+        server.start()
+        os.environ['OPENAI_API_BASE'] = server.base_url
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host: str = '127.0.0.1',
+        port: int = 0,
+        config: Optional[MockConfig] = None,
+        recordings: Optional[str] = None,
+        record_upstream: Optional[str] = None,
+        verbose: bool = False
+    ):
+        """
+        Args:
+            host: 监听地址
+            port: 监听端口 (0 表示随机端口)
+            config: 行为配置
+            recordings: 录制文件路径 (JSONL)
+            record_upstream: 录制模式的上游 OpenAI 兼容端点;设置后未命中的请求会转发到上游并写入录制文件
+            verbose: 是否输出访问日志
+        """
+        super().__init__((host, port), MockLLMHandler)
+        self.config = config or MockConfig()
+        self.store = ResponseStore(recordings, self.config.review_failures)
+        self.record_upstream = record_upstream.rstrip('/') if record_upstream else None
+        self.verbose = verbose
+        self._random = random.Random(self.config.seed)
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'errors': 0, 'recorded': 0}
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        """OpenAI 兼容的 base_url (可直接用作 OPENAI_API_BASE)"""
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def start(self) -> 'MockLLMServer':
+        """在后台线程中启动服务"""
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """停止服务"""
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        """客户端提前断开 (超时 / 对冲请求被取消) 属于正常情况,不输出堆栈"""
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    def respond(self, messages: List[Dict], body: dict, api: str, headers: Dict[str, str]) -> Optional[str]:
+        """返回请求对应的响应文本,录制模式下未命中精确录制时转发到上游"""
+        if self.record_upstream and request_key(messages) not in self.store.exact:
+            text = self._forward(body, api, headers)
+            if text is not None:
+                self.store.record(messages, text)
+                self.count('recorded')
+            return text
+        return self.store.lookup(messages)
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.config.error_rate
+
+    def uniform(self, upper: float) -> float:
+        if upper <= 0:
+            return 0.0
+        with self._lock:
+            return self._random.uniform(0, upper)
+
+    @staticmethod
+    def sleep(seconds: float):
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def count(self, name: str):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+    def _forward(self, body: dict, api: str, headers: Dict[str, str]) -> Optional[str]:
+        """将请求 (非流式) 转发到上游并提取响应文本"""
+        import requests
+
+        forward_headers = {k: v for k, v in headers.items()
+                           if k.lower() in ('authorization', 'x-api-key', 'anthropic-version')}
+        body = dict(body, stream=False)
+        endpoint = '/chat/completions' if api == 'openai' else '/messages'
+        try:
+            resp = requests.post(self.record_upstream + endpoint, json=body, headers=forward_headers, timeout=600)
+            resp.raise_for_status()
+            data = resp.json()
+            if api == 'openai':
+                return data['choices'][0]['message']['content']
+            return ''.join(block.get('text', '') for block in data.get('content', []))
+        except Exception as e:
+            print(f'✗ 上游录制失败: {str(e)}')
+            return None
+
+
+def _content_text(content) -> str:
+    """消息 content 可能是字符串或 [{type: text, text: ...}] 列表"""
+    if isinstance(content, list):
+        return ''.join(part.get('text', '') for part in content if isinstance(part, dict))
+    return content or ''
+
+
+def _code_blocks_in(prompt: str) -> List[tuple]:
+    return [(m.group(1).strip(), m.group(2).strip()) for m in CODE_BLOCK_PATTERN.finditer(prompt)]
+
+
+def _format_blocks(blocks: List[tuple]) -> str:
+    return '\n\n'.join(f'```python\n# path: {path}\n{content}\n```' for path, content in blocks)
+
+
+def _template_srs(prompt: str) -> str:
+    requirement = prompt.split('用户原始需求')[-1].strip('*: \n-')[:200].split('\n')[0]
+    return json.dumps({
+        'srs': f'# 软件需求规格说明\n\n## 1. 项目概述\n{requirement}\n\n## 2. 功能需求\n- FR1: 核心功能\n',
+        'tasks': [
+            {'module': 'app', 'file': 'app/main.py', 'task': '实现核心功能'},
+            {'module': 'app', 'file': 'app/utils.py', 'task': '实现辅助函数'},
+            {'module': 'tests', 'file': 'tests/test_main.py', 'task': '编写单元测试'}
+        ]
+    }, ensure_ascii=False)
+
+
+def _template_code(prompt: str) -> str:
+    files = []
+    for path in re.findall(r'"file":\s*"([^"]+)"', prompt):
+        if path not in files:
+            files.append(path)
+    if not files:
+        files = ['app/main.py']
+    blocks = []
+    for path in files:
+        name = re.sub(r'\W', '_', path.rsplit('/', 1)[-1].rsplit('.', 1)[0])
+        blocks.append((path, f'"""{path}"""\n\n\ndef {name}():\n    return True\n'))
+    return '以下是实现代码:\n\n' + _format_blocks(blocks)
+
+
+def _template_review(prompt: str, failed: bool) -> str:
+    blocks = _code_blocks_in(prompt)
+    target = blocks[0][0] if blocks else 'app/main.py'
+    defects = []
+    if failed:
+        defects.append({
+            'severity': 'medium', 'category': 'logic', 'file': target,
+            'description': '缺少输入校验', 'recommendation': '为公共函数添加参数校验'
+        })
+    return json.dumps({
+        'passed': not failed,
+        'results': [f'共审查 {len(blocks)} 个文件'],
+        'defects': defects,
+        'tests': {'files': [], 'run_command': 'pytest', 'expected_result': '全部通过'}
+    }, ensure_ascii=False)
+
+
+def _template_fix(prompt: str) -> str:
+    blocks = [(path, content) for path, content in _code_blocks_in(prompt) if '<<<<<<< SEARCH' not in content]
+    if '<<<<<<< SEARCH' in prompt:
+        # 补丁模式: 对每个文件的最后一行输出一个 SEARCH/REPLACE 编辑块
+        edits = [(path, f'<<<<<<< SEARCH\n{content.splitlines()[-1]}\n=======\n'
+                        f'{content.splitlines()[-1]}\n# fixed\n>>>>>>> REPLACE')
+                 for path, content in blocks if content]
+        return '修改如下:\n\n' + _format_blocks(edits)
+    fixed = [(path, content + '\n# fixed') for path, content in blocks]
+    return '修复后的代码:\n\n' + _format_blocks(fixed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='本地 LLM 替身服务 (OpenAI / Anthropic 兼容)')
+    parser.add_argument('--host', default='127.0.0.1', help='监听地址 (默认: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8800, help='监听端口 (默认: 8800)')
+    parser.add_argument('--recordings', help='录制文件路径 (JSONL)')
+    parser.add_argument('--record-upstream', help='录制模式: 未命中时转发到该上游端点并写入录制文件')
+    parser.add_argument('--latency', type=float, default=0.0, help='基础延迟秒数')
+    parser.add_argument('--jitter', type=float, default=0.0, help='延迟抖动上限秒数')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='错误注入概率 (0-1)')
+    parser.add_argument('--error-status', type=int, default=500, help='注入错误的 HTTP 状态码')
+    parser.add_argument('--retry-after', type=float, help='注入错误时返回的 Retry-After 秒数')
+    parser.add_argument('--chunk-size', type=int, default=16, help='流式分片字符数')
+    parser.add_argument('--chunk-delay', type=float, default=0.0, help='流式分片间隔秒数')
+    parser.add_argument('--review-failures', type=int, default=0, help='模板模式下前 N 次审查返回未通过')
+    parser.add_argument('--seed', type=int, help='随机种子')
+    parser.add_argument('--verbose', action='store_true', help='输出访问日志')
+
+    args = parser.parse_args()
+    server = MockLLMServer(
+        host=args.host,
+        port=args.port,
+        config=MockConfig(
+            latency=args.latency,
+            jitter=args.jitter,
+            error_rate=args.error_rate,
+            error_status=args.error_status,
+            retry_after=args.retry_after,
+            chunk_size=args.chunk_size,
+            chunk_delay=args.chunk_delay,
+            review_failures=args.review_failures,
+            seed=args.seed
+        ),
+        recordings=args.recordings,
+        record_upstream=args.record_upstream,
+        verbose=args.verbose
+    )
+    print(f'✓ LLM 替身服务已启动: {server.base_url}')
+    print(f'  OPENAI_API_BASE={server.base_url}')
+    print(f'  ANTHROPIC_BASE_URL={server.base_url[:-3]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('\n已停止')
@@ -3,14 +3,29 @@
 import argparse
 import json
 import os
-import re
-import tempfile
-from typing import List, Tuple, Optional, Dict
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple, Optional, Dict
 # 加载 .env 文件中的环境变量
 from dotenv import load_dotenv
 load_dotenv()
 
+from checkpoint import Checkpoint, fingerprint
+from convergence import STOP_REASONS, FixLoopTracker
+from fanout import FANOUT_SCOPE_NOTE, PathClaims, group_tasks, merge_blocks, normalize_path, task_files
+from fix_candidates import CandidateCancelled, SpendMeter, call_cost, consume, race, variants_from_env
+from fix_scope import Defect, fix_targets, interface_summary, merge_fixed
 from llm_client import LLMClient
+from patching import PATCH_FORMAT_NOTE, apply_patch_response
+from review_cache import build_cache, changed_files, merge_review
+from review_shards import reduce_reviews, scope_note, split_shards
+from runs import RUN_INFO_FILE, create_run_dir, read_run_info, write_run_info
+from sandbox import materialize, verify
+from scheduler import PipelineAbort, Stage, StageScheduler, registered_stages
+from static_gate import gate_enabled, run_static_gate
+from streaming import CODE_BLOCK_PATTERN, StreamCancelled, StreamResult, collect_stream, format_timing
+from token_budget import TokenBudget, count_tokens
 from utils import (
     write_files_from_codeblock,
     commit_and_push,
@@ -20,13 +35,23 @@ from utils import (
 )
 
 
+# 已加载的提示词模板 {路径: (修改时间, 内容)},常驻进程 (服务模式、批量模式) 中不重复读取文件
+_prompt_cache: Dict[str, Tuple[float, str]] = {}
+
+
 def load_prompt(path: str) -> str:
-    """加载提示词模板"""
+    """加载提示词模板 (文件修改后重新读取)"""
     try:
+        mtime = os.path.getmtime(path)
+        cached = _prompt_cache.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
         with open(path, 'r', encoding='utf-8') as f:
-            return f.read()
+            text = f.read()
     except FileNotFoundError:
         raise FileNotFoundError(f'提示词文件不存在: {path}')
+    _prompt_cache[path] = (mtime, text)
+    return text
 
 
 def parse_code_blocks(llm_response: str) -> List[Tuple[str, str]]:
@@ -43,12 +68,7 @@ def parse_code_blocks(llm_response: str) -> List[Tuple[str, str]]:
 
     # 匹配包含路径注释的代码块
     # 支持多种格式: # path: ..., // path: ..., <!-- path: ... -->
-    pattern = re.compile(
-        r'```(?:[a-zA-Z0-9]*)\n(?:#|//|<!--)\s*path:\s*(.+?)(?:-->)?\n([\s\S]*?)```',
-        re.MULTILINE
-    )
-
-    for match in pattern.finditer(llm_response):
+    for match in CODE_BLOCK_PATTERN.finditer(llm_response):
         path = match.group(1).strip()
         content = match.group(2).strip()
         blocks.append((path, content))
@@ -60,7 +80,59 @@ def parse_code_blocks(llm_response: str) -> List[Tuple[str, str]]:
     return blocks
 
 
-def generate_srs(client: LLMClient, requirement: str, output_dir: str) -> Dict:
+def stream_code_blocks(client: LLMClient, stream_func, prompt: str, max_tokens: int,
+                       code_dir: Optional[str] = None,
+                       accept: Optional[Callable[[str], bool]] = None) -> StreamResult:
+    """
+    流式调用 LLM,边接收边解析代码块,并在每个代码块闭合时立即写入文件
+
+    Args:
+        client: LLM 客户端
+        stream_func: 流式调用函数 (client.stream_claude / client.stream_codex)
+        prompt: 提示词
+        max_tokens: 最大生成 token 数
+        code_dir: 代码写入目录,为空时只解析不写文件
+        accept: 判断代码块是否写入文件 (并行生成时用于处理路径冲突),为空时全部写入
+
+    Returns:
+        StreamResult (完整文本、代码块、耗时统计)
+    """
+    # 单次调用超时后原线程仍在接收,由重试取代:新的尝试开始时取消之前的尝试,
+    # 写文件与取消在同一把锁内进行,被取消的尝试不会再写文件
+    write_lock = threading.Lock()
+    attempts: List[threading.Event] = []
+
+    def run() -> StreamResult:
+        cancel = threading.Event()
+        with write_lock:
+            for previous in attempts:
+                previous.set()
+            attempts.append(cancel)
+
+        def on_block(path: str, content: str):
+            with write_lock:
+                if cancel.is_set():
+                    raise StreamCancelled()
+                if accept is None or accept(path):
+                    write_files_from_codeblock([(path, content)], code_dir)
+
+        started_at = time.perf_counter()
+        chunks = stream_func(prompt, max_tokens=max_tokens)
+        return collect_stream(chunks, on_block if code_dir else None, started_at, cancel)
+
+    # 流式调用会边接收边写文件,不能发出对冲请求
+    try:
+        result = client.call_with_retry(run, hedge=False)
+    finally:
+        with write_lock:
+            for cancel in attempts:
+                cancel.set()
+    print(f'⏱  流式耗时: {format_timing(result.timing)}')
+    return result
+
+
+def generate_srs(client: LLMClient, requirement: str, output_dir: str,
+                 budget: Optional[TokenBudget] = None, checkpoint: Optional[Checkpoint] = None) -> Dict:
     """
     第一步: 使用 Codex 生成 SRS
 
@@ -68,6 +140,8 @@ def generate_srs(client: LLMClient, requirement: str, output_dir: str) -> Dict:
         client: LLM 客户端
         requirement: 用户需求描述
         output_dir: 输出目录
+        budget: token 预算 (按上下文窗口确定 max_tokens 并记录用量)
+        checkpoint: 续跑时已保存的步骤结果 (指纹一致时直接复用)
 
     Returns:
         包含 srs 和 tasks 的字典
@@ -79,8 +153,18 @@ def generate_srs(client: LLMClient, requirement: str, output_dir: str) -> Dict:
     prompt_path = 'orchestrator/prompts/codex_srs_prompt.txt'
     prompt = load_prompt(prompt_path).replace('{{REQUIREMENT}}', requirement)
 
+    models = client.models('codex')
+    step_fingerprint = fingerprint('srs', prompt, models, max_tokens=2000)
+    saved = checkpoint.load('step1_srs', step_fingerprint) if checkpoint else None
+    if saved:
+        return saved
+
+    budget = budget or TokenBudget()
+    max_tokens, entry = budget.plan('srs', prompt, 2000, models)
+
     print('正在调用 Codex 生成 SRS...')
-    srs_response = client.call_with_retry(client.call_codex, prompt, max_tokens=2000)
+    srs_response = client.call_with_retry(client.call_codex, prompt, max_tokens=max_tokens)
+    budget.record(entry, srs_response)
 
     # 解析响应
     srs_json = validate_json_response(srs_response)
@@ -99,14 +183,20 @@ def generate_srs(client: LLMClient, requirement: str, output_dir: str) -> Dict:
     result = {
         'srs': srs_markdown,
         'tasks': tasks,
-        'raw_response': srs_response
+        'raw_response': srs_response,
+        'continuations': getattr(srs_response, 'continuations', 0),
+        'fingerprint': step_fingerprint
     }
 
     save_intermediate_result(result, 'step1_srs', output_dir)
     return result
 
 
-def generate_code(client: LLMClient, srs_data: Dict, output_dir: str) -> Tuple[str, List[Tuple[str, str]]]:
+def generate_code(client: LLMClient, srs_data: Dict, output_dir: str,
+                  stream: bool = False, code_dir: Optional[str] = None,
+                  budget: Optional[TokenBudget] = None,
+                  fanout: Optional[bool] = None,
+                  checkpoint: Optional[Checkpoint] = None) -> Tuple[str, List[Tuple[str, str]]]:
     """
     第二步: 使用 Claude 生成代码
 
@@ -114,6 +204,11 @@ def generate_code(client: LLMClient, srs_data: Dict, output_dir: str) -> Tuple[s
         client: LLM 客户端
         srs_data: SRS 数据
         output_dir: 输出目录
+        stream: 是否使用流式生成
+        code_dir: 流式模式下代码块闭合后立即写入的目录
+        budget: token 预算 (按上下文窗口确定 max_tokens 并记录用量)
+        fanout: 是否按任务分组并行生成,为空时读取 LLM_CODEGEN_FANOUT 环境变量
+        checkpoint: 续跑时已保存的步骤结果 (指纹一致时直接复用)
 
     Returns:
         (原始响应, 代码块列表)
@@ -122,39 +217,201 @@ def generate_code(client: LLMClient, srs_data: Dict, output_dir: str) -> Tuple[s
     print('步骤 2/5: 生成代码实现')
     print('='*60)
 
+    if fanout is None:
+        fanout = os.getenv('LLM_CODEGEN_FANOUT', 'false').lower() == 'true'
+
     prompt_path = 'orchestrator/prompts/claude_code_prompt.txt'
     prompt = load_prompt(prompt_path)
     prompt = prompt.replace('{{SRS}}', srs_data['srs'])
     prompt = prompt.replace('{{TASKS}}', json.dumps(srs_data['tasks'], ensure_ascii=False, indent=2))
 
-    print('正在调用 Claude 生成代码...')
-    code_response = client.call_with_retry(client.call_claude, prompt, max_tokens=4000)
+    models = client.models('claude')
+    step_fingerprint = fingerprint('code', prompt, models, max_tokens=4000, fanout=fanout)
+    saved = checkpoint.load('step2_code', step_fingerprint) if checkpoint else None
+    if saved:
+        code_blocks = [(b['path'], b['content']) for b in saved['code_blocks']]
+        if stream and code_dir:
+            write_files_from_codeblock(code_blocks, code_dir)
+        return saved['raw_response'], code_blocks
+
+    if fanout:
+        groups = group_tasks(srs_data.get('tasks') or [], int(os.getenv('LLM_CODEGEN_MAX_GROUPS', '8')))
+        if len(groups) > 1:
+            return generate_code_fanout(client, srs_data, groups, output_dir, stream=stream,
+                                        code_dir=code_dir, budget=budget, step_fingerprint=step_fingerprint)
+        print('任务不足两组,按单次请求生成代码')
+
+    budget = budget or TokenBudget()
+    max_tokens, entry = budget.plan('code', prompt, 4000, models)
+
+    timing = None
+    if stream:
+        print('正在调用 Claude 流式生成代码...')
+        result = stream_code_blocks(client, client.stream_claude, prompt, max_tokens, code_dir)
+        code_response, code_blocks, timing = result.text, result.blocks, result.timing
+        continuations = result.continuations
+        if not code_blocks:
+            print('⚠️  未找到带路径标记的代码块')
+    else:
+        print('正在调用 Claude 生成代码...')
+        code_response = client.call_with_retry(client.call_claude, prompt, max_tokens=max_tokens)
+        continuations = getattr(code_response, 'continuations', 0)
+
+        # 解析代码块
+        code_blocks = parse_code_blocks(code_response)
+    budget.record(entry, code_response)
+
+    if code_blocks:
+        print(f'✓ 代码生成成功,共 {len(code_blocks)} 个文件')
+    else:
+        print('⚠️  未能解析出代码块')
+
+    step_data = {
+        'code_blocks': [{'path': p, 'content': c} for p, c in code_blocks],
+        'raw_response': code_response,
+        'continuations': continuations,
+        'fingerprint': step_fingerprint
+    }
+    if timing:
+        step_data['timing'] = timing
+    save_intermediate_result(step_data, 'step2_code', output_dir)
+
+    return code_response, code_blocks
+
+
+def generate_code_fanout(client: LLMClient, srs_data: Dict, groups: List[List[Dict]], output_dir: str,
+                         stream: bool = False, code_dir: Optional[str] = None,
+                         budget: Optional[TokenBudget] = None,
+                         step_fingerprint: Optional[str] = None) -> Tuple[str, List[Tuple[str, str]]]:
+    """
+    按任务分组并行生成代码
+
+    每个任务组一次请求,共享完整 SRS 作为上下文,并告知项目的完整文件清单;
+    并发数由 LLM_CODEGEN_CONCURRENCY 限制 (默认 4)。各组代码块合并时,
+    同一路径被多个任务组输出的,优先采用任务列表中声明该文件的任务组的版本。
+    单个任务组失败时保留其余任务组的结果 (缺失的文件由审查发现并修复),全部失败时抛出第一个错误。
+
+    Args:
+        client: LLM 客户端
+        srs_data: SRS 数据
+        groups: 任务分组 (fanout.group_tasks)
+        output_dir: 输出目录
+        stream: 是否使用流式生成
+        code_dir: 流式模式下代码块闭合后立即写入的目录
+        budget: token 预算 (按上下文窗口确定 max_tokens 并记录用量)
+        step_fingerprint: 步骤输入的指纹 (保存在结果中,用于续跑)
+
+    Returns:
+        (合并后的代码包, 代码块列表)
+    """
+    template = load_prompt('orchestrator/prompts/claude_code_prompt.txt').replace('{{SRS}}', srs_data['srs'])
+    all_files = '\n'.join(f'- {path}' for path in task_files(srs_data['tasks'])) or '- (未声明)'
+    claims = PathClaims(groups)
+    budget = budget or TokenBudget()
+    concurrency = max(1, min(int(os.getenv('LLM_CODEGEN_CONCURRENCY', '4')), len(groups)))
+
+    def run(index: int) -> Dict:
+        try:
+            return run_group(index)
+        except Exception as e:
+            print(f'  ✗ 任务组 {index + 1}/{len(groups)} 生成失败: {e}')
+            return {'tasks': groups[index], 'files': [], 'elapsed': 0.0, 'continuations': 0,
+                    'raw_response': None, 'error': str(e), 'exception': e, 'blocks': None}
+
+    def run_group(index: int) -> Dict:
+        group = groups[index]
+        own_files = '\n'.join(f'- {path}' for path in task_files(group)) or '- (按任务需要确定)'
+        prompt = template.replace('{{TASKS}}', json.dumps(group, ensure_ascii=False, indent=2))
+        prompt += FANOUT_SCOPE_NOTE.replace('{{OWN_FILES}}', own_files).replace('{{ALL_FILES}}', all_files)
+        max_tokens, entry = budget.plan('code', prompt, 4000, client.models('claude'))
+
+        started_at = time.perf_counter()
+        if stream:
+            result = stream_code_blocks(client, client.stream_claude, prompt, max_tokens, code_dir,
+                                        accept=lambda path: claims.claim(path, index))
+            response, blocks, continuations = result.text, result.blocks, result.continuations
+        else:
+            response = client.call_with_retry(client.call_claude, prompt, max_tokens=max_tokens)
+            blocks = parse_code_blocks(response)
+            continuations = getattr(response, 'continuations', 0)
+        budget.record(entry, response)
+        elapsed = time.perf_counter() - started_at
+
+        print(f'  ✓ 任务组 {index + 1}/{len(groups)}: {len(group)} 个任务, {len(blocks)} 个文件 ({elapsed:.1f}s)')
+        return {
+            'tasks': group,
+            'files': [p for p, _ in blocks],
+            'elapsed': round(elapsed, 3),
+            'continuations': continuations,
+            'raw_response': response,
+            'blocks': blocks
+        }
+
+    print(f'正在调用 Claude 按 {len(groups)} 个任务组并行生成代码 (并发 {concurrency})...')
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        group_results = list(executor.map(run, range(len(groups))))
+    elapsed = time.perf_counter() - started_at
 
-    # 解析代码块
-    code_blocks = parse_code_blocks(code_response)
+    errors = [r.pop('exception') for r in group_results if 'exception' in r]
+    if len(errors) == len(group_results):
+        raise errors[0]
+    if errors:
+        print(f'⚠️  {len(errors)}/{len(groups)} 个任务组生成失败,保留其余任务组的代码')
+
+    code_blocks = merge_blocks([r.pop('blocks') for r in group_results], claims)
+    code_response = '\n\n'.join([
+        f'```\n# path: {path}\n{content}\n```'
+        for path, content in code_blocks
+    ])
+    serial = sum(r['elapsed'] for r in group_results)
+    print(f'⏱  并行生成耗时 {elapsed:.1f}s (各任务组耗时合计 {serial:.1f}s)')
 
     if code_blocks:
         print(f'✓ 代码生成成功,共 {len(code_blocks)} 个文件')
+        if claims.conflicts:
+            print(f'⚠️  {len(claims.conflicts)} 处路径冲突已按文件归属处理')
     else:
         print('⚠️  未能解析出代码块')
 
-    save_intermediate_result({
+    step_data = {
         'code_blocks': [{'path': p, 'content': c} for p, c in code_blocks],
-        'raw_response': code_response
-    }, 'step2_code', output_dir)
+        'raw_response': code_response,
+        'continuations': sum(r['continuations'] for r in group_results),
+        'fingerprint': step_fingerprint,
+        'fanout': {
+            'groups': group_results,
+            'conflicts': claims.conflicts,
+            'concurrency': concurrency,
+            'elapsed': round(elapsed, 3)
+        }
+    }
+    save_intermediate_result(step_data, 'step2_code', output_dir)
 
     return code_response, code_blocks
 
 
-def review_and_test(client: LLMClient, srs_data: Dict, code_response: str, output_dir: str) -> Dict:
+def review_and_test(client: LLMClient, srs_data: Dict, code_response: str, output_dir: str,
+                    budget: Optional[TokenBudget] = None, iteration: int = 0,
+                    checkpoint: Optional[Checkpoint] = None,
+                    code_blocks: Optional[List[Tuple[str, str]]] = None,
+                    previous: Optional[Dict] = None) -> Dict:
     """
     第三步: 使用 Codex 进行代码审查和测试
 
+    复审时 (提供 previous) 只发送与上一轮审查相比内容变化的文件和上一轮的缺陷,
+    未变化文件沿用上一轮的结论,合并为完整审查结果 (LLM_REVIEW_INCREMENTAL=false 时每轮完整审查)。
+
     Args:
         client: LLM 客户端
         srs_data: SRS 数据
         code_response: 代码生成的原始响应
         output_dir: 输出目录
+        budget: token 预算 (按上下文窗口确定 max_tokens 并记录用量)
+        iteration: 修复迭代序号 (0 为首次审查),结果保存为 step3_review_<iteration>.json
+        checkpoint: 续跑时已保存的步骤结果 (指纹一致时直接复用)
+        code_blocks: 本次审查的代码块 (用于记录各文件的内容哈希)
+        previous: 上一轮的审查结果 (带有 review_cache 时进行增量审查)
 
     Returns:
         审查结果字典
@@ -163,28 +420,117 @@ def review_and_test(client: LLMClient, srs_data: Dict, code_response: str, outpu
     print('步骤 3/5: 代码审查与测试')
     print('='*60)
 
-    prompt_path = 'orchestrator/prompts/codex_review_prompt.txt'
-    prompt = load_prompt(prompt_path)
-    prompt = prompt.replace('{{SRS}}', srs_data['srs'])
-    prompt = prompt.replace('{{CODE_BUNDLE}}', code_response)
+    models = client.models('codex')
+    cache, changed, unchanged = review_scope(code_blocks, previous)
+
+    if unchanged and not changed:
+        # 所有文件与上一轮审查时一致,不需要再次调用模型
+        print('所有文件与上一轮审查时一致,沿用上一轮审查结果')
+        last = {key: previous[key] for key in ('passed', 'results', 'defects', 'tests') if key in previous}
+        review_json = merge_review(last, cache, unchanged, code_blocks)
+        review_json['review_cache'] = cache
+        print(f'审查结果: {"✓ 通过" if review_json.get("passed") else "✗ 未通过"}')
+        save_intermediate_result(dict(review_json, fingerprint=fingerprint('review', json.dumps(cache), models)),
+                                 f'step3_review_{iteration}', output_dir)
+        return review_json
+
+    if unchanged:
+        print(f'增量审查: {len(changed)}/{len(code_blocks)} 个文件有变化,其余文件沿用上一轮结论')
+    template, review_blocks = review_template(srs_data, code_blocks, previous, changed, unchanged)
+
+    # 代码超出分片预算时按模块分片并行审查 (LLM_REVIEW_SHARD_TOKENS)
+    shard_tokens = int(os.getenv('LLM_REVIEW_SHARD_TOKENS', '0'))
+    shards = []
+    if shard_tokens > 0:
+        review_blocks = review_blocks or code_blocks or parse_code_blocks(code_response)
+        shards = split_shards(review_blocks, shard_tokens, models[0] if models else None)
+    if len(shards) > 1:
+        return review_sharded(client, template, shards, output_dir, budget, iteration, checkpoint,
+                              code_blocks, cache if unchanged else None, unchanged)
+
+    prompt = template.replace('{{CODE_BUNDLE}}', code_bundle(review_blocks) if unchanged else code_response)
+
+    step_fingerprint = fingerprint('review', prompt, models, max_tokens=2000)
+    saved = checkpoint.load(f'step3_review_{iteration}', step_fingerprint) if checkpoint else None
+    if saved:
+        print(f'审查结果: {"✓ 通过" if saved.get("passed") else "✗ 未通过"}')
+        return saved
+
+    budget = budget or TokenBudget()
+    max_tokens, entry = budget.plan('review', prompt, 2000, models)
 
     print('正在调用 Codex 进行代码审查...')
-    review_response = client.call_with_retry(client.call_codex, prompt, max_tokens=2000)
+    review_response = client.call_with_retry(client.call_codex, prompt, max_tokens=max_tokens)
+    budget.record(entry, review_response)
 
     # 解析审查结果
     review_json = validate_json_response(review_response)
+    review_json = finish_review(review_json, review_response, code_blocks, cache if unchanged else None, unchanged)
+
+    save_intermediate_result(dict(review_json, continuations=getattr(review_response, 'continuations', 0),
+                                  fingerprint=step_fingerprint),
+                             f'step3_review_{iteration}', output_dir)
+    return review_json
+
+
+def review_scope(code_blocks: Optional[List[Tuple[str, str]]],
+                 previous: Optional[Dict]) -> Tuple[Optional[Dict], Optional[List[str]], List[str]]:
+    """
+    复审范围: 与上一轮审查相比内容变化与未变化的文件 (LLM_REVIEW_INCREMENTAL=false 时不区分)
+
+    Returns:
+        (上一轮的 review_cache, 变化的文件, 未变化的文件);不进行增量审查时未变化的文件为空
+    """
+    cache = (previous or {}).get('review_cache')
+    changed, unchanged = changed_files(cache, code_blocks) if cache and code_blocks else (None, [])
+    if os.getenv('LLM_REVIEW_INCREMENTAL', 'true').lower() == 'false':
+        unchanged = []
+    return cache, changed, unchanged
+
+
+def review_template(srs_data: Dict, code_blocks: Optional[List[Tuple[str, str]]], previous: Optional[Dict],
+                    changed: Optional[List[str]], unchanged: List[str]) -> Tuple[str, Optional[List[Tuple[str, str]]]]:
+    """
+    审查提示词模板 ({{CODE_BUNDLE}} 待填入代码)
+
+    Returns:
+        (模板, 增量审查时要审查的代码块;完整审查时为 None)
+    """
+    if unchanged and changed:
+        template = load_prompt('orchestrator/prompts/codex_incremental_review_prompt.txt')
+        template = template.replace('{{OUTSTANDING_DEFECTS}}',
+                                    json.dumps(previous.get('defects', []), ensure_ascii=False, indent=2))
+        template = template.replace('{{UNCHANGED_FILES}}', '\n'.join(f'- {path}' for path in unchanged))
+        return template, [(p, c) for p, c in code_blocks if p in changed]
+    template = load_prompt('orchestrator/prompts/codex_review_prompt.txt')
+    return template.replace('{{SRS}}', srs_data['srs']), None
+
+
+def finish_review(review_json: Optional[Dict], review_response: str, code_blocks: Optional[List[Tuple[str, str]]],
+                  cache: Optional[Dict] = None, unchanged: Optional[List[str]] = None) -> Dict:
+    """
+    整理审查结果: 增量审查时合并未变化文件的缓存结论,打印结论,并记录各文件的哈希供下一轮复审使用
 
+    Args:
+        review_json: 解析后的审查结果 (无法解析为 None)
+        review_response: 原始响应 (无法解析时放入 results)
+        code_blocks: 本次审查的全部代码块
+        cache: 增量审查时上一轮的 review_cache
+        unchanged: 增量审查时未变化的文件
+    """
     if review_json:
+        if cache:
+            review_json = merge_review(review_json, cache, unchanged, code_blocks)
         passed = review_json.get('passed', False)
-        results = review_json.get('results', [])
         defects = review_json.get('defects', [])
-        tests = review_json.get('tests', {})
 
         print(f'审查结果: {"✓ 通过" if passed else "✗ 未通过"}')
         if defects:
             print(f'发现 {len(defects)} 个缺陷:')
             for i, defect in enumerate(defects, 1):
                 print(f'  {i}. {defect}')
+        if code_blocks:
+            review_json['review_cache'] = build_cache(review_json, code_blocks)
     else:
         print('⚠️  无法解析审查结果为 JSON')
         review_json = {
@@ -193,12 +539,84 @@ def review_and_test(client: LLMClient, srs_data: Dict, code_response: str, outpu
             'defects': ['无法解析审查结果,请查看原始响应'],
             'tests': {}
         }
+    return review_json
+
+
+def review_sharded(client: LLMClient, template: str, shards: List[List[Tuple[str, str]]], output_dir: str,
+                   budget: Optional[TokenBudget], iteration: int, checkpoint: Optional[Checkpoint],
+                   code_blocks: Optional[List[Tuple[str, str]]], cache: Optional[Dict] = None,
+                   unchanged: Optional[List[str]] = None) -> Dict:
+    """
+    分片并行审查,并把各分片结果归并为一份审查结果
+
+    Args:
+        client: LLM 客户端
+        template: 已填入 SRS (或上一轮缺陷) 的审查提示词模板,{{CODE_BUNDLE}} 待填入分片代码
+        shards: split_shards 返回的分片
+        output_dir: 输出目录
+        budget: token 预算
+        iteration: 修复迭代序号
+        checkpoint: 续跑时已保存的步骤结果
+        code_blocks: 本次审查的全部代码块
+        cache: 增量审查时上一轮的 review_cache
+        unchanged: 增量审查时未变化的文件
 
-    save_intermediate_result(review_json, 'step3_review', output_dir)
+    Returns:
+        审查结果字典 (额外带有各分片信息 shards)
+    """
+    all_paths = [path for shard in shards for path, _ in shard]
+    prompts = []
+    for index, shard in enumerate(shards, 1):
+        own = {path for path, _ in shard}
+        note = scope_note(index, len(shards), [path for path in all_paths if path not in own])
+        prompts.append(template.replace('{{CODE_BUNDLE}}', code_bundle(shard) + note))
+
+    models = client.models('codex')
+    step_fingerprint = fingerprint('review', '\n'.join(prompts), models, max_tokens=2000, shards=len(shards))
+    saved = checkpoint.load(f'step3_review_{iteration}', step_fingerprint) if checkpoint else None
+    if saved:
+        print(f'审查结果: {"✓ 通过" if saved.get("passed") else "✗ 未通过"}')
+        return saved
+
+    budget = budget or TokenBudget()
+    concurrency = max(1, int(os.getenv('LLM_REVIEW_CONCURRENCY', '4')))
+    print(f'分片审查: {len(all_paths)} 个文件分为 {len(shards)} 个分片, 并发 {concurrency}')
+
+    def review_shard(index: int) -> Tuple[str, float]:
+        started_at = time.perf_counter()
+        max_tokens, entry = budget.plan('review', prompts[index], 2000, models)
+        response = client.call_with_retry(client.call_codex, prompts[index], max_tokens=max_tokens)
+        budget.record(entry, response)
+        elapsed = time.perf_counter() - started_at
+        print(f'  ✓ 分片 {index + 1}/{len(shards)}: {len(shards[index])} 个文件 ({elapsed:.1f}s)')
+        return response, elapsed
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='review') as pool:
+        outcomes = list(pool.map(review_shard, range(len(shards))))
+    elapsed = time.perf_counter() - started_at
+
+    responses = [response for response, _ in outcomes]
+    reviews = [validate_json_response(response) for response in responses]
+    review_json = finish_review(reduce_reviews(reviews, responses), '', code_blocks, cache, unchanged)
+
+    step_data = dict(review_json, fingerprint=step_fingerprint,
+                     continuations=sum(getattr(r, 'continuations', 0) for r in responses))
+    step_data['shards'] = {
+        'shards': [{'files': [p for p, _ in shard], 'passed': bool(review and review.get('passed')),
+                    'defects': len(review.get('defects', [])) if review else None, 'elapsed': round(t, 3)}
+                   for shard, review, (_, t) in zip(shards, reviews, outcomes)],
+        'concurrency': concurrency,
+        'elapsed': round(elapsed, 3)
+    }
+    save_intermediate_result(step_data, f'step3_review_{iteration}', output_dir)
     return review_json
 
 
-def fix_defects(client: LLMClient, defects: List[str], code_blocks: List[Tuple[str, str]], output_dir: str) -> List[Tuple[str, str]]:
+def fix_defects(client: LLMClient, defects: List[Defect], code_blocks: List[Tuple[str, str]], output_dir: str,
+                stream: bool = False, code_dir: Optional[str] = None,
+                budget: Optional[TokenBudget] = None, iteration: int = 1,
+                checkpoint: Optional[Checkpoint] = None) -> List[Tuple[str, str]]:
     """
     第四步: 使用 Claude 修复缺陷
 
@@ -207,59 +625,697 @@ def fix_defects(client: LLMClient, defects: List[str], code_blocks: List[Tuple[s
         defects: 缺陷列表
         code_blocks: 原始代码块
         output_dir: 输出目录
+        stream: 是否使用流式生成
+        code_dir: 流式模式下修复后的代码块闭合后立即写入的目录
+        budget: token 预算 (按上下文窗口确定 max_tokens 并记录用量)
+        iteration: 修复迭代序号,结果保存为 step4_fix_<iteration>.json
+        checkpoint: 续跑时已保存的步骤结果 (指纹一致时直接复用)
 
     Returns:
-        修复后的代码块
+        修复后的完整代码块 (未涉及缺陷的文件保持原样)
     """
     print('\n' + '='*60)
     print('步骤 4/5: 修复代码缺陷')
     print('='*60)
 
-    # 构建修复提示词
-    code_bundle = '\n\n'.join([
-        f'```\n# path: {path}\n{content}\n```'
-        for path, content in code_blocks
-    ])
+    targets, target_blocks, other_blocks = split_fix_scope(defects, code_blocks)
+
+    # 补丁模式只让模型输出修改部分,本地应用到原文件 (LLM_FIX_FORMAT=patch)
+    patch_mode = os.getenv('LLM_FIX_FORMAT', 'full').lower() == 'patch'
+    fix_prompt = build_fix_prompt(defects, target_blocks, other_blocks, patch=patch_mode)
+
+    models = client.models('claude')
+    step_fingerprint = fingerprint('fix', fix_prompt, models, max_tokens=4000)
+    saved = checkpoint.load(f'step4_fix_{iteration}', step_fingerprint) if checkpoint else None
+    if saved:
+        fixed_blocks = [(b['path'], b['content']) for b in saved['fixed_blocks']]
+        if stream and code_dir:
+            write_files_from_codeblock(fixed_blocks, code_dir)
+        return fixed_blocks
+
+    budget = budget or TokenBudget()
+    max_tokens, entry = budget.plan('fix', fix_prompt, 4000, models)
+
+    timing = None
+    # 补丁模式的响应不是完整文件,流式接收时不边收边写,应用补丁后再写入
+    if stream:
+        print('正在调用 Claude 流式修复缺陷...')
+        result = stream_code_blocks(client, client.stream_claude, fix_prompt, max_tokens,
+                                    None if patch_mode else code_dir)
+        fix_response, fixed_blocks, timing = result.text, result.blocks, result.timing
+        continuations = result.continuations
+    else:
+        print('正在调用 Claude 修复缺陷...')
+        fix_response = client.call_with_retry(client.call_claude, fix_prompt, max_tokens=max_tokens)
+        continuations = getattr(fix_response, 'continuations', 0)
+        fixed_blocks = None if patch_mode else parse_code_blocks(fix_response)
+    budget.record(entry, fix_response)
+
+    patch_report = None
+    if patch_mode:
+        fixed_blocks, patch_report = apply_patch_response(code_blocks, fix_response)
+        print(f'补丁: 已应用 {patch_report["applied"]}/{patch_report["edits"]} 处编辑'
+              f' (模糊匹配 {patch_report["fuzzy"]} 处)')
+
+        # 无法应用补丁的文件回退为请求完整文件
+        failed = [(p, c) for p, c in code_blocks if p in patch_report['failed']]
+        patch_report['fallback_files'] = [p for p, _ in failed]
+        patch_report['fallback_response'] = None
+        if failed:
+            for path, reason in patch_report['failed'].items():
+                print(f'⚠️  {path} 的补丁无法应用 ({reason}),回退为请求完整文件')
+            patched = merge_fixed(code_blocks, fixed_blocks)
+            fallback_prompt = build_fix_prompt(defects, failed,
+                                               [(p, c) for p, c in patched if p not in patch_report['failed']])
+            fallback_tokens, fallback_entry = budget.plan('fix', fallback_prompt, 4000, models)
+            fallback_response = client.call_with_retry(client.call_claude, fallback_prompt,
+                                                       max_tokens=fallback_tokens)
+            budget.record(fallback_entry, fallback_response)
+            patch_report['fallback_response'] = fallback_response
+            fixed_blocks = merge_fixed(fixed_blocks, parse_code_blocks(fallback_response))
+
+        # 输出 token 节省: 实际输出 (含回退请求) 与整文件输出修改过的文件的估算值比较
+        model = models[0] if models else None
+        output_tokens = sum(count_tokens(text, model)[0] for text in
+                            (fix_response, patch_report['fallback_response']) if text)
+        full_tokens = count_tokens(code_bundle(fixed_blocks), model)[0] if fixed_blocks else 0
+        patch_report.update({
+            'output_tokens': output_tokens,
+            'full_output_tokens': full_tokens,
+            'saved_tokens': full_tokens - output_tokens
+        })
+        if full_tokens and full_tokens >= output_tokens:
+            print(f'输出 token: {output_tokens} (整文件输出约 {full_tokens},'
+                  f'节省 {full_tokens - output_tokens},{(full_tokens - output_tokens) / full_tokens:.0%})')
+        elif full_tokens:
+            print(f'输出 token: {output_tokens} (整文件输出约 {full_tokens},补丁未减少输出)')
+
+    if fixed_blocks:
+        print(f'✓ 代码修复完成,共修改 {len(fixed_blocks)} 个文件')
+    else:
+        print('⚠️  未能解析出修复后的代码块,使用原始代码')
+
+    # 修复结果合并回完整文件集,未修改的文件保持原样
+    merged_blocks = merge_fixed(code_blocks, fixed_blocks)
+    if stream and code_dir:
+        written = set() if patch_mode else {normalize_path(p) for p, _ in fixed_blocks}
+        write_files_from_codeblock([(p, c) for p, c in merged_blocks if normalize_path(p) not in written], code_dir)
+
+    step_data = {
+        'fixed_blocks': [{'path': p, 'content': c} for p, c in merged_blocks],
+        'changed_files': [p for p, _ in fixed_blocks],
+        'scope': {'files': targets, 'summarized': [p for p, _ in other_blocks]},
+        'raw_response': fix_response,
+        'continuations': continuations,
+        'fingerprint': step_fingerprint
+    }
+    if patch_report:
+        step_data['patch'] = patch_report
+    if timing:
+        step_data['timing'] = timing
+    save_intermediate_result(step_data, f'step4_fix_{iteration}', output_dir)
+
+    return merged_blocks
+
+
+def split_fix_scope(defects: List[Defect], code_blocks: List[Tuple[str, str]]
+                    ) -> Tuple[List[str], List[Tuple[str, str]], List[Tuple[str, str]]]:
+    """
+    确定修复范围: 只把缺陷涉及的文件交给模型修复,其余文件提供接口摘要 (LLM_FIX_SCOPE=all 时发送全部文件)
+
+    Returns:
+        (需要修复的文件路径, 需要修复的代码块, 其他代码块)
+    """
+    if os.getenv('LLM_FIX_SCOPE', 'implicated').lower() == 'all':
+        targets = [path for path, _ in code_blocks]
+    else:
+        targets = fix_targets(defects, code_blocks)
+    target_blocks = [(p, c) for p, c in code_blocks if p in targets]
+    other_blocks = [(p, c) for p, c in code_blocks if p not in targets]
+    if other_blocks:
+        print(f'修复范围: {len(target_blocks)}/{len(code_blocks)} 个文件 (其余文件以接口摘要提供)')
+    return targets, target_blocks, other_blocks
+
+
+def build_fix_prompt(defects: List[Defect], target_blocks: List[Tuple[str, str]],
+                     other_blocks: List[Tuple[str, str]], patch: bool = False) -> str:
+    """
+    构造修复提示词
+
+    Args:
+        defects: 缺陷列表
+        target_blocks: 需要修复的文件 (完整内容)
+        other_blocks: 其他文件 (只提供接口摘要)
+        patch: 是否要求以 SEARCH/REPLACE 编辑块或 unified diff 输出修改
+    """
+    if other_blocks:
+        summaries = '\n\n'.join(
+            f'- {path}:\n```\n{interface_summary(path, content)}\n```'
+            for path, content in other_blocks
+        )
+        context = f"""需要修复的文件:
+{code_bundle(target_blocks)}
+
+项目中其他文件的接口摘要 (仅供参考,不要输出这些文件):
+{summaries}"""
+        instruction = '请返回修复后的文件 (只输出需要修改的文件,每个文件输出完整内容),保持原有的 path 标记格式。'
+    else:
+        context = f"""当前代码:
+{code_bundle(target_blocks)}"""
+        instruction = '请返回修复后的完整代码,保持原有的 path 标记格式。'
+    if patch:
+        instruction = '请只返回需要修改的部分。\n' + PATCH_FORMAT_NOTE
 
-    fix_prompt = f"""请修复以下代码中的缺陷:
+    return f"""请修复以下代码中的缺陷:
 
 缺陷列表:
 {json.dumps(defects, ensure_ascii=False, indent=2)}
 
-当前代码:
-{code_bundle}
+{context}
 
-请返回修复后的完整代码,保持原有的 path 标记格式。
+{instruction}
 """
 
-    print('正在调用 Claude 修复缺陷...')
-    fix_response = client.call_with_retry(client.call_claude, fix_prompt, max_tokens=4000)
 
-    # 解析修复后的代码
-    fixed_blocks = parse_code_blocks(fix_response)
+class PipelineContext:
+    """一次流水线运行的共享状态,由各阶段读写 (阶段返回值保存在 results 中)"""
+
+    def __init__(self, client: LLMClient, requirement: str, output_dir: str, budget: TokenBudget,
+                 max_fix_iterations: int = 2, stream: bool = False, fanout: Optional[bool] = None,
+                 checkpoint: Optional[Checkpoint] = None):
+        self.client = client
+        self.requirement = requirement
+        self.output_dir = output_dir
+        self.budget = budget
+        self.max_fix_iterations = max_fix_iterations
+        self.stream = stream
+        self.fanout = fanout
+        self.checkpoint = checkpoint
+        self.code_dir = os.path.join(output_dir, 'generated_code')
+        self.final_code_dir = self.code_dir
+        self.results: Dict[str, object] = {}
+        self.scheduler: Optional[StageScheduler] = None
+        self.srs_data: Dict = {}
+        self.code_blocks: List[Tuple[str, str]] = []
+        self.review_result: Dict = {}
+        # 并行修复候选以 review 方式验证时,采用的候选的审查结果 (复审阶段直接沿用)
+        self.candidate_reviews: Dict[int, Dict] = {}
+        self.iteration = 0
+        # 修复循环的收敛跟踪 (无进展 / 振荡 / 时间与 token 预算)
+        self.convergence = FixLoopTracker.from_env(max_fix_iterations)
+        self.started_at = time.perf_counter()
+
+
+def code_bundle(code_blocks: List[Tuple[str, str]]) -> str:
+    """把代码块拼接为带 path 标记的代码包 (用于审查提示词)"""
+    return '\n\n'.join([
+        f'```\n# path: {path}\n{content}\n```'
+        for path, content in code_blocks
+    ])
 
-    if fixed_blocks:
-        print(f'✓ 代码修复完成,共 {len(fixed_blocks)} 个文件')
+
+def srs_stage(ctx: PipelineContext) -> Dict:
+    """步骤 1: 生成 SRS"""
+    ctx.srs_data = generate_srs(ctx.client, ctx.requirement, ctx.output_dir, budget=ctx.budget,
+                                checkpoint=ctx.checkpoint)
+    return ctx.srs_data
+
+
+def code_stage(ctx: PipelineContext) -> str:
+    """步骤 2: 生成代码 (流式模式下代码块闭合即写入文件)"""
+    code_response, code_blocks = generate_code(ctx.client, ctx.srs_data, ctx.output_dir, stream=ctx.stream,
+                                               code_dir=ctx.code_dir, budget=ctx.budget, fanout=ctx.fanout,
+                                               checkpoint=ctx.checkpoint)
+    if not code_blocks:
+        raise PipelineAbort('未生成任何代码')
+    ctx.code_blocks = code_blocks
+    return code_response
+
+
+def write_stage(ctx: PipelineContext) -> List[str]:
+    """写入生成的代码 (审查只需要代码文本;未启用静态检查时与审查并行执行,启用时静态检查在写入之后、审查之前)"""
+    if ctx.stream:
+        print(f'\n✓ 已在流式生成过程中写入 {len(ctx.code_blocks)} 个文件')
+        return []
+    print('\n正在将代码写入文件系统...')
+    created_files = write_files_from_codeblock(ctx.code_blocks, ctx.code_dir)
+    print(f'✓ 已创建 {len(created_files)} 个文件')
+    return created_files
+
+
+def git_init_stage(ctx: PipelineContext) -> bool:
+    """在审查进行的同时初始化代码目录的 Git 仓库"""
+    return init_git_repo(ctx.code_dir)
+
+
+def gate_stage(ctx: PipelineContext, code_blocks: List[Tuple[str, str]], code_dir: str,
+               iteration: int = 0) -> Optional[Dict]:
+    """审查前对已写入的文件进行本地静态检查 (PIPELINE_STATIC_GATE=false 时不加入依赖图)"""
+    report = run_static_gate(code_dir, [path for path, _ in code_blocks])
+    if report['passed']:
+        print(f'✓ 本地静态检查通过: {report["checked"]} 个文件 ({report["elapsed"]:.2f}s)')
     else:
-        print('⚠️  未能解析出修复后的代码块,使用原始代码')
-        fixed_blocks = code_blocks
+        print(f'✗ 本地静态检查发现 {len(report["defects"])} 个错误 ({report["checked"]} 个文件, '
+              f'{report["elapsed"]:.2f}s)')
+    save_intermediate_result(report, f'static_gate_{iteration}', ctx.output_dir)
+    return report
+
+
+def review_stage(ctx: PipelineContext, code_blocks: List[Tuple[str, str]], code_response: str,
+                 iteration: int = 0) -> Dict:
+    """
+    步骤 3: 审查和测试
+
+    本地静态检查发现硬性错误时跳过 LLM 审查,直接把这些错误作为缺陷交给修复步骤。
+    启用本地测试时派生 verify 阶段,否则直接决定是否进入下一轮修复;复审只审查内容变化的文件。
+    """
+    gate = ctx.results.get(f'gate_fix_{iteration}' if iteration else 'gate')
+    if gate and not gate['passed']:
+        print('\n' + '='*60)
+        print('步骤 3/5: 代码审查与测试')
+        print('='*60)
+        print('✗ 本地静态检查未通过,跳过 LLM 审查:')
+        for i, defect in enumerate(gate['defects'], 1):
+            print(f'  {i}. {defect["file"]}: {defect["description"]}')
+        review_result = {
+            'passed': False,
+            'results': [f'本地静态检查发现 {len(gate["defects"])} 个错误,未进行 LLM 审查'],
+            'defects': gate['defects'],
+            'tests': {},
+            'static_gate': True
+        }
+    elif iteration in ctx.candidate_reviews:
+        review_result = ctx.candidate_reviews.pop(iteration)
+        save_intermediate_result(review_result, f'step3_review_{iteration}', ctx.output_dir)
+        print(f'\n✓ 沿用修复候选验证时的审查结果: {"✓ 通过" if review_result.get("passed") else "✗ 未通过"}')
+    else:
+        review_result = review_and_test(ctx.client, ctx.srs_data, code_response, ctx.output_dir,
+                                        budget=ctx.budget, iteration=iteration, checkpoint=ctx.checkpoint,
+                                        code_blocks=code_blocks, previous=ctx.review_result if iteration else None)
+    ctx.review_result = review_result
+
+    # 本地运行测试后再决定是否进入下一轮修复 (PIPELINE_RUN_TESTS=true)
+    if os.getenv('PIPELINE_RUN_TESTS', 'false').lower() == 'true' and not review_result.get('static_gate'):
+        ctx.scheduler.spawn(Stage(f'verify_fix_{iteration}' if iteration else 'verify',
+                                  lambda c: verify_stage(c, code_blocks, iteration), kind='verify'))
+        return review_result
+    next_round(ctx, review_result)
+    return review_result
+
+
+def verify_stage(ctx: PipelineContext, code_blocks: List[Tuple[str, str]], iteration: int = 0) -> Dict:
+    """
+    本地运行审查生成的测试与代码中的测试 (独立工作目录、受限子进程、并行)
+
+    失败的测试及其回溯作为缺陷并入审查结果,交给修复步骤。
+    """
+    work_dir = os.path.join(ctx.output_dir, 'test_runs', f'iteration_{iteration}')
+    report = verify(code_blocks, ctx.review_result.get('tests') or {}, work_dir)
+    if report['skipped']:
+        print(f'⚠️  跳过本地测试: {report["skipped"]}')
+    else:
+        failed = [r['file'] for r in report['results'] if r['status'] in ('failed', 'error', 'timeout')]
+        icon = '✗' if failed else '✓'
+        print(f'{icon} 本地测试: {len(report["results"]) - len(failed)}/{len(report["results"])} 个测试文件通过 '
+              f'({report["elapsed"]:.1f}s)')
+        for path in failed:
+            print(f'  ✗ {path}')
+    save_intermediate_result(report, f'test_run_{iteration}', ctx.output_dir)
+
+    review_result = dict(ctx.review_result, test_run={k: report[k] for k in ('passed', 'skipped', 'results')})
+    if report['defects']:
+        review_result['passed'] = False
+        review_result['defects'] = list(review_result.get('defects', [])) + report['defects']
+    ctx.review_result = review_result
+    next_round(ctx, review_result)
+    return report
+
+
+def next_round(ctx: PipelineContext, review_result: Dict):
+    """
+    判断是否值得再修复一轮 (见 convergence.FixLoopTracker),是则派生下一轮的修复、写入、静态检查与复审阶段
+
+    停止原因与各轮的代码 / 缺陷指纹保存在 fix_loop.json。
+    """
+    total = ctx.budget.report()['total']
+    proceed, reason = ctx.convergence.observe(ctx.iteration, ctx.code_blocks, review_result,
+                                              time.perf_counter() - ctx.started_at,
+                                              total['prompt_tokens'] + total['completion_tokens'])
+    save_intermediate_result(ctx.convergence.report(), 'fix_loop', ctx.output_dir)
+    if not proceed:
+        if reason not in ('passed', 'max_iterations'):
+            print(f'停止修复: {STOP_REASONS[reason]}')
+        return
+
+    defects = review_result.get('defects', [])
+    ctx.iteration += 1
+    n = ctx.iteration
+    print(f'\n修复迭代 {n}/{ctx.max_fix_iterations}')
+    ctx.scheduler.spawn(Stage(f'fix_{n}', lambda c: fix_stage(c, n, defects), kind='fix', limit=1))
+    ctx.scheduler.spawn(Stage(f'write_fix_{n}', lambda c: write_fix_stage(c, n),
+                              deps=[f'fix_{n}'], kind='write'))
+    review_deps = [f'fix_{n}']
+    if gate_enabled():
+        code_dir_fixed = os.path.join(ctx.output_dir, f'generated_code_fixed_{n}')
+        ctx.scheduler.spawn(Stage(f'gate_fix_{n}',
+                                  lambda c: gate_stage(c, c.results[f'fix_{n}'], code_dir_fixed, n),
+                                  deps=[f'write_fix_{n}'], kind='gate'))
+        review_deps.append(f'gate_fix_{n}')
+    ctx.scheduler.spawn(Stage(f'review_fix_{n}',
+                              lambda c: review_stage(c, c.results[f'fix_{n}'], code_bundle(c.results[f'fix_{n}']), n),
+                              deps=review_deps, kind='review'))
+
+
+def fix_stage(ctx: PipelineContext, iteration: int, defects: List[Defect]) -> List[Tuple[str, str]]:
+    """步骤 4: 修复缺陷 (流式模式下修复后的代码块闭合即写入文件;LLM_FIX_CANDIDATES > 1 时并行生成多个候选)"""
+    code_dir_fixed = os.path.join(ctx.output_dir, f'generated_code_fixed_{iteration}')
+    variants = variants_from_env()
+    fixed_blocks = race_fix_candidates(ctx, iteration, defects, variants) if variants else None
+    if fixed_blocks is None:
+        fixed_blocks = fix_defects(ctx.client, defects, ctx.code_blocks, ctx.output_dir, stream=ctx.stream,
+                                   code_dir=code_dir_fixed, budget=ctx.budget, iteration=iteration,
+                                   checkpoint=ctx.checkpoint)
+    elif ctx.stream:
+        # 流式模式下 write_fix 阶段不写文件
+        write_files_from_codeblock(fixed_blocks, code_dir_fixed)
+    ctx.code_blocks = fixed_blocks
+    ctx.final_code_dir = code_dir_fixed
+    return ctx.code_blocks
+
+
+def race_fix_candidates(ctx: PipelineContext, iteration: int, defects: List[Defect],
+                        variants: List[Dict]) -> Optional[List[Tuple[str, str]]]:
+    """
+    步骤 4 (并行候选): 以不同温度 / 模型同时生成多个修复,各自在独立目录中验证,采用最先通过验证的候选
+
+    候选流式生成,有候选通过验证后其余候选立即断开连接;候选之间互为冗余,不单独重试。
+    所有候选的调用 (含 review 验证) 按最坏情况预留 token,总花费不超过 LLM_FIX_CANDIDATE_MAX_TOKENS。
+    没有候选通过时采用缺陷最少的候选。
+
+    Args:
+        ctx: 流水线上下文
+        iteration: 修复迭代序号,结果保存为 step4_fix_<iteration>.json (candidates 字段记录各候选)
+        defects: 缺陷列表
+        variants: 各候选的温度与模型 (fix_candidates.variants_from_env)
 
-    save_intermediate_result({
-        'fixed_blocks': [{'path': p, 'content': c} for p, c in fixed_blocks],
-        'raw_response': fix_response
-    }, 'step4_fix', output_dir)
+    Returns:
+        修复后的完整代码块;没有候选生成出代码时返回 None (回退为普通修复)
+    """
+    print('\n' + '='*60)
+    print(f'步骤 4/5: 修复代码缺陷 ({len(variants)} 个并行候选)')
+    print('='*60)
+
+    targets, target_blocks, other_blocks = split_fix_scope(defects, ctx.code_blocks)
+    patch_mode = os.getenv('LLM_FIX_FORMAT', 'full').lower() == 'patch'
+    fix_prompt = build_fix_prompt(defects, target_blocks, other_blocks, patch=patch_mode)
+    validate_mode = os.getenv('LLM_FIX_CANDIDATE_VALIDATE', 'local').lower()
+
+    step_fingerprint = fingerprint('fix', fix_prompt, ctx.client.models('claude'), max_tokens=4000,
+                                   candidates=variants, validate=validate_mode)
+    saved = ctx.checkpoint.load(f'step4_fix_{iteration}', step_fingerprint) if ctx.checkpoint else None
+    if saved:
+        return [(b['path'], b['content']) for b in saved['fixed_blocks']]
+
+    meter = SpendMeter(int(os.getenv('LLM_FIX_CANDIDATE_MAX_TOKENS', '0')))
+    candidates_dir = os.path.join(ctx.output_dir, 'fix_candidates', f'iteration_{iteration}')
+    outputs: Dict[int, Dict] = {}
+
+    def run(index: int, cancel) -> Dict:
+        variant = variants[index]
+        # 预留按单次调用计算,候选不续写 (续写会再次发送提示词与已生成的文本)
+        client = ctx.client.variant(**variant)
+        client.max_continuations = 0
+        models = client.models('claude')
+        model = models[0] if models else None
+        max_tokens, entry = ctx.budget.plan('fix', fix_prompt, 4000, models)
+        cost = call_cost(fix_prompt, max_tokens, model)
+        if not meter.reserve(cost):
+            return {'status': 'skipped', 'reason': '超出候选花费上限'}
+
+        prompt_tokens = cost - max_tokens
+        try:
+            response = consume(client.stream_claude(fix_prompt, max_tokens=max_tokens), cancel)
+        except CandidateCancelled as e:
+            meter.settle(cost, prompt_tokens + count_tokens(e.partial, model)[0])
+            ctx.budget.record(entry, e.partial)
+            raise
+        except Exception:
+            meter.settle(cost, cost)
+            raise
+        meter.settle(cost, prompt_tokens + count_tokens(response, model)[0])
+        ctx.budget.record(entry, response)
+
+        if patch_mode:
+            fixed, patch_report = apply_patch_response(ctx.code_blocks, response)
+        else:
+            fixed = [(m.group(1).strip(), m.group(2).strip()) for m in CODE_BLOCK_PATTERN.finditer(response)]
+            patch_report = None
+        if not fixed:
+            return {'passed': False, 'reason': '未能解析出修复后的代码块'}
+        merged = merge_fixed(ctx.code_blocks, fixed)
+        outputs[index] = {'blocks': merged, 'response': response, 'changed_files': [p for p, _ in fixed],
+                          'patch': patch_report}
+        if cancel.is_set():
+            raise CandidateCancelled()
+
+        verdict = validate_candidate(ctx, merged, os.path.join(candidates_dir, f'candidate_{index}'), iteration,
+                                     cancel, meter, validate_mode)
+        if cancel.is_set():
+            raise CandidateCancelled()
+        label = f'候选 {index + 1} (温度 {variant["temperature"]}' + \
+            (f', 模型 {variant["model"]})' if variant['model'] else ')')
+        if verdict.get('status') == 'skipped':
+            print(f'⚠️  {label} 未复审: {verdict["reason"]}')
+        elif verdict['passed']:
+            print(f'✓ {label} 通过验证')
+        else:
+            print(f'✗ {label} 未通过验证: {len(verdict["defects"])} 个缺陷')
+        return verdict
+
+    winner, records = race(len(variants), run)
+
+    chosen = winner
+    if chosen is None:
+        failed = [r for r in records if r['status'] in ('failed', 'skipped') and r['index'] in outputs]
+        if not failed:
+            print('⚠️  没有候选生成出修复代码,回退为普通修复')
+            return None
+        chosen = min(failed, key=lambda r: len(r.get('defects', [])))['index']
+        print(f'⚠️  没有候选通过验证,采用缺陷最少的候选 {chosen + 1}')
+    else:
+        print(f'✓ 采用候选 {winner + 1},其余候选已取消')
+        if records[winner].get('review'):
+            ctx.candidate_reviews[iteration] = records[winner]['review']
+
+    output = outputs[chosen]
+    step_data = {
+        'fixed_blocks': [{'path': p, 'content': c} for p, c in output['blocks']],
+        'changed_files': output['changed_files'],
+        'scope': {'files': targets, 'summarized': [p for p, _ in other_blocks]},
+        'raw_response': output['response'],
+        'candidates': [dict(variants[r['index']], **{k: len(v) if k == 'defects' else v for k, v in r.items()
+                                                   if k not in ('passed', 'review')}) for r in records],
+        'chosen': chosen,
+        'passed': winner is not None,
+        'spend': {'cap': meter.cap, 'spent': meter.spent},
+        'fingerprint': step_fingerprint
+    }
+    if output['patch']:
+        step_data['patch'] = output['patch']
+    save_intermediate_result(step_data, f'step4_fix_{iteration}', ctx.output_dir)
+    return output['blocks']
 
-    return fixed_blocks
 
+def validate_candidate(ctx: PipelineContext, code_blocks: List[Tuple[str, str]], work_dir: str, iteration: int,
+                       cancel, meter: SpendMeter, mode: str = 'local') -> Dict:
+    """
+    验证一个修复候选: 本地静态检查、本地测试 (PIPELINE_RUN_TESTS=true 时),mode 为 review 时再进行 LLM 复审
 
-def main(requirement: str, max_fix_iterations: int = 2):
+    Returns:
+        {'passed', 'defects', 'checks': 已完成的检查} (review 模式下带有 review 字段)
+    """
+    code_dir = os.path.join(work_dir, 'code')
+    materialize(code_blocks, {}, code_dir)
+    checks = []
+    if gate_enabled():
+        gate = run_static_gate(code_dir, [path for path, _ in code_blocks])
+        checks.append('gate')
+        if not gate['passed']:
+            return {'passed': False, 'defects': gate['defects'], 'checks': checks}
+
+    if os.getenv('PIPELINE_RUN_TESTS', 'false').lower() == 'true':
+        if cancel.is_set():
+            raise CandidateCancelled()
+        report = verify(code_blocks, ctx.review_result.get('tests') or {}, os.path.join(work_dir, 'tests'))
+        checks.append('tests')
+        if report['defects']:
+            return {'passed': False, 'defects': report['defects'], 'checks': checks}
+
+    if mode != 'review':
+        return {'passed': True, 'defects': [], 'checks': checks}
+
+    if cancel.is_set():
+        raise CandidateCancelled()
+    # 按实际发送的提示词预留花费;与修复候选一样不续写,且不对冲,单次调用的花费不会超过预留
+    client = ctx.client.variant()
+    client.max_continuations = 0
+    models = client.models('codex')
+    model = models[0] if models else None
+    cache, changed, unchanged = review_scope(code_blocks, ctx.review_result)
+    template, review_blocks = review_template(ctx.srs_data, code_blocks, ctx.review_result, changed, unchanged)
+    prompt = template.replace('{{CODE_BUNDLE}}', code_bundle(review_blocks or code_blocks))
+    max_tokens, entry = ctx.budget.plan('review', prompt, 2000, models)
+    cost = call_cost(prompt, max_tokens, model)
+    if not meter.reserve(cost):
+        return {'status': 'skipped', 'passed': False, 'reason': '超出候选花费上限', 'defects': [], 'checks': checks}
+
+    try:
+        response = client.call_with_retry(client.call_codex, prompt, max_tokens=max_tokens, hedge=False)
+    except Exception:
+        meter.settle(cost, cost)
+        raise
+    meter.settle(cost, cost - max_tokens + count_tokens(response, model)[0])
+    ctx.budget.record(entry, response)
+    review = finish_review(validate_json_response(response), response, code_blocks,
+                           cache if review_blocks else None, unchanged)
+    save_intermediate_result(review, f'step3_review_{iteration}', work_dir)
+    checks.append('review')
+    return {'passed': bool(review.get('passed')), 'defects': review.get('defects', []), 'checks': checks,
+            'review': review}
+
+
+def write_fix_stage(ctx: PipelineContext, iteration: int) -> List[str]:
+    """写入修复后的代码 (未启用静态检查时与复审并行执行,启用时静态检查在写入之后、复审之前)"""
+    if ctx.stream:
+        return []
+    code_dir_fixed = os.path.join(ctx.output_dir, f'generated_code_fixed_{iteration}')
+    return write_files_from_codeblock(ctx.results[f'fix_{iteration}'], code_dir_fixed)
+
+
+def decide_stage(ctx: PipelineContext) -> bool:
+    """步骤 5: 最终决策"""
+    print('\n' + '='*60)
+    print('步骤 5/5: 最终决策')
+    print('='*60)
+
+    review_result = ctx.review_result
+    if review_result.get('passed'):
+        print('✓ 代码通过审查!')
+        if os.getenv('AUTO_GIT_COMMIT', 'false').lower() != 'true':
+            print('\n提示: 设置环境变量 AUTO_GIT_COMMIT=true 可自动提交代码')
+        return True
+
+    print('✗ 代码审查未通过')
+    if ctx.convergence.reason and ctx.convergence.reason != 'passed':
+        print(f'修复循环停止原因: {STOP_REASONS[ctx.convergence.reason]}')
+    print('缺陷列表:')
+    for i, defect in enumerate(review_result.get('defects', []), 1):
+        print(f'  {i}. {defect}')
+    print('\n建议: 检查输出目录中的中间结果,手动修复问题')
+    return False
+
+
+def git_stage(ctx: PipelineContext) -> bool:
+    """审查通过后提交到 Git (AUTO_GIT_COMMIT=true 时)"""
+    if not ctx.results.get('decide'):
+        return False
+    print('\n正在提交到 Git...')
+    if not init_git_repo(ctx.final_code_dir):
+        return False
+    success = commit_and_push(
+        ctx.final_code_dir,
+        'ai-generated',
+        f'AI generated code - {ctx.requirement[:50]}',
+        create_branch=True
+    )
+    if success:
+        print('✓ 代码已提交到分支 ai-generated')
+    else:
+        print('⚠️  提交失败,请手动操作')
+    return success
+
+
+def default_stages() -> List[Stage]:
+    """
+    内置阶段依赖图
+
+    srs → code → write → gate → review (→ fix_N → write_fix_N → gate_fix_N → review_fix_N ...) → decide → git
+
+    gate 为审查前的本地静态检查,发现硬性错误时 review 不调用 LLM,直接进入修复;
+    PIPELINE_STATIC_GATE=false 时没有 gate 阶段,review 只依赖 code,与 write 并行执行;
+    PIPELINE_RUN_TESTS=true 时每次审查后派生 verify (本地运行测试),由它决定是否进入下一轮修复
+    """
+    stages = [
+        Stage('srs', srs_stage),
+        Stage('code', code_stage, deps=['srs']),
+        Stage('write', write_stage, deps=['code'], kind='write'),
+        Stage('review', lambda ctx: review_stage(ctx, ctx.code_blocks, ctx.results['code']),
+              deps=['code', 'gate'] if gate_enabled() else ['code'], kind='review'),
+        Stage('decide', decide_stage, deps=['write', 'review']),
+    ]
+    if gate_enabled():
+        stages.insert(3, Stage('gate', lambda ctx: gate_stage(ctx, ctx.code_blocks, ctx.code_dir), deps=['write'],
+                               kind='gate'))
+    if os.getenv('AUTO_GIT_COMMIT', 'false').lower() == 'true':
+        stages.append(Stage('git_init', git_init_stage, deps=['write'], kind='git', required=False))
+        stages.append(Stage('git', git_stage, deps=['decide', 'git_init'], kind='git', required=False))
+    return stages
+
+
+def main(requirement: Optional[str], max_fix_iterations: Optional[int] = None, stream: Optional[bool] = None,
+         fanout: Optional[bool] = None, output_dir: Optional[str] = None,
+         output_root: Optional[str] = None, resume: Optional[str] = None,
+         from_step: Optional[str] = None, client: Optional[LLMClient] = None,
+         on_event: Optional[Callable[[Dict], None]] = None, stop: Optional[threading.Event] = None) -> Dict:
     """
     主流程编排
 
+    各阶段由 StageScheduler 按依赖图调度,PIPELINE_PLUGINS 中注册的阶段
+    (scheduler.register_stage) 会加入依赖图或替换同名的内置阶段。
+
+    续跑 (resume) 时在原运行目录中继续:提示词与配置指纹一致的步骤结果直接复用,
+    从第一个未完成或已变化的步骤开始重新执行。
+
     Args:
-        requirement: 用户需求描述
-        max_fix_iterations: 最大修复迭代次数
+        requirement: 用户需求描述 (续跑时为空则使用原运行的需求)
+        max_fix_iterations: 最大修复迭代次数,为空时为 2 (续跑时沿用原运行的设置)
+        stream: 是否流式生成代码 (边生成边写文件),为空时读取 LLM_STREAM 环境变量
+        fanout: 是否按任务分组并行生成代码,为空时读取 LLM_CODEGEN_FANOUT 环境变量
+        output_dir: 本次运行的输出目录,为空时在输出根目录下新建 runs/<run ID>/
+        output_root: 输出根目录,为空时读取 PIPELINE_OUTPUT_ROOT 环境变量 (默认为系统临时目录下的 ai_pipeline_output)
+        resume: 要续跑的运行目录
+        from_step: 续跑时从该步骤起重新执行 (srs / code / review / fix,或 review_<n> / fix_<n>)
+        client: 复用的 LLM 客户端 (服务模式中常驻),为空时按 LLM_PROVIDER 新建
+        on_event: 进度事件回调 (run_started / stage_started / stage_finished / run_finished)
+        stop: 中止信号 (任务队列中 worker 的租约被回收时设置),设置后不再启动新的阶段,
+              运行目录已由其他 worker 接管,不再写入阶段耗时、token 报告与运行信息
+
+    Returns:
+        运行结果 {run_id, output_dir, status: passed / failed / aborted / error, passed, iterations, files,
+        prompt_tokens, completion_tokens, llm_calls, reused_steps, stop_reason (修复循环停止原因), error}
     """
+    previous: Dict = {}
+    checkpoint = None
+    if resume:
+        previous = read_run_info(resume)
+        if not previous:
+            raise FileNotFoundError(f'不是有效的运行目录 (缺少 {RUN_INFO_FILE}): {resume}')
+        requirement = requirement or previous['requirement']
+        options = previous.get('options', {})
+        stream = options.get('stream') if stream is None else stream
+        fanout = options.get('fanout') if fanout is None else fanout
+        if max_fix_iterations is None:
+            max_fix_iterations = options.get('max_fix_iterations')
+        output_dir = resume
+        checkpoint = Checkpoint(resume, from_step)
+    elif from_step:
+        raise ValueError('--from-step 需要与 --resume 一起使用')
+
+    if stream is None:
+        stream = os.getenv('LLM_STREAM', 'false').lower() == 'true'
+    if max_fix_iterations is None:
+        max_fix_iterations = 2
+
     print('\n' + '='*60)
     print('AI 自动化代码流水线启动')
     print('='*60)
@@ -268,114 +1324,226 @@ def main(requirement: str, max_fix_iterations: int = 2):
 
     # 初始化
     provider = os.getenv('LLM_PROVIDER', 'openai')
-    client = LLMClient(provider=provider)
+    client = client or LLMClient(provider=provider)
+    emit = on_event or (lambda event: None)
 
-    # 创建输出目录
-    output_dir = os.path.join(tempfile.gettempdir(), 'ai_pipeline_output')
-    os.makedirs(output_dir, exist_ok=True)
+    # 每次运行使用独立的输出目录,并发运行互不覆盖
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+        run_id = os.path.basename(os.path.normpath(output_dir))
+    else:
+        run_id, output_dir = create_run_dir(output_root)
+    print(f'Run ID: {run_id}')
     print(f'输出目录: {output_dir}')
 
-    try:
-        # 步骤 1: 生成 SRS
-        srs_data = generate_srs(client, requirement, output_dir)
-
-        # 步骤 2: 生成代码
-        code_response, code_blocks = generate_code(client, srs_data, output_dir)
+    run_info = dict(previous, **{
+        'run_id': run_id,
+        'requirement': requirement,
+        'status': 'running',
+        'started_at': previous.get('started_at', time.strftime('%Y-%m-%dT%H:%M:%S')),
+        'options': {'provider': provider, 'max_fix_iterations': max_fix_iterations,
+                    'stream': stream, 'fanout': fanout}
+    })
+    if resume:
+        print(f'续跑: {resume}' + (f' (从 {from_step} 起重新执行)' if from_step else ''))
+        run_info['resumes'] = previous.get('resumes', []) + [
+            {'at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'from_step': from_step}
+        ]
+    write_run_info(output_dir, run_info)
+    emit({'event': 'run_started', 'run_id': run_id, 'output_dir': output_dir})
+
+    # 本次运行的 token 预算与用量报告
+    budget = TokenBudget()
+    ctx = PipelineContext(client, requirement, output_dir, budget, max_fix_iterations=max_fix_iterations,
+                          stream=stream, fanout=fanout, checkpoint=checkpoint)
+    status, error = 'error', None
 
-        if not code_blocks:
-            print('\n✗ 流水线失败: 未生成任何代码')
-            return
-
-        # 写入文件
-        print('\n正在将代码写入文件系统...')
-        code_dir = os.path.join(output_dir, 'generated_code')
-        created_files = write_files_from_codeblock(code_blocks, code_dir)
-        print(f'✓ 已创建 {len(created_files)} 个文件')
-
-        # 步骤 3: 审查和测试
-        review_result = review_and_test(client, srs_data, code_response, output_dir)
-
-        # 步骤 4 & 5: 修复循环
-        iteration = 0
-        while not review_result.get('passed') and iteration < max_fix_iterations:
-            iteration += 1
-            print(f'\n修复迭代 {iteration}/{max_fix_iterations}')
-
-            defects = review_result.get('defects', [])
-            if not defects:
-                print('没有具体的缺陷信息,停止修复')
-                break
-
-            # 修复代码
-            code_blocks = fix_defects(client, defects, code_blocks, output_dir)
-
-            # 更新文件
-            code_dir_fixed = os.path.join(output_dir, f'generated_code_fixed_{iteration}')
-            created_files = write_files_from_codeblock(code_blocks, code_dir_fixed)
-
-            # 重新审查
-            code_response_fixed = '\n\n'.join([
-                f'```\n# path: {path}\n{content}\n```'
-                for path, content in code_blocks
-            ])
-            review_result = review_and_test(client, srs_data, code_response_fixed, output_dir)
-
-        # 最终决策
-        print('\n' + '='*60)
-        print('步骤 5/5: 最终决策')
-        print('='*60)
-
-        if review_result.get('passed'):
-            print('✓ 代码通过审查!')
-
-            # 可选: 提交到 Git
-            if os.getenv('AUTO_GIT_COMMIT', 'false').lower() == 'true':
-                print('\n正在提交到 Git...')
-                final_code_dir = os.path.join(output_dir, f'generated_code_fixed_{iteration}' if iteration > 0 else 'generated_code')
-
-                if init_git_repo(final_code_dir):
-                    success = commit_and_push(
-                        final_code_dir,
-                        'ai-generated',
-                        f'AI generated code - {requirement[:50]}',
-                        create_branch=True
-                    )
-                    if success:
-                        print('✓ 代码已提交到分支 ai-generated')
-                    else:
-                        print('⚠️  提交失败,请手动操作')
-            else:
-                print('\n提示: 设置环境变量 AUTO_GIT_COMMIT=true 可自动提交代码')
-        else:
-            print('✗ 代码审查未通过')
-            print('缺陷列表:')
-            for i, defect in enumerate(review_result.get('defects', []), 1):
-                print(f'  {i}. {defect}')
-            print('\n建议: 检查输出目录中的中间结果,手动修复问题')
+    try:
+        stages = {stage.name: stage for stage in default_stages()}
+        stages.update({stage.name: stage for stage in registered_stages()})
+        scheduler = StageScheduler(listener=on_event, stop=stop)
+        for stage in stages.values():
+            scheduler.add(stage)
+
+        try:
+            scheduler.run(ctx)
+        finally:
+            print('\n阶段耗时:')
+            print(scheduler.format_timeline())
+            if not (stop and stop.is_set()):
+                save_intermediate_result({'stages': scheduler.timeline(), 'elapsed': scheduler.elapsed},
+                                         'stage_timing', output_dir)
+
+        print('\nToken 用量 (估算):')
+        print(budget.format())
+        save_intermediate_result(budget.report(), 'token_report', output_dir)
+
+        cache_stats = client.cache_stats()
+        if cache_stats:
+            print(f'LLM 缓存: 命中 {cache_stats["hits"]} / 未命中 {cache_stats["misses"]} '
+                  f'(命中率 {cache_stats["hit_rate"]:.0%}, {cache_stats["entries"]} 条)')
+
+        retry_stats = client.retry_stats()
+        if retry_stats['retries'] or retry_stats['hedged']:
+            print(f'LLM 重试: {retry_stats["retries"]} 次, 对冲请求 {retry_stats["hedged"]} 次 '
+                  f'(对冲胜出 {retry_stats["hedge_wins"]} 次)')
+
+        router_stats = client.router_stats()
+        if router_stats:
+            for name, stats in router_stats.items():
+                print(f'LLM 端点 {name}: {stats["requests"]} 次请求, {stats["errors"]} 次失败, '
+                      f'延迟 {stats["latency_ewma"] if stats["latency_ewma"] is not None else "-"}s')
 
         print(f'\n所有输出已保存至: {output_dir}')
+        status = 'passed' if ctx.review_result.get('passed') else 'failed'
+
+    except PipelineAbort as e:
+        print(f'\n✗ 流水线失败: {str(e)}')
+        status, error = 'aborted', str(e)
 
     except Exception as e:
         print(f'\n✗ 流水线执行失败: {str(e)}')
         import traceback
         traceback.print_exc()
+        status, error = 'error', str(e)
+
+    total = budget.report()['total']
+    outcome = {
+        'run_id': run_id,
+        'output_dir': output_dir,
+        'status': status,
+        'passed': status == 'passed',
+        'iterations': ctx.iteration,
+        'files': len(ctx.code_blocks),
+        'prompt_tokens': total['prompt_tokens'],
+        'completion_tokens': total['completion_tokens'],
+        'llm_calls': total['calls'],
+        'reused_steps': checkpoint.reused if checkpoint else [],
+        'stop_reason': ctx.convergence.reason,
+        'error': error
+    }
+    if not (stop and stop.is_set()):
+        write_run_info(output_dir, dict(run_info, status=status, finished_at=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                        outcome=outcome))
+    emit(dict(outcome, event='run_finished'))
+    return outcome
 
 
 if __name__ == '__main__':
+    import sys
+
+    from batch import load_jobs, run_batch
+    from job_queue import JobQueue, QueueFullError, enqueue, run_workers
+    from server import serve
+
     parser = argparse.ArgumentParser(
         description='AI 自动化代码流水线 - 从需求到可运行代码'
     )
-    parser.add_argument(
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
         '--requirement',
-        required=True,
         help='用户需求描述'
     )
+    source.add_argument(
+        '--batch',
+        metavar='JSONL',
+        help='批量模式: 每行一个需求的 JSONL 文件'
+    )
+    source.add_argument(
+        '--resume',
+        metavar='RUN_DIR',
+        help='续跑: 复用运行目录中已完成的步骤结果,从第一个未完成的步骤继续'
+    )
+    source.add_argument(
+        '--worker',
+        action='store_true',
+        help='队列 worker: 从持久化任务队列中认领并运行任务 (崩溃后由其他 worker 续跑)'
+    )
+    source.add_argument(
+        '--serve',
+        action='store_true',
+        help='服务模式: 在本机启动 HTTP 服务,常驻 LLM 客户端并通过接口提交任务'
+    )
     parser.add_argument(
         '--max-iterations',
         type=int,
-        default=2,
-        help='最大修复迭代次数 (默认: 2)'
+        default=None,
+        help='最大修复迭代次数 (默认: 2,续跑时沿用原运行的设置)'
+    )
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        default=None,
+        help='流式生成代码,代码块闭合即写入文件 (也可设置 LLM_STREAM=true)'
+    )
+    parser.add_argument(
+        '--fanout',
+        action='store_true',
+        default=None,
+        help='按任务分组并行生成代码 (也可设置 LLM_CODEGEN_FANOUT=true)'
+    )
+    parser.add_argument(
+        '--from-step',
+        help='与 --resume 一起使用: 从该步骤起重新执行 (srs / code / review / fix,或 review_1 / fix_2 ...)'
+    )
+    parser.add_argument(
+        '--output-root',
+        help='输出根目录,每次运行写入其中的 runs/<run ID>/ (也可设置 PIPELINE_OUTPUT_ROOT)'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='批量模式同时运行的需求数 (默认: 4,也可设置 PIPELINE_BATCH_WORKERS);服务模式与队列 worker 同时运行的任务数 (默认: 2)'
+    )
+    parser.add_argument(
+        '--executor',
+        choices=['thread', 'process'],
+        help='批量模式的 worker 类型 (默认: thread,也可设置 PIPELINE_BATCH_EXECUTOR)'
+    )
+    parser.add_argument(
+        '--enqueue',
+        action='store_true',
+        help='与 --requirement / --batch 一起使用: 提交到持久化任务队列而不是立即运行'
+    )
+    parser.add_argument(
+        '--priority',
+        type=int,
+        default=0,
+        help='入队任务的优先级 (越大越先运行,默认: 0)'
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        help='服务模式的监听端口 (默认: 8765,也可设置 PIPELINE_SERVER_PORT)'
+    )
+    parser.add_argument(
+        '--max-in-flight',
+        type=int,
+        help='批量模式与队列 worker 同时进行的 LLM 请求数上限 (也可设置 PIPELINE_BATCH_MAX_IN_FLIGHT / PIPELINE_QUEUE_MAX_IN_FLIGHT)'
     )
 
     args = parser.parse_args()
-    main(args.requirement, args.max_iterations)
+    if args.from_step and not args.resume:
+        parser.error('--from-step 需要与 --resume 一起使用')
+    if args.enqueue and not (args.requirement or args.batch):
+        parser.error('--enqueue 需要与 --requirement 或 --batch 一起使用')
+    if args.enqueue:
+        jobs = load_jobs(args.batch) if args.batch else [{
+            'requirement': args.requirement, 'max_iterations': args.max_iterations,
+            'stream': args.stream, 'fanout': args.fanout
+        }]
+        try:
+            enqueue(jobs, JobQueue(root=args.output_root), priority=args.priority)
+        except QueueFullError as e:
+            print(f'✗ {str(e)}')
+            sys.exit(1)
+    elif args.worker:
+        run_workers(JobQueue(root=args.output_root), workers=args.workers, max_in_flight=args.max_in_flight)
+    elif args.serve:
+        serve(port=args.port, workers=args.workers, output_root=args.output_root)
+    elif args.batch:
+        run_batch(args.batch, workers=args.workers, executor=args.executor, output_root=args.output_root,
+                  max_in_flight=args.max_in_flight)
+    else:
+        main(args.requirement, args.max_iterations, stream=args.stream, fanout=args.fanout,
+             output_root=args.output_root, resume=args.resume, from_step=args.from_step)
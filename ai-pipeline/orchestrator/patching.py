@@ -0,0 +1,287 @@
+# patching.py
+# 补丁式修复:解析模型返回的 SEARCH/REPLACE 编辑块或 unified diff,在本地应用到原文件 (支持模糊匹配上下文)
+import difflib
+import re
+from typing import Dict, List, Optional, Tuple
+
+from fanout import normalize_path
+from streaming import CODE_BLOCK_PATTERN
+
+# 补丁模式下追加到修复提示词末尾的输出格式说明
+PATCH_FORMAT_NOTE = """
+**输出格式 (补丁模式):**
+
+不要输出完整文件,只输出修改。每个需要修改的文件输出一个代码块,首行为 path 标记,
+其后是一个或多个 SEARCH/REPLACE 编辑块:
+
+```python
+# path: app/main.py
+<<<<<<< SEARCH
+原有代码 (逐字复制,包含足够的上下文使其在文件中唯一)
+=======
+修改后的代码
+>>>>>>> REPLACE
+```
+
+- SEARCH 部分必须与原文件内容一致,尽量短,但要能唯一定位
+- 删除代码时 REPLACE 部分留空;新增文件时 SEARCH 部分留空,REPLACE 部分为完整内容
+- 也可以输出 unified diff (```diff 代码块,带 --- a/路径 与 +++ b/路径 文件头)
+"""
+
+SEARCH_MARKER = re.compile(r'^<{5,9} ?SEARCH\s*$')
+DIVIDER_MARKER = re.compile(r'^={5,9}\s*$')
+REPLACE_MARKER = re.compile(r'^>{5,9} ?REPLACE\s*$')
+DIFF_BLOCK_PATTERN = re.compile(r'```(?:diff|patch)?\n((?:---|diff --git)[\s\S]*?)```')
+HUNK_HEADER = re.compile(r'^@@ -(\d+)(?:,\d+)? \+\d+(?:,\d+)? @@')
+
+# 模糊匹配时可接受的最低相似度
+FUZZY_THRESHOLD = 0.8
+
+# 一处编辑: (原有代码, 修改后的代码, 原文件中的大致行号 (unified diff 提供,可为空))
+Edit = Tuple[str, str, Optional[int]]
+
+
+class PatchError(ValueError):
+    """编辑块无法在原文件中定位"""
+
+
+def parse_search_replace(content: str) -> List[Edit]:
+    """解析代码块中的 SEARCH/REPLACE 编辑块"""
+    edits = []
+    lines = content.split('\n')
+    i = 0
+    while i < len(lines):
+        if not SEARCH_MARKER.match(lines[i]):
+            i += 1
+            continue
+        search, replace, target = [], [], None
+        i += 1
+        while i < len(lines) and not REPLACE_MARKER.match(lines[i]):
+            if target is None and DIVIDER_MARKER.match(lines[i]):
+                target = replace
+            else:
+                (target if target is not None else search).append(lines[i])
+            i += 1
+        if target is None:
+            raise PatchError('编辑块缺少 ======= 分隔行')
+        edits.append(('\n'.join(search), '\n'.join(replace), None))
+        i += 1
+    return edits
+
+
+def parse_unified_diff(content: str) -> Dict[str, List[Edit]]:
+    """
+    解析 unified diff
+
+    每个 hunk 转换为一处编辑: 上下文行与删除行组成原有代码,上下文行与新增行组成修改后的代码,
+    hunk 头中的行号作为定位提示 (行号不准确时仍按内容匹配)。
+
+    Returns:
+        {路径: [编辑, ...]}
+    """
+    edits: Dict[str, List[Edit]] = {}
+    path, hunk = None, None
+
+    def close():
+        if path and hunk:
+            while hunk['lines'] and hunk['lines'][-1] == (' ', ''):
+                hunk['lines'].pop()
+            old = [line for kind, line in hunk['lines'] if kind != '+']
+            new = [line for kind, line in hunk['lines'] if kind != '-']
+            edits.setdefault(path, []).append(('\n'.join(old), '\n'.join(new), hunk['start']))
+
+    lines = content.split('\n')
+    for index, line in enumerate(lines):
+        # 文件头是相邻的 --- / +++ 两行;hunk 中以 "-- " 开头的删除行不会被当作文件头
+        next_line = lines[index + 1] if index + 1 < len(lines) else ''
+        previous = lines[index - 1] if index > 0 else ''
+        if line.startswith('+++ ') and (hunk is None or previous.startswith('--- ')):
+            close()
+            hunk = None
+            target = line[4:].split('\t')[0].strip()
+            path = normalize_path(target[2:] if target.startswith('b/') else target)
+        elif (line.startswith('--- ') and next_line.startswith('+++ ')) or line.startswith('diff --git'):
+            close()
+            hunk = None
+        elif hunk is None and line.startswith('index '):
+            continue
+        elif HUNK_HEADER.match(line):
+            close()
+            hunk = {'start': int(HUNK_HEADER.match(line).group(1)), 'lines': []}
+        elif hunk is not None and line[:1] in ('+', '-', ' '):
+            hunk['lines'].append((line[0], line[1:]))
+        elif hunk is not None and line == '':
+            # 部分模型会去掉空白上下文行的前导空格
+            hunk['lines'].append((' ', ''))
+        elif hunk is not None and line.startswith('\\'):
+            continue
+    close()
+    return edits
+
+
+def parse_patch_response(response: str) -> Tuple[Dict[str, List[Edit]], List[Tuple[str, str]], Dict[str, str]]:
+    """
+    解析补丁模式的修复响应
+
+    Returns:
+        ({路径: [编辑, ...]}, 完整文件代码块列表 [(路径, 内容), ...], {格式错误的路径: 原因})
+        模型仍可能对个别文件输出完整内容 (如新增文件),这些代码块原样返回。
+    """
+    edits: Dict[str, List[Edit]] = {}
+    full_blocks = []
+    malformed: Dict[str, str] = {}
+    for match in CODE_BLOCK_PATTERN.finditer(response):
+        path, content = match.group(1).strip(), match.group(2).strip('\n')
+        if any(SEARCH_MARKER.match(line) for line in content.split('\n')):
+            try:
+                edits.setdefault(path, []).extend(parse_search_replace(content))
+            except PatchError as e:
+                malformed[path] = str(e)
+        elif re.search(r'^@@ -\d', content, re.MULTILINE):
+            for hunks in parse_unified_diff(f'+++ b/{path}\n{content}').values():
+                edits.setdefault(path, []).extend(hunks)
+        else:
+            full_blocks.append((path, content.strip()))
+
+    for match in DIFF_BLOCK_PATTERN.finditer(response):
+        for path, hunks in parse_unified_diff(match.group(1)).items():
+            edits.setdefault(path, []).extend(hunks)
+    return edits, full_blocks, malformed
+
+
+def _locate(lines: List[str], search: List[str], hint: Optional[int]) -> Tuple[int, int, str]:
+    """
+    在文件中定位原有代码
+
+    依次尝试: 逐字匹配、忽略行尾空白、忽略缩进、按相似度模糊匹配。
+    同一策略下有多处匹配时取最接近 hint 的一处,没有 hint 时视为无法唯一定位。
+
+    Returns:
+        (起始行, 结束行 (不含), 使用的匹配策略)
+    """
+    size = len(search)
+    strategies = [
+        ('exact', lambda s: s),
+        ('rstrip', str.rstrip),
+        ('strip', str.strip),
+    ]
+    for name, norm in strategies:
+        target = [norm(line) for line in search]
+        matches = [i for i in range(len(lines) - size + 1)
+                   if [norm(line) for line in lines[i:i + size]] == target]
+        if len(matches) == 1:
+            return matches[0], matches[0] + size, name
+        if matches and hint is not None:
+            start = min(matches, key=lambda i: abs(i - (hint - 1)))
+            return start, start + size, name
+        if matches:
+            raise PatchError(f'原有代码在文件中出现 {len(matches)} 次,无法唯一定位: {search[0].strip()[:60]}')
+
+    # 模糊匹配: 同样长度的窗口中相似度最高的一处
+    joined = '\n'.join(line.strip() for line in search)
+    best, best_ratio = None, 0.0
+    for i in range(len(lines) - size + 1):
+        window = '\n'.join(line.strip() for line in lines[i:i + size])
+        matcher = difflib.SequenceMatcher(None, joined, window, autojunk=False)
+        if matcher.real_quick_ratio() < FUZZY_THRESHOLD or matcher.quick_ratio() < FUZZY_THRESHOLD:
+            continue
+        ratio = matcher.ratio()
+        closer = best is not None and hint is not None and ratio == best_ratio and \
+            abs(i - (hint - 1)) < abs(best - (hint - 1))
+        if ratio > best_ratio or closer:
+            best, best_ratio = i, ratio
+    if best is not None and best_ratio >= FUZZY_THRESHOLD:
+        return best, best + size, f'fuzzy({best_ratio:.2f})'
+    raise PatchError(f'原有代码在文件中找不到: {search[0].strip()[:60] if search else ""}')
+
+
+def _reindent(replace: List[str], search: List[str], matched: List[str]) -> List[str]:
+    """匹配位置的缩进与 SEARCH 部分不同时 (模型抄错缩进),按相同的差值调整修改后的代码"""
+    def indent(line: str) -> str:
+        return line[:len(line) - len(line.lstrip())]
+
+    pairs = [(indent(s), indent(m)) for s, m in zip(search, matched) if s.strip() and m.strip()]
+    if not pairs or pairs[0][0] == pairs[0][1]:
+        return replace
+    written, actual = pairs[0]
+    if actual.startswith(written):
+        extra = actual[len(written):]
+        return [extra + line if line.strip() else line for line in replace]
+    if written.startswith(actual):
+        surplus = len(written) - len(actual)
+        return [line[surplus:] if line[:surplus].strip() == '' else line.lstrip() for line in replace]
+    return replace
+
+
+def apply_edits(content: str, edits: List[Edit]) -> Tuple[str, List[str]]:
+    """
+    把编辑依次应用到文件内容
+
+    Args:
+        content: 原文件内容
+        edits: 编辑列表
+
+    Returns:
+        (修改后的内容, 各编辑使用的匹配策略)
+
+    Raises:
+        PatchError: 任一编辑无法定位 (调用方应回退为请求完整文件)
+    """
+    lines = content.split('\n')
+    strategies = []
+    for search, replace, hint in edits:
+        search_lines = search.split('\n') if search.strip() else []
+        replace_lines = replace.split('\n') if replace.strip() else []
+        if not search_lines:
+            if hint is not None and 0 < hint <= len(lines) + 1 and lines != ['']:
+                # unified diff 中没有上下文的纯新增 hunk: 按行号插入
+                lines[hint - 1:hint - 1] = replace_lines
+                strategies.append('insert')
+            elif not content.strip():
+                lines = replace_lines
+                strategies.append('create')
+            else:
+                raise PatchError('SEARCH 部分为空,但文件已存在')
+            continue
+        start, end, strategy = _locate(lines, search_lines, hint)
+        lines[start:end] = _reindent(replace_lines, search_lines, lines[start:end])
+        strategies.append(strategy)
+    return '\n'.join(lines), strategies
+
+
+def apply_patch_response(code_blocks: List[Tuple[str, str]], response: str) -> Tuple[List[Tuple[str, str]], Dict]:
+    """
+    把补丁模式的修复响应应用到代码块
+
+    某个文件的任一编辑无法定位时,该文件的所有编辑都不应用,列入 failed (调用方回退为请求完整文件)。
+
+    Args:
+        code_blocks: 修复前的代码块
+        response: 模型的修复响应
+
+    Returns:
+        (修改过的文件代码块 [(路径, 新内容), ...], 报告 {'edits', 'applied', 'fuzzy', 'failed', 'full_files'})
+    """
+    current = {normalize_path(path): (path, content) for path, content in code_blocks}
+    edits, full_blocks, malformed = parse_patch_response(response)
+    changed = []
+    report: Dict = {'edits': sum(len(e) for e in edits.values()), 'applied': 0, 'fuzzy': 0,
+                    'failed': {}, 'full_files': [path for path, _ in full_blocks]}
+    for path, reason in malformed.items():
+        edits.pop(path, None)
+        report['failed'][current.get(normalize_path(path), (path,))[0]] = reason
+
+    for path, file_edits in edits.items():
+        original_path, content = current.get(normalize_path(path), (path, ''))
+        try:
+            new_content, strategies = apply_edits(content, file_edits)
+        except PatchError as e:
+            report['failed'][original_path] = str(e)
+            continue
+        report['applied'] += len(strategies)
+        report['fuzzy'] += sum(1 for s in strategies if s not in ('exact', 'insert', 'create'))
+        changed.append((original_path, new_content.strip()))
+
+    patched = {normalize_path(path) for path, _ in changed}
+    changed.extend((path, content) for path, content in full_blocks if normalize_path(path) not in patched)
+    return changed, report
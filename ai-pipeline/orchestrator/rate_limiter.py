@@ -0,0 +1,524 @@
+# rate_limiter.py
+# 全局限流调度:按端点 + 模型的 RPM / TPM 令牌桶,解析 Retry-After 与限流响应头,
+# 并按 AIMD (加性增、乘性减) 自适应调整并发数
+import asyncio
+import email.utils
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Mapping, Optional, Tuple
+
+from token_budget import count_tokens
+
+
+class RateLimitConfig:
+    """单个端点 + 模型的限流配置 (0 表示不限制)"""
+
+    def __init__(
+        self,
+        rpm: float = 0,
+        tpm: float = 0,
+        max_concurrency: int = 16,
+        min_concurrency: int = 1,
+        burst_seconds: float = 10
+    ):
+        """
+        Args:
+            rpm: 每分钟请求数上限
+            tpm: 每分钟 token 数上限 (提示词估算 token + max_tokens)
+            max_concurrency: 最大并发请求数 (AIMD 调整的上限)
+            min_concurrency: 收到 429 后并发数下调的下限
+            burst_seconds: 令牌桶容量对应的秒数,即允许的突发量 (rpm / 60 * burst_seconds)
+        """
+        self.rpm = float(rpm or 0)
+        self.tpm = float(tpm or 0)
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.min_concurrency = max(1, min(int(min_concurrency), self.max_concurrency))
+        self.burst_seconds = max(1.0, float(burst_seconds))
+
+    @classmethod
+    def from_dict(cls, data: Dict, default: Optional['RateLimitConfig'] = None) -> 'RateLimitConfig':
+        """从配置字典创建,未给出的字段沿用 default"""
+        default = default or cls()
+        return cls(
+            rpm=data.get('rpm', default.rpm),
+            tpm=data.get('tpm', default.tpm),
+            max_concurrency=data.get('max_concurrency', default.max_concurrency),
+            min_concurrency=data.get('min_concurrency', default.min_concurrency),
+            burst_seconds=data.get('burst_seconds', default.burst_seconds)
+        )
+
+
+class Permit:
+    """一次获准发出的请求,结束后需要交还给限流器"""
+
+    def __init__(self, tokens: int):
+        self.tokens = tokens
+        self.started_at = time.monotonic()
+
+
+class MemoryBucketStore:
+    """进程内令牌桶存储"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, Dict[str, float]] = {}
+
+    def take(self, key: str, config: RateLimitConfig, tokens: int) -> float:
+        """
+        尝试从令牌桶中扣减一次请求和 tokens 个 token
+
+        Returns:
+            0 表示成功扣减;否则为需要等待的秒数
+        """
+        now = time.time()
+        with self._lock:
+            state = self._buckets.setdefault(key, _full_bucket(config, now))
+            wait = _take(state, config, tokens, now)
+        return wait
+
+    def block(self, key: str, until: float):
+        """在 until (Unix 时间) 之前拒绝该端点的所有请求"""
+        with self._lock:
+            state = self._buckets.setdefault(key, {'requests': 0.0, 'tokens': 0.0, 'updated_at': time.time(),
+                                                   'blocked_until': 0.0})
+            state['blocked_until'] = max(state['blocked_until'], until)
+
+
+class SqliteBucketStore:
+    """
+    基于 SQLite 的跨进程令牌桶存储
+
+    每次扣减在 BEGIN IMMEDIATE 事务中完成,同一主机上的多个进程共享同一份配额。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS rate_buckets ('
+                ' key TEXT PRIMARY KEY,'
+                ' requests REAL NOT NULL,'
+                ' tokens REAL NOT NULL,'
+                ' updated_at REAL NOT NULL,'
+                ' blocked_until REAL NOT NULL DEFAULT 0)'
+            )
+        finally:
+            conn.close()
+
+    def take(self, key: str, config: RateLimitConfig, tokens: int) -> float:
+        """同 MemoryBucketStore.take,但在 SQLite 事务中读改写"""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            state = self._load(conn, key) or _full_bucket(config, now)
+            wait = _take(state, config, tokens, now)
+            self._save(conn, key, state)
+            conn.execute('COMMIT')
+            return wait
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def block(self, key: str, until: float):
+        """同 MemoryBucketStore.block"""
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            state = self._load(conn, key) or {'requests': 0.0, 'tokens': 0.0, 'updated_at': time.time(),
+                                              'blocked_until': 0.0}
+            state['blocked_until'] = max(state['blocked_until'], until)
+            self._save(conn, key, state)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    @staticmethod
+    def _load(conn: sqlite3.Connection, key: str) -> Optional[Dict[str, float]]:
+        row = conn.execute(
+            'SELECT requests, tokens, updated_at, blocked_until FROM rate_buckets WHERE key = ?', (key,)
+        ).fetchone()
+        if not row:
+            return None
+        return {'requests': row[0], 'tokens': row[1], 'updated_at': row[2], 'blocked_until': row[3]}
+
+    @staticmethod
+    def _save(conn: sqlite3.Connection, key: str, state: Dict[str, float]):
+        conn.execute(
+            'INSERT OR REPLACE INTO rate_buckets (key, requests, tokens, updated_at, blocked_until) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (key, state['requests'], state['tokens'], state['updated_at'], state['blocked_until'])
+        )
+
+
+class EndpointLimiter:
+    """
+    单个端点 + 模型的限流器
+
+    - RPM / TPM: 令牌桶 (可跨进程共享)
+    - 并发: AIMD,成功时并发上限缓慢增加,收到 429 时减半
+    - Retry-After / 限流响应头: 在指定时间前暂停该端点的所有请求
+    """
+
+    def __init__(self, key: str, config: RateLimitConfig, store):
+        self.key = key
+        self.config = config
+        self.store = store
+        self.concurrency = float(config.max_concurrency)
+        self.in_flight = 0
+        self._cond = threading.Condition()
+        self._stats = {'requests': 0, 'rate_limited': 0, 'waited_seconds': 0.0}
+
+    def acquire(self, tokens: int) -> Permit:
+        """阻塞直到允许发出请求"""
+        waited = 0.0
+        while True:
+            with self._cond:
+                while self.in_flight >= int(self.concurrency):
+                    start = time.monotonic()
+                    self._cond.wait(timeout=1.0)
+                    waited += time.monotonic() - start
+                self.in_flight += 1  # 先占用并发槽位,再检查令牌桶
+
+            wait = self.store.take(self.key, self.config, tokens)
+            if wait <= 0:
+                return self._grant(tokens, waited)
+
+            self._free_slot()
+            time.sleep(wait)
+            waited += wait
+
+    async def aacquire(self, tokens: int) -> Permit:
+        """acquire 的异步版本,等待期间让出事件循环"""
+        waited = 0.0
+        while True:
+            with self._cond:
+                reserved = self.in_flight < int(self.concurrency)
+                if reserved:
+                    self.in_flight += 1
+
+            if not reserved:
+                await asyncio.sleep(0.05)
+                waited += 0.05
+                continue
+
+            try:
+                if isinstance(self.store, SqliteBucketStore):
+                    wait = await asyncio.to_thread(self.store.take, self.key, self.config, tokens)
+                else:
+                    wait = self.store.take(self.key, self.config, tokens)
+            except BaseException:
+                self._free_slot()  # 被取消时归还槽位
+                raise
+            if wait <= 0:
+                return self._grant(tokens, waited)
+
+            self._free_slot()
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def release(self, permit: Permit, headers: Optional[Mapping[str, str]] = None,
+                status_code: Optional[int] = None, failed: bool = False):
+        """
+        交还许可,并根据响应调整限流状态
+
+        Args:
+            permit: acquire 返回的许可
+            headers: 响应头 (成功或失败均可)
+            status_code: HTTP 状态码 (429 触发并发减半)
+            failed: 请求是否失败 (失败时不增加并发上限)
+        """
+        rate_limited = status_code == 429
+        block_until = parse_rate_limit_block(headers or {}, rate_limited)
+        if block_until:
+            self.store.block(self.key, block_until)
+        self._learn_limits(headers or {})
+
+        with self._cond:
+            self.in_flight -= 1
+            if rate_limited:
+                self._stats['rate_limited'] += 1
+                self.concurrency = max(self.config.min_concurrency, self.concurrency / 2)
+            elif not failed:
+                self.concurrency = min(self.config.max_concurrency, self.concurrency + 1.0 / self.concurrency)
+            self._cond.notify_all()
+
+        if rate_limited:
+            print(f'⚠️  触发限流 (429) {self.key},并发上限降至 {int(self.concurrency)}')
+
+    def stats(self) -> Dict[str, float]:
+        with self._cond:
+            stats = dict(self._stats)
+            stats['concurrency'] = round(self.concurrency, 2)
+            stats['in_flight'] = self.in_flight
+        stats['waited_seconds'] = round(stats['waited_seconds'], 3)
+        return stats
+
+    def _grant(self, tokens: int, waited: float) -> Permit:
+        """登记一次放行 (并发槽位已在 acquire 中占用)"""
+        with self._cond:
+            self._stats['requests'] += 1
+            self._stats['waited_seconds'] += waited
+        return Permit(tokens)
+
+    def _free_slot(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def _learn_limits(self, headers: Mapping[str, str]):
+        """未配置 RPM / TPM 时,采用服务端响应头中声明的配额"""
+        if not self.config.rpm:
+            limit = _header_float(headers, 'x-ratelimit-limit-requests', 'anthropic-ratelimit-requests-limit')
+            if limit:
+                self.config.rpm = limit
+        if not self.config.tpm:
+            limit = _header_float(headers, 'x-ratelimit-limit-tokens', 'anthropic-ratelimit-tokens-limit')
+            if limit:
+                self.config.tpm = limit
+
+
+class RateLimiter:
+    """
+    进程内共享的限流调度器,按 (端点, 模型) 管理 EndpointLimiter
+
+    配置来源 (环境变量):
+        LLM_RATE_LIMIT=true         启用限流 (设置下列任一项也会启用)
+        LLM_RPM / LLM_TPM           默认的每分钟请求数 / token 数
+        LLM_MAX_CONCURRENCY         默认最大并发数
+        LLM_RATE_LIMITS             按端点 + 模型覆盖的 JSON, 键为 "base_url|model"、"base_url" 或 "*"
+        LLM_RATE_LIMIT_DB           SQLite 文件路径,设置后同一主机的多个进程共享令牌桶
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(
+        self,
+        default: Optional[RateLimitConfig] = None,
+        overrides: Optional[Dict[str, Dict]] = None,
+        db_path: Optional[str] = None
+    ):
+        self.default = default or RateLimitConfig()
+        self.overrides = overrides or {}
+        self.store = SqliteBucketStore(db_path) if db_path else MemoryBucketStore()
+        self._limiters: Dict[str, EndpointLimiter] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> Optional['RateLimiter']:
+        """根据环境变量创建限流器,未启用时返回 None"""
+        names = ('LLM_RPM', 'LLM_TPM', 'LLM_MAX_CONCURRENCY', 'LLM_RATE_LIMITS', 'LLM_RATE_LIMIT_DB')
+        enabled = os.getenv('LLM_RATE_LIMIT', 'false').lower() == 'true' or any(os.getenv(n) for n in names)
+        if not enabled:
+            return None
+
+        default = RateLimitConfig(
+            rpm=float(os.getenv('LLM_RPM', '0')),
+            tpm=float(os.getenv('LLM_TPM', '0')),
+            max_concurrency=int(os.getenv('LLM_MAX_CONCURRENCY', '16'))
+        )
+        overrides = {}
+        if os.getenv('LLM_RATE_LIMITS'):
+            try:
+                overrides = json.loads(os.getenv('LLM_RATE_LIMITS'))
+            except json.JSONDecodeError as e:
+                raise ValueError(f'LLM_RATE_LIMITS 不是合法的 JSON: {str(e)}')
+        return cls(default, overrides, os.getenv('LLM_RATE_LIMIT_DB'))
+
+    @classmethod
+    def shared(cls) -> Optional['RateLimiter']:
+        """获取进程内共享的限流器 (按环境变量创建一次),未启用时返回 None"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls.from_env() or False
+            return cls._shared or None
+
+    def for_endpoint(self, endpoint: str, model: str) -> EndpointLimiter:
+        """获取 (或创建) 指定端点 + 模型的限流器"""
+        key = f'{endpoint}|{model}'
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                data = self.overrides.get(key) or self.overrides.get(endpoint) or self.overrides.get('*') or {}
+                config = RateLimitConfig.from_dict(data, self.default)
+                limiter = EndpointLimiter(key, config, self.store)
+                self._limiters[key] = limiter
+            return limiter
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """各端点的限流统计"""
+        with self._lock:
+            limiters = dict(self._limiters)
+        return {key: limiter.stats() for key, limiter in limiters.items()}
+
+
+def parse_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """
+    解析 Retry-After / retry-after-ms 响应头
+
+    Returns:
+        需要等待的秒数,没有该响应头时返回 None
+    """
+    value = _header(headers, 'retry-after-ms')
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+
+    value = _header(headers, 'retry-after')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        parsed = email.utils.parsedate_to_datetime(value) if value else None
+        return max(0.0, parsed.timestamp() - time.time()) if parsed else None
+
+
+def parse_rate_limit_block(headers: Mapping[str, str], rate_limited: bool) -> Optional[float]:
+    """
+    根据响应头计算端点需要暂停到的时间点
+
+    - 429 响应: 使用 Retry-After,缺失时默认暂停 1 秒
+    - 剩余请求数 / token 数为 0: 暂停到对应的 reset 时间
+
+    Returns:
+        暂停截止的 Unix 时间,无需暂停时返回 None
+    """
+    now = time.time()
+    until = None
+
+    retry_after = parse_retry_after(headers)
+    if retry_after is not None:
+        until = now + retry_after
+    elif rate_limited:
+        until = now + 1.0
+
+    for kind in ('requests', 'tokens'):
+        remaining = _header_float(headers, f'x-ratelimit-remaining-{kind}', f'anthropic-ratelimit-{kind}-remaining')
+        if remaining is not None and remaining <= 0:
+            reset = _parse_reset(
+                _header(headers, f'x-ratelimit-reset-{kind}') or _header(headers, f'anthropic-ratelimit-{kind}-reset')
+            )
+            if reset:
+                until = max(until or 0, now + reset)
+
+    return until
+
+
+def estimate_request_tokens(request: Dict) -> int:
+    """估算一次请求计入 TPM 的 token 数:提示词 (见 token_budget.count_tokens) + max_tokens"""
+    texts = [request.get('system', '') or '']
+    for message in request.get('messages', []):
+        content = message.get('content', '')
+        texts.append(content if isinstance(content, str) else json.dumps(content, ensure_ascii=False))
+    prompt_tokens, _ = count_tokens('\n'.join(texts), request.get('model'))
+    return prompt_tokens + int(request.get('max_tokens') or 0)
+
+
+def error_status_and_headers(error: BaseException) -> Tuple[Optional[int], Mapping[str, str]]:
+    """从 SDK 异常中提取 HTTP 状态码和响应头 (openai / anthropic 的 APIStatusError 均带 response)"""
+    response = getattr(error, 'response', None)
+    status = getattr(error, 'status_code', None) or getattr(response, 'status_code', None)
+    headers = getattr(response, 'headers', None) or {}
+    return status, headers
+
+
+def _full_bucket(config: RateLimitConfig, now: float) -> Dict[str, float]:
+    return {
+        'requests': _capacity(config.rpm, config),
+        'tokens': _capacity(config.tpm, config),
+        'updated_at': now,
+        'blocked_until': 0.0
+    }
+
+
+def _capacity(per_minute: float, config: RateLimitConfig) -> float:
+    return max(1.0, per_minute / 60 * config.burst_seconds) if per_minute else 0.0
+
+
+def _take(state: Dict[str, float], config: RateLimitConfig, tokens: int, now: float) -> float:
+    """令牌桶补充与扣减 (调用方负责并发保护)"""
+    if state['blocked_until'] > now:
+        return state['blocked_until'] - now
+
+    elapsed = max(0.0, now - state['updated_at'])
+    state['updated_at'] = now
+    waits = []
+    for field, per_minute, cost in (('requests', config.rpm, 1), ('tokens', config.tpm, tokens)):
+        if not per_minute:
+            continue
+        capacity = _capacity(per_minute, config)
+        state[field] = min(capacity, state[field] + elapsed * per_minute / 60)
+        cost = min(cost, capacity)  # 单次请求超过桶容量时,等桶满即可放行
+        if state[field] < cost:
+            waits.append((cost - state[field]) / (per_minute / 60))
+
+    if waits:
+        return max(waits)
+
+    if config.rpm:
+        state['requests'] -= 1
+    if config.tpm:
+        state['tokens'] -= min(tokens, _capacity(config.tpm, config))
+    return 0.0
+
+
+def _header(headers: Mapping[str, str], name: str) -> Optional[str]:
+    try:
+        return headers.get(name) or headers.get(name.title())
+    except AttributeError:
+        return None
+
+
+def _header_float(headers: Mapping[str, str], *names: str) -> Optional[float]:
+    for name in names:
+        value = _header(headers, name)
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                continue
+    return None
+
+
+def _parse_reset(value: Optional[str]) -> Optional[float]:
+    """
+    解析 reset 时间:OpenAI 格式为 "1s" / "6m0s" / "20ms",Anthropic 为 RFC 3339 时间戳
+
+    Returns:
+        距离 reset 的秒数
+    """
+    if not value:
+        return None
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    parts = re.findall(r'([\d.]+)(ms|h|m|s)', value)
+    if parts and ''.join(n + u for n, u in parts) == value:
+        return sum(float(n) * units[u] for n, u in parts)
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        from datetime import datetime
+        return max(0.0, datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp() - time.time())
+    except ValueError:
+        return None
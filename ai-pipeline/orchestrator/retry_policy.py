@@ -0,0 +1,451 @@
+# retry_policy.py
+# 重试策略:区分可重试 / 不可重试错误、全抖动退避、单次与整体超时、
+# 按端点熔断,以及基于 p95 延迟的对冲请求
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Deque, Dict, Iterator, Optional
+
+from rate_limiter import parse_retry_after
+
+# 可重试的 HTTP 状态码 (另外所有 5xx 都可重试)
+RETRYABLE_STATUS = {408, 409, 425, 429}
+# 配置或编程错误,重试没有意义
+FATAL_EXCEPTIONS = (NotImplementedError, ValueError, TypeError, KeyError, AttributeError)
+
+
+class LLMAPIError(RuntimeError):
+    """LLM 接口调用失败,携带状态码与是否可重试 (继承 RuntimeError 以兼容原有调用方)"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None,
+                 retryable: bool = True, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+    @classmethod
+    def wrap(cls, message: str, error: BaseException) -> 'LLMAPIError':
+        """包装 SDK 异常,保留状态码、Retry-After 与可重试判定"""
+        if isinstance(error, LLMAPIError):
+            return error
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None) or {}
+        return cls(
+            f'{message}: {str(error)}',
+            status_code=error_status(error),
+            retryable=is_retryable(error),
+            retry_after=parse_retry_after(headers)
+        )
+
+
+class CircuitOpenError(LLMAPIError):
+    """端点处于熔断状态,请求被直接拒绝"""
+
+    def __init__(self, endpoint: str, retry_in: float):
+        super().__init__(f'端点 {endpoint} 已熔断,{retry_in:.1f}s 后重试探测', retryable=False)
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+class AttemptTimeoutError(LLMAPIError):
+    """单次尝试或整体调用超过截止时间"""
+
+    def __init__(self, message: str):
+        super().__init__(message, retryable=True)
+
+
+def _error_chain(error: BaseException) -> Iterator[BaseException]:
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        yield error
+        error = error.__cause__ or error.__context__
+
+
+def error_status(error: BaseException) -> Optional[int]:
+    """沿异常链查找 HTTP 状态码"""
+    for err in _error_chain(error):
+        status = getattr(err, 'status_code', None) or getattr(getattr(err, 'response', None), 'status_code', None)
+        if isinstance(status, int):
+            return status
+    return None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    判断错误是否值得重试
+
+    - 不可重试: 熔断、配置 / 编程错误 (NotImplementedError、ValueError 等)、
+      400 / 401 / 403 / 404 / 422 等客户端错误
+    - 可重试: 408 / 409 / 425 / 429、5xx、超时与连接错误,以及其他未知异常
+    """
+    for err in _error_chain(error):
+        if isinstance(err, LLMAPIError):
+            return err.retryable
+        if isinstance(err, FATAL_EXCEPTIONS):
+            return False
+        if isinstance(err, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+            return True
+        status = getattr(err, 'status_code', None)
+        if isinstance(status, int):
+            return status in RETRYABLE_STATUS or status >= 500
+    return True
+
+
+def retry_after_of(error: BaseException) -> Optional[float]:
+    """从异常中取出服务端要求的等待时间"""
+    for err in _error_chain(error):
+        if getattr(err, 'retry_after', None) is not None:
+            return err.retry_after
+        headers = getattr(getattr(err, 'response', None), 'headers', None)
+        if headers:
+            value = parse_retry_after(headers)
+            if value is not None:
+                return value
+    return None
+
+
+class CircuitBreaker:
+    """
+    单个端点的熔断器
+
+    连续失败达到阈值后进入 open 状态,直接拒绝请求;reset_timeout 秒后进入
+    half_open,只放行一个探测请求,成功则恢复 closed,失败则重新 open。
+    """
+
+    def __init__(self, endpoint: str, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.endpoint = endpoint
+        self.failure_threshold = max(1, failure_threshold)
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """请求前检查,熔断中抛出 CircuitOpenError"""
+        with self._lock:
+            if self.state == 'closed':
+                return
+            elapsed = time.monotonic() - self.opened_at
+            if self.state == 'open' and elapsed >= self.reset_timeout:
+                self.state = 'half_open'
+                self._probing = False
+            if self.state == 'half_open' and not self._probing:
+                self._probing = True
+                return
+            raise CircuitOpenError(self.endpoint, max(0.0, self.reset_timeout - elapsed))
+
+    def available(self) -> bool:
+        """是否可以发出请求 (关闭状态,或熔断时间已过 / 半开且没有进行中的探测,可以探测)"""
+        with self._lock:
+            return self.state == 'closed' or (self.state == 'half_open' and not self._probing) or \
+                (self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout)
+
+    def release_probe(self):
+        """探测请求没有得出结论 (被取消、流被关闭等) 时释放探测名额,下一个请求重新探测"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != 'closed':
+                print(f'✓ 端点 {self.endpoint} 已恢复,熔断关闭')
+            self.state = 'closed'
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    print(f'⚠️  端点 {self.endpoint} 连续失败 {self.failures} 次,熔断 {self.reset_timeout:.1f}s')
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+
+class LatencyTracker:
+    """记录最近的调用耗时,用于计算对冲请求的触发阈值"""
+
+    def __init__(self, window: int = 200):
+        self._samples: Dict[str, Deque[float]] = {}
+        self._window = window
+        self._lock = threading.Lock()
+
+    def record(self, key: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(key, deque(maxlen=self._window)).append(seconds)
+
+    def percentile(self, key: str, pct: float, min_samples: int = 20) -> Optional[float]:
+        """样本不足 min_samples 时返回 None"""
+        with self._lock:
+            samples = sorted(self._samples.get(key, ()))
+        if len(samples) < min_samples:
+            return None
+        index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+        return samples[index]
+
+
+class RetryPolicy:
+    """
+    可配置的重试策略 (进程内共享,按环境变量创建)
+
+        LLM_MAX_RETRIES=3          最大尝试次数
+        LLM_RETRY_BASE_DELAY=1     退避基数 (秒),第 n 次等待 uniform(0, min(max, base * 2^n))
+        LLM_RETRY_MAX_DELAY=30     单次退避上限 (秒)
+        LLM_ATTEMPT_TIMEOUT=0      单次尝试超时 (秒),0 表示不限制
+        LLM_CALL_DEADLINE=0        包含重试在内的整体截止时间 (秒),0 表示不限制
+        LLM_BREAKER_THRESHOLD=5    连续失败多少次后熔断端点
+        LLM_BREAKER_RESET=30       熔断持续时间 (秒)
+        LLM_HEDGE=false            是否启用对冲请求
+        LLM_HEDGE_PERCENTILE=95    对冲阈值取历史耗时的百分位
+        LLM_HEDGE_DELAY=0          样本不足时的固定对冲阈值 (秒),0 表示样本不足时不对冲
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(
+        self,
+        max_attempts: int = 3,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+        attempt_timeout: Optional[float] = None,
+        deadline: Optional[float] = None,
+        breaker_threshold: int = 5,
+        breaker_reset: float = 30.0,
+        hedge: bool = False,
+        hedge_percentile: float = 95,
+        hedge_delay: Optional[float] = None
+    ):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempt_timeout = attempt_timeout or None
+        self.deadline = deadline or None
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay or None
+
+        self.latency = LatencyTracker()
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._random = random.Random()
+        self._stats = {'attempts': 0, 'retries': 0, 'fatal': 0, 'hedged': 0, 'hedge_wins': 0, 'timeouts': 0}
+
+    @classmethod
+    def from_env(cls) -> 'RetryPolicy':
+        return cls(
+            max_attempts=int(os.getenv('LLM_MAX_RETRIES', '3')),
+            base_delay=float(os.getenv('LLM_RETRY_BASE_DELAY', '1')),
+            max_delay=float(os.getenv('LLM_RETRY_MAX_DELAY', '30')),
+            attempt_timeout=float(os.getenv('LLM_ATTEMPT_TIMEOUT', '0')),
+            deadline=float(os.getenv('LLM_CALL_DEADLINE', '0')),
+            breaker_threshold=int(os.getenv('LLM_BREAKER_THRESHOLD', '5')),
+            breaker_reset=float(os.getenv('LLM_BREAKER_RESET', '30')),
+            hedge=os.getenv('LLM_HEDGE', 'false').lower() == 'true',
+            hedge_percentile=float(os.getenv('LLM_HEDGE_PERCENTILE', '95')),
+            hedge_delay=float(os.getenv('LLM_HEDGE_DELAY', '0'))
+        )
+
+    @classmethod
+    def shared(cls) -> 'RetryPolicy':
+        """获取进程内共享的重试策略 (熔断状态与延迟统计在所有 LLMClient 之间共享)"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls.from_env()
+            return cls._shared
+
+    def breaker(self, endpoint: str) -> CircuitBreaker:
+        """获取端点对应的熔断器"""
+        with self._lock:
+            breaker = self._breakers.get(endpoint)
+            if breaker is None:
+                breaker = CircuitBreaker(endpoint, self.breaker_threshold, self.breaker_reset)
+                self._breakers[endpoint] = breaker
+            return breaker
+
+    def backoff(self, attempt: int, error: Optional[BaseException] = None) -> float:
+        """第 attempt 次 (从 0 开始) 失败后的等待时间:全抖动退避,且不短于 Retry-After"""
+        cap = min(self.max_delay, self.base_delay * (2 ** attempt))
+        with self._lock:
+            delay = self._random.uniform(0, cap)
+        retry_after = retry_after_of(error) if error is not None else None
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    def attempt_timeout_for(self, elapsed: float, timeout: Optional[float] = None) -> Optional[float]:
+        """
+        本次尝试可用的时间:单次超时与整体截止时间剩余部分中的较小者
+
+        Raises:
+            AttemptTimeoutError: 整体截止时间已过
+        """
+        timeout = timeout or self.attempt_timeout
+        if self.deadline:
+            remaining = self.deadline - elapsed
+            if remaining <= 0:
+                raise AttemptTimeoutError(f'调用超过整体截止时间 {self.deadline:.1f}s')
+            timeout = min(timeout, remaining) if timeout else remaining
+        return timeout
+
+    def next_delay(self, error: BaseException, attempt: int, attempts: int, elapsed: float) -> Optional[float]:
+        """
+        第 attempt 次 (从 0 开始) 失败后是否重试
+
+        Returns:
+            重试前的等待秒数;不可重试、次数耗尽或会超过整体截止时间时返回 None
+        """
+        if not is_retryable(error):
+            self.count('fatal')
+            print(f'✗ 不可重试的错误: {str(error)}')
+            return None
+        if attempt >= attempts - 1:
+            return None
+        delay = self.backoff(attempt, error)
+        if self.deadline and elapsed + delay >= self.deadline:
+            print(f'⚠️  重试将超过整体截止时间 {self.deadline:.1f}s,停止重试')
+            return None
+        self.count('retries')
+        return delay
+
+    def hedge_after(self, key: str) -> Optional[float]:
+        """对冲请求的触发阈值 (秒),None 表示不对冲"""
+        threshold = self.latency.percentile(key, self.hedge_percentile)
+        return threshold if threshold is not None else self.hedge_delay
+
+    def count(self, name: str, amount: int = 1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def stats(self) -> Dict[str, object]:
+        with self._lock:
+            stats = dict(self._stats)
+            breakers = {key: b.state for key, b in self._breakers.items()}
+        stats['breakers'] = breakers
+        return stats
+
+    def run_attempt(self, key: str, func: Callable, args: tuple, kwargs: dict,
+                    timeout: Optional[float], hedge: bool):
+        """
+        执行一次尝试 (同步)
+
+        需要超时或对冲时在线程池中执行:超时后放弃等待 (线程中的请求由 SDK 超时兜底),
+        对冲时在阈值到达后发出第二个相同请求,取先成功的结果。
+        """
+        hedge_after = self.hedge_after(key) if hedge else None
+        if not timeout and hedge_after is None:
+            return self._timed(key, func, args, kwargs)
+
+        executor = self._get_executor()
+        started = time.monotonic()
+        futures = [executor.submit(self._timed, key, func, args, kwargs)]
+        first = futures[0]
+        hedged = False
+        last_error = None
+
+        while futures:
+            now = time.monotonic()
+            waits = []
+            if timeout:
+                waits.append(started + timeout - now)
+            if hedge_after is not None and not hedged:
+                waits.append(started + hedge_after - now)
+            done, _ = wait(futures, timeout=max(0.0, min(waits)) if waits else None, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                futures.remove(future)
+                if future.exception() is None:
+                    if future is not first:
+                        self.count('hedge_wins')
+                    return future.result()
+                last_error = future.exception()
+
+            now = time.monotonic()
+            if timeout and now - started >= timeout:
+                self.count('timeouts')
+                raise AttemptTimeoutError(f'单次调用超过 {timeout:.1f}s 未完成')
+            if hedge_after is not None and not hedged and now - started >= hedge_after and futures:
+                hedged = True
+                self.count('hedged')
+                print(f'⏱  调用超过 {hedge_after:.1f}s,发出对冲请求')
+                futures.append(executor.submit(self._timed, key, func, args, kwargs))
+
+        raise last_error
+
+    async def arun_attempt(self, key: str, func: Callable, args: tuple, kwargs: dict,
+                           timeout: Optional[float], hedge: bool):
+        """run_attempt 的异步版本,落后的请求会被取消"""
+        hedge_after = self.hedge_after(key) if hedge else None
+        started = time.monotonic()
+        tasks = [asyncio.ensure_future(self._atimed(key, func, args, kwargs))]
+        first = tasks[0]
+        hedged = False
+        last_error = None
+
+        try:
+            while tasks:
+                now = time.monotonic()
+                waits = []
+                if timeout:
+                    waits.append(started + timeout - now)
+                if hedge_after is not None and not hedged:
+                    waits.append(started + hedge_after - now)
+                done, _ = await asyncio.wait(tasks, timeout=max(0.0, min(waits)) if waits else None,
+                                             return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    tasks.remove(task)
+                    if task.exception() is None:
+                        if task is not first:
+                            self.count('hedge_wins')
+                        return task.result()
+                    last_error = task.exception()
+
+                now = time.monotonic()
+                if timeout and now - started >= timeout:
+                    self.count('timeouts')
+                    raise AttemptTimeoutError(f'单次调用超过 {timeout:.1f}s 未完成')
+                if hedge_after is not None and not hedged and now - started >= hedge_after and tasks:
+                    hedged = True
+                    self.count('hedged')
+                    print(f'⏱  调用超过 {hedge_after:.1f}s,发出对冲请求')
+                    tasks.append(asyncio.ensure_future(self._atimed(key, func, args, kwargs)))
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        raise last_error
+
+    def _timed(self, key: str, func: Callable, args: tuple, kwargs: dict):
+        started = time.monotonic()
+        result = func(*args, **kwargs)
+        self.latency.record(key, time.monotonic() - started)
+        return result
+
+    async def _atimed(self, key: str, func: Callable, args: tuple, kwargs: dict):
+        started = time.monotonic()
+        result = await func(*args, **kwargs)
+        self.latency.record(key, time.monotonic() - started)
+        return result
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=int(os.getenv('LLM_RETRY_WORKERS', '32')),
+                    thread_name_prefix='llm-attempt'
+                )
+            return self._executor
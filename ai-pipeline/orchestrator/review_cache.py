@@ -0,0 +1,95 @@
+# review_cache.py
+# 增量审查:记录每次审查时各文件的内容哈希与缺陷结论,复审只发送内容变化的文件与未解决的缺陷,再合并为完整审查结果
+import hashlib
+from typing import Dict, List, Tuple
+
+from fanout import normalize_path
+from fix_scope import Defect, implicated_files
+from review_shards import defect_key
+
+
+def content_hash(content: str) -> str:
+    """文件内容哈希"""
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]
+
+
+def build_cache(review_result: Dict, code_blocks: List[Tuple[str, str]]) -> Dict:
+    """
+    审查后各文件的哈希与结论,保存在审查结果的 review_cache 字段中供下一轮复审使用
+
+    缺陷按 fix_scope.implicated_files 归属到文件;无法归属到文件的缺陷不缓存,下一轮复审时重新判断。
+
+    Returns:
+        {'files': {路径: {'hash': 内容哈希, 'defects': [该文件的缺陷, ...]}}}
+    """
+    paths = [path for path, _ in code_blocks]
+    files = {normalize_path(path): {'hash': content_hash(content), 'defects': []} for path, content in code_blocks}
+    for defect in review_result.get('defects', []):
+        for path in implicated_files(defect, paths):
+            files[normalize_path(path)]['defects'].append(defect)
+    return {'files': files}
+
+
+def changed_files(cache: Dict, code_blocks: List[Tuple[str, str]]) -> Tuple[List[str], List[str]]:
+    """
+    与上一轮审查相比内容变化的文件
+
+    Returns:
+        (变化或新增的文件路径, 未变化的文件路径)
+    """
+    files = cache.get('files', {})
+    changed, unchanged = [], []
+    for path, content in code_blocks:
+        entry = files.get(normalize_path(path))
+        (unchanged if entry and entry['hash'] == content_hash(content) else changed).append(path)
+    return changed, unchanged
+
+
+def merge_review(partial: Dict, cache: Dict, unchanged: List[str], code_blocks: List[Tuple[str, str]]) -> Dict:
+    """
+    把只覆盖变化文件的审查结果与未变化文件的缓存结论合并为完整审查结果
+
+    缓存缺陷 (涉及未变化文件) 只在复审无法判断时沿用:缺陷只涉及未变化的文件,或复审结果仍然列出该缺陷
+    (按 review_shards.defect_key 匹配)。同时涉及变化文件的缺陷由复审重新判断,复审不再列出即视为已修复。
+    复审中只涉及未变化文件的缺陷与缓存重复,不再重复计入。
+    合并后仍有复审未列出的缺陷时整体不通过。
+
+    Args:
+        partial: 增量审查的解析结果 (passed / results / defects / tests)
+        cache: 上一轮审查的 review_cache
+        unchanged: 未变化的文件路径
+        code_blocks: 当前全部代码块
+
+    Returns:
+        与完整审查格式一致的结果 (额外带有 incremental 字段)
+    """
+    paths = [path for path, _ in code_blocks]
+    unchanged_keys = {normalize_path(path) for path in unchanged}
+    reported = {defect_key(d) for d in partial.get('defects', [])}
+
+    cached: List[Defect] = []
+    for key in unchanged_keys:
+        for defect in cache['files'][key]['defects']:
+            if defect in cached:
+                continue
+            files = {normalize_path(path) for path in implicated_files(defect, paths)}
+            if files <= unchanged_keys or defect_key(defect) in reported:
+                cached.append(defect)
+
+    defects = list(cached)
+    seen = {defect_key(d) for d in cached}
+    for defect in partial.get('defects', []):
+        files = {normalize_path(path) for path in implicated_files(defect, paths)}
+        if files and files <= unchanged_keys:
+            continue
+        if defect_key(defect) not in seen:
+            seen.add(defect_key(defect))
+            defects.append(defect)
+
+    passed = bool(partial.get('passed', False)) and all(defect_key(d) in reported for d in defects)
+    results = list(partial.get('results', []))
+    if unchanged:
+        results.append(f'{len(unchanged)} 个文件与上一轮审查一致,沿用缓存结论 ({len(cached)} 个缺陷)')
+    return dict(partial, passed=passed, results=results, defects=defects,
+                incremental={'reviewed': [p for p in paths if p not in unchanged], 'cached': unchanged,
+                             'cached_defects': len(cached)})
@@ -0,0 +1,150 @@
+# review_shards.py
+# 分片审查:按模块与 token 预算把代码拆分为多个分片并行审查,再把各分片结果归并为一份审查结果 (缺陷去重)
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+from fanout import normalize_path
+from token_budget import count_tokens
+
+# 分片审查时追加在代码集合之后的范围说明
+SHARD_SCOPE_NOTE = """
+
+**本次审查范围:**
+
+项目较大,由多位审查者分片审查。你只审查上面给出的文件 (分片 {{INDEX}}/{{TOTAL}}),
+只报告这些文件中的缺陷。项目中的其他文件如下,可以假定它们按 SRS 实现了各自的接口:
+{{OTHER_FILES}}
+"""
+
+
+def _module(path: str) -> str:
+    """文件所属模块 (所在目录)"""
+    return os.path.dirname(normalize_path(path))
+
+
+def split_shards(code_blocks: List[Tuple[str, str]], max_tokens: int,
+                 model: Optional[str] = None) -> List[List[Tuple[str, str]]]:
+    """
+    按模块把代码块装入若干分片,每个分片的代码不超过 max_tokens
+
+    同一模块 (目录) 的文件尽量放在同一分片;模块超出预算时按文件拆分,
+    单个文件超出预算时独占一个分片。
+
+    Args:
+        code_blocks: 代码块列表
+        max_tokens: 每个分片的代码 token 预算
+        model: 用于估算 token 的模型
+
+    Returns:
+        分片列表 (只有一个分片时即不需要分片)
+    """
+    modules: Dict[str, List[Tuple[Tuple[str, str], int]]] = {}
+    for path, content in code_blocks:
+        size = count_tokens(f'# path: {path}\n{content}', model)[0]
+        modules.setdefault(_module(path), []).append(((path, content), size))
+
+    shards: List[List[Tuple[str, str]]] = []
+    current: List[Tuple[str, str]] = []
+    used = 0
+
+    def flush():
+        nonlocal current, used
+        if current:
+            shards.append(current)
+        current, used = [], 0
+
+    for files in modules.values():
+        total = sum(size for _, size in files)
+        if used and used + total > max_tokens and total <= max_tokens:
+            flush()
+        for block, size in files:
+            if used and used + size > max_tokens:
+                flush()
+            current.append(block)
+            used += size
+    flush()
+    return shards
+
+
+def scope_note(index: int, total: int, other_paths: List[str]) -> str:
+    """分片范围说明"""
+    others = '\n'.join(f'- {path}' for path in other_paths) or '- (无)'
+    return SHARD_SCOPE_NOTE.replace('{{INDEX}}', str(index)).replace('{{TOTAL}}', str(total)) \
+        .replace('{{OTHER_FILES}}', others)
+
+
+def defect_key(defect) -> Tuple[str, str]:
+    """
+    缺陷去重键: 文件与归一化后的描述 (忽略大小写、空白与标点)
+
+    本地测试失败的缺陷 (sandbox,category 为 test 且带有 tests) 按文件、运行状态与失败的测试 ID,
+    描述中的测试输出含耗时等每次运行都不同的内容,不参与比较。
+    """
+    if isinstance(defect, dict) and defect.get('category') == 'test' and 'tests' in defect:
+        path = normalize_path(str(defect.get('file') or ''))
+        return path, f'{defect.get("status", "")}:{",".join(sorted(defect["tests"]))}'
+    if isinstance(defect, dict):
+        path = normalize_path(str(defect.get('file') or '')) if defect.get('file') else ''
+        text = str(defect.get('description') or defect)
+    else:
+        path, text = '', str(defect)
+    return path, re.sub(r'[\W_]+', '', text.lower())
+
+
+def reduce_reviews(reviews: List[Optional[Dict]], raw_responses: List[str]) -> Dict:
+    """
+    把各分片的审查结果归并为一份审查结果
+
+    任一分片未通过或无法解析时整体不通过;缺陷按文件与描述去重,同一缺陷保留严重程度最高的版本;
+    测试文件按路径去重。
+
+    Args:
+        reviews: 各分片解析后的审查结果 (无法解析为 None)
+        raw_responses: 各分片的原始响应 (无法解析时放入 results)
+
+    Returns:
+        与完整审查格式一致的结果 (passed / results / defects / tests)
+    """
+    rank = {'high': 0, 'medium': 1, 'low': 2}
+    passed = True
+    results: List[str] = []
+    defects: Dict[Tuple[str, str], object] = {}
+    test_files: Dict[str, Dict] = {}
+    commands: List[str] = []
+    expected: List[str] = []
+
+    for index, (review, raw) in enumerate(zip(reviews, raw_responses), 1):
+        prefix = f'[分片 {index}/{len(reviews)}] '
+        if review is None:
+            passed = False
+            results.append(prefix + '无法解析审查结果: ' + raw)
+            defects.setdefault(('', f'shard{index}'), f'分片 {index} 无法解析审查结果,请查看原始响应')
+            continue
+        passed = passed and bool(review.get('passed', False))
+        results.extend(prefix + str(r) for r in review.get('results', []))
+        for defect in review.get('defects', []):
+            key = defect_key(defect)
+            kept = defects.get(key)
+            if kept is None or (isinstance(defect, dict) and isinstance(kept, dict) and
+                                rank.get(defect.get('severity'), 3) < rank.get(kept.get('severity'), 3)):
+                defects[key] = defect
+        tests = review.get('tests') or {}
+        for test_file in tests.get('files') or []:
+            if isinstance(test_file, dict) and test_file.get('path'):
+                test_files.setdefault(normalize_path(test_file['path']), test_file)
+        if tests.get('run_command') and tests['run_command'] not in commands:
+            commands.append(tests['run_command'])
+        if tests.get('expected_result') and tests['expected_result'] not in expected:
+            expected.append(tests['expected_result'])
+
+    return {
+        'passed': passed,
+        'results': results,
+        'defects': list(defects.values()),
+        'tests': {
+            'files': list(test_files.values()),
+            'run_command': ' && '.join(commands),
+            'expected_result': '\n'.join(expected)
+        }
+    }
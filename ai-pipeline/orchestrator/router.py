@@ -0,0 +1,180 @@
+# router.py
+# 多端点路由:在多个 OpenAI 兼容网关 / 模型之间按权重、实时延迟与错误率选择,并自动故障转移
+import json
+import os
+import random
+import threading
+from typing import Callable, Dict, List, Optional
+
+
+class Endpoint:
+    """一个可路由的 OpenAI 兼容端点 (网关 + 模型 + 密钥)"""
+
+    def __init__(
+        self,
+        base_url: Optional[str],
+        model: str,
+        api_key: Optional[str],
+        weight: float = 1.0,
+        name: Optional[str] = None
+    ):
+        self.base_url = base_url
+        self.model = model
+        self.api_key = api_key
+        self.weight = max(0.01, float(weight))
+        self.name = name or f'{base_url or "openai"}|{model}'
+
+        # 实时统计:延迟 EWMA 只用成功请求更新,错误率 EWMA 每次请求都更新
+        self.latency_ewma: Optional[float] = None
+        self.error_ewma = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    @classmethod
+    def from_dict(cls, data: dict, default_model: str, default_key: Optional[str]) -> 'Endpoint':
+        """
+        从配置项创建端点
+
+        配置项字段: base_url (必填)、model、api_key 或 api_key_env (存放密钥的环境变量名)、weight、name
+        """
+        if not data.get('base_url'):
+            raise ValueError(f'端点配置缺少 base_url: {data}')
+        api_key = data.get('api_key')
+        if not api_key and data.get('api_key_env'):
+            api_key = os.getenv(data['api_key_env'])
+        return cls(
+            base_url=data['base_url'],
+            model=data.get('model') or default_model,
+            api_key=api_key or default_key,
+            weight=data.get('weight', 1.0),
+            name=data.get('name')
+        )
+
+
+class EndpointRouter:
+    """
+    端点路由器 (进程内共享)
+
+    每次调用用 "两次随机选择" 挑选首选端点:按权重随机抽取两个端点,取得分较低者,
+    得分 = 延迟 EWMA × (1 + 错误率惩罚)。权重决定流量比例,得分决定两者之间谁胜出,
+    这样较慢的端点仍会持续收到少量请求,统计不会过时。从未请求过的端点得分为 0 (优先探索)。
+    其余端点按得分排序作为故障转移顺序,熔断中的端点排在最后。
+
+    配置 (LLM_ENDPOINTS,JSON 数组或 JSON 文件路径):
+        [{"name": "deepseek", "base_url": "https://api.deepseek.com/v1", "model": "deepseek-chat",
+          "api_key_env": "DEEPSEEK_API_KEY", "weight": 2},
+         {"name": "siliconflow", "base_url": "https://api.siliconflow.cn/v1",
+          "model": "deepseek-ai/DeepSeek-V3", "api_key_env": "SILICONFLOW_API_KEY"}]
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, endpoints: List[Endpoint], alpha: float = 0.3, error_penalty: float = 10.0,
+                 seed: Optional[int] = None):
+        """
+        Args:
+            endpoints: 端点列表
+            alpha: EWMA 平滑系数 (LLM_ROUTER_EWMA_ALPHA),越大越偏向最近的样本
+            error_penalty: 错误率惩罚系数 (LLM_ROUTER_ERROR_PENALTY)
+            seed: 随机种子
+        """
+        if not endpoints:
+            raise ValueError('端点列表不能为空')
+        self.endpoints = endpoints
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> Optional['EndpointRouter']:
+        """根据 LLM_ENDPOINTS 创建路由器,未配置时返回 None"""
+        value = os.getenv('LLM_ENDPOINTS', '').strip()
+        if not value:
+            return None
+        if not value.startswith('['):
+            with open(value, 'r', encoding='utf-8') as f:
+                value = f.read()
+        try:
+            items = json.loads(value)
+        except json.JSONDecodeError as e:
+            raise ValueError(f'LLM_ENDPOINTS 不是合法的 JSON: {str(e)}')
+
+        default_model = os.getenv('OPENAI_MODEL', 'gpt-4-turbo-preview')
+        default_key = os.getenv('OPENAI_API_KEY')
+        endpoints = [Endpoint.from_dict(item, default_model, default_key) for item in items]
+        return cls(
+            endpoints,
+            alpha=float(os.getenv('LLM_ROUTER_EWMA_ALPHA', '0.3')),
+            error_penalty=float(os.getenv('LLM_ROUTER_ERROR_PENALTY', '10'))
+        )
+
+    @classmethod
+    def shared(cls) -> Optional['EndpointRouter']:
+        """获取进程内共享的路由器 (所有流水线共享端点统计),未配置时返回 None"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls.from_env() or False
+            return cls._shared or None
+
+    def score(self, endpoint: Endpoint) -> float:
+        """端点得分,越低越好"""
+        with self._lock:
+            if endpoint.requests == 0:
+                return 0.0
+            latency = endpoint.latency_ewma
+            if latency is None:
+                # 只有失败记录:按当前最慢端点的延迟计算,避免得分为 0 被优先选中
+                known = [e.latency_ewma for e in self.endpoints if e.latency_ewma is not None]
+                latency = max(known) if known else 1.0
+            error = endpoint.error_ewma
+        return latency * (1 + self.error_penalty * error)
+
+    def ranked(self, available: Optional[Callable[[Endpoint], bool]] = None) -> List[Endpoint]:
+        """
+        本次调用的端点尝试顺序
+
+        Args:
+            available: 判断端点当前是否可用 (如熔断器未打开),不可用的端点排在最后
+
+        Returns:
+            端点列表,第一个为首选端点,其余为故障转移顺序
+        """
+        healthy = [e for e in self.endpoints if available is None or available(e)]
+        unhealthy = [e for e in self.endpoints if e not in healthy]
+        if not healthy:
+            return sorted(unhealthy, key=self.score)
+
+        with self._lock:
+            picks = self._random.choices(healthy, weights=[e.weight for e in healthy], k=2)
+        first = min(picks, key=self.score)
+        rest = sorted((e for e in healthy if e is not first), key=self.score)
+        return [first] + rest + sorted(unhealthy, key=self.score)
+
+    def record(self, endpoint: Endpoint, latency: float, ok: bool):
+        """记录一次调用结果"""
+        with self._lock:
+            endpoint.requests += 1
+            if ok:
+                endpoint.latency_ewma = latency if endpoint.latency_ewma is None else \
+                    self.alpha * latency + (1 - self.alpha) * endpoint.latency_ewma
+            else:
+                endpoint.errors += 1
+            endpoint.error_ewma = self.alpha * (0.0 if ok else 1.0) + (1 - self.alpha) * endpoint.error_ewma
+
+    def stats(self) -> Dict[str, Dict[str, object]]:
+        """各端点的请求数、错误数、延迟与错误率 EWMA"""
+        with self._lock:
+            return {
+                e.name: {
+                    'base_url': e.base_url,
+                    'model': e.model,
+                    'weight': e.weight,
+                    'requests': e.requests,
+                    'errors': e.errors,
+                    'latency_ewma': round(e.latency_ewma, 3) if e.latency_ewma is not None else None,
+                    'error_rate': round(e.error_ewma, 3),
+                }
+                for e in self.endpoints
+            }
@@ -0,0 +1,61 @@
+# runs.py
+# 运行目录管理:每次运行分配独立的 run ID 与目录,多条流水线可以在同一主机上并发运行
+import json
+import os
+import secrets
+import tempfile
+import time
+from typing import Dict, Optional, Tuple
+
+RUN_INFO_FILE = 'run.json'
+
+
+def output_root(root: Optional[str] = None) -> str:
+    """输出根目录: 参数 > PIPELINE_OUTPUT_ROOT > 系统临时目录下的 ai_pipeline_output"""
+    return root or os.getenv('PIPELINE_OUTPUT_ROOT') or os.path.join(tempfile.gettempdir(), 'ai_pipeline_output')
+
+
+def new_run_id() -> str:
+    """生成 run ID: 时间戳 + 随机后缀,按字典序即按时间排序"""
+    return f'{time.strftime("%Y%m%d-%H%M%S")}-{secrets.token_hex(3)}'
+
+
+def create_run_dir(root: Optional[str] = None, kind: str = 'runs') -> Tuple[str, str]:
+    """
+    创建新的运行目录 <输出根目录>/<kind>/<run ID>/
+
+    Args:
+        root: 输出根目录,为空时见 output_root()
+        kind: 子目录 (单次运行为 runs,批量运行为 batches)
+
+    Returns:
+        (run ID, 运行目录)
+    """
+    parent = os.path.join(output_root(root), kind)
+    os.makedirs(parent, exist_ok=True)
+    while True:
+        run_id = new_run_id()
+        run_dir = os.path.join(parent, run_id)
+        try:
+            os.makedirs(run_dir)
+            return run_id, run_dir
+        except FileExistsError:
+            continue
+
+
+def write_run_info(run_dir: str, info: Dict):
+    """写入运行信息 run.json (先写临时文件再替换,读取方不会看到写了一半的文件)"""
+    path = os.path.join(run_dir, RUN_INFO_FILE)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(info, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def read_run_info(run_dir: str) -> Dict:
+    """读取运行信息 run.json,不存在时返回空字典"""
+    try:
+        with open(os.path.join(run_dir, RUN_INFO_FILE), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
@@ -0,0 +1,236 @@
+# sandbox.py
+# 本地测试验证:把审查生成的测试文件与代码一起写入独立的工作目录,
+# 在受 CPU / 内存 / 时间限制的子进程中并行运行,失败的测试输出作为缺陷交给修复步骤
+import importlib.util
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from fanout import normalize_path
+
+# 测试文件名 (pytest 默认的收集规则)
+TEST_FILE_PATTERN = re.compile(r'(^|/)(test_[^/]*|[^/]*_test)\.py$')
+# 传递给测试进程的环境变量 (其余变量,尤其是 API Key,不会传入)
+PASSTHROUGH_ENV = ('PATH', 'LANG', 'LC_ALL', 'TZ', 'SYSTEMROOT', 'TMP', 'TEMP')
+# 写入缺陷描述的测试输出上限 (字符)
+MAX_OUTPUT_CHARS = 3000
+# pytest 简要汇总中失败的测试 (FAILED / ERROR 节点 ID)
+FAILED_TEST_PATTERN = re.compile(r'^(?:FAILED|ERROR) (\S+::\S+|\S+\.py)', re.MULTILINE)
+
+
+# POSIX 上先设置 CPU 时间与地址空间上限再 exec 测试命令
+# (多线程进程中使用 preexec_fn 可能死锁,因此由子进程自己设置)
+LIMIT_BOOTSTRAP = """
+import os, resource, sys
+cpu, memory = int(sys.argv[1]), int(sys.argv[2])
+if cpu:
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+if memory:
+    resource.setrlimit(resource.RLIMIT_AS, (memory * 1024 * 1024, memory * 1024 * 1024))
+os.execv(sys.argv[3], sys.argv[3:])
+"""
+
+
+class SandboxPool:
+    """
+    测试子进程池
+
+    进程内共享 (见 shared()),多轮修复、多个候选修复或批量模式的多个任务同时验证时
+    共用同一个并发上限。每个测试文件在独立的子进程中运行:
+    工作目录为本次验证的副本,环境变量只保留 PASSTHROUGH_ENV,POSIX 上限制 CPU 时间与内存。
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, workers: int = 4, timeout: float = 60.0, cpu_seconds: int = 0, memory_mb: int = 1024):
+        """
+        Args:
+            workers: 同时运行的测试进程数
+            timeout: 单个测试进程的墙钟超时 (秒)
+            cpu_seconds: 单个测试进程的 CPU 时间上限 (秒,0 表示与 timeout 相同)
+            memory_mb: 单个测试进程的内存上限 (MB,0 表示不限)
+        """
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds or int(timeout)
+        self.memory_mb = memory_mb
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='sandbox')
+
+    @classmethod
+    def from_env(cls) -> 'SandboxPool':
+        """从环境变量创建 (PIPELINE_TEST_WORKERS / TIMEOUT / CPU_SECONDS / MEMORY_MB)"""
+        return cls(
+            workers=int(os.getenv('PIPELINE_TEST_WORKERS', '4')),
+            timeout=float(os.getenv('PIPELINE_TEST_TIMEOUT', '60')),
+            cpu_seconds=int(os.getenv('PIPELINE_TEST_CPU_SECONDS', '0')),
+            memory_mb=int(os.getenv('PIPELINE_TEST_MEMORY_MB', '1024'))
+        )
+
+    @classmethod
+    def shared(cls) -> 'SandboxPool':
+        """获取进程内共享的测试进程池"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls.from_env()
+            return cls._shared
+
+    def _env(self, work_dir: str) -> Dict[str, str]:
+        env = {key: os.environ[key] for key in PASSTHROUGH_ENV if key in os.environ}
+        env.update({
+            'HOME': work_dir,
+            'PYTHONPATH': os.pathsep.join([work_dir, os.path.join(work_dir, 'src')]),
+            'PYTHONDONTWRITEBYTECODE': '1',
+            'PYTHONHASHSEED': '0',
+        })
+        return env
+
+    def run(self, work_dir: str, test_path: str) -> Dict:
+        """
+        在子进程中运行一个测试文件
+
+        Returns:
+            {'file', 'status' (passed / failed / error / timeout / empty), 'returncode', 'output', 'elapsed'}
+        """
+        command = [sys.executable, '-m', 'pytest', '-q', '--tb=short', '-p', 'no:cacheprovider', test_path]
+        options = {}
+        if os.name == 'posix':
+            command = [sys.executable, '-c', LIMIT_BOOTSTRAP, str(self.cpu_seconds), str(self.memory_mb)] + command
+            options['start_new_session'] = True
+
+        started_at = time.perf_counter()
+        process = subprocess.Popen(command, cwd=work_dir, env=self._env(work_dir), stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **options)
+        try:
+            output, _ = process.communicate(timeout=self.timeout)
+            status = {0: 'passed', 1: 'failed', 5: 'empty'}.get(process.returncode, 'error')
+        except subprocess.TimeoutExpired:
+            # 结束整个进程组 (测试可能启动了子进程)
+            if os.name == 'posix':
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    # 进程组在超时后、结束前已经退出
+                    pass
+            else:
+                process.kill()
+            output, _ = process.communicate()
+            status = 'timeout'
+        if os.name == 'posix' and process.returncode in (-signal.SIGKILL, -signal.SIGXCPU) and status != 'timeout':
+            status = 'timeout'
+
+        return {
+            'file': test_path,
+            'status': status,
+            'returncode': process.returncode,
+            'output': output.decode('utf-8', errors='replace'),
+            'elapsed': round(time.perf_counter() - started_at, 3)
+        }
+
+    def map(self, work_dir: str, test_paths: List[str]) -> List[Dict]:
+        """并行运行多个测试文件 (与其他调用方共用进程池的并发上限)"""
+        futures = [self._executor.submit(self.run, work_dir, path) for path in test_paths]
+        return [future.result() for future in futures]
+
+
+def materialize(code_blocks: List[Tuple[str, str]], tests: Dict, work_dir: str) -> List[str]:
+    """
+    把代码与审查生成的测试文件写入工作目录
+
+    审查给出的测试文件与生成的代码同名时覆盖生成的版本 (只影响工作目录)。
+
+    Returns:
+        要运行的测试文件 (审查生成的测试文件,以及代码中本来就有的测试文件)
+    """
+    test_blocks = [(f['path'], f.get('content') or '') for f in (tests or {}).get('files') or []
+                   if isinstance(f, dict) and f.get('path') and f['path'].endswith('.py')]
+
+    written = []
+    for path, content in code_blocks + test_blocks:
+        # 与 write_files_from_codeblock 相同的路径检查
+        if '..' in path or path.startswith('/'):
+            continue
+        path = normalize_path(path)
+        full_path = os.path.join(work_dir, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        written.append(path)
+
+    test_paths = []
+    for path in [normalize_path(p) for p, _ in test_blocks + code_blocks]:
+        if path in written and TEST_FILE_PATTERN.search(path) and path not in test_paths:
+            test_paths.append(path)
+    return test_paths
+
+
+def _failure_defect(result: Dict, test_sources: Dict[str, str]) -> Dict:
+    """失败的测试运行 → 审查缺陷格式 (审查生成的测试不在代码中,附上测试代码供修复参考)"""
+    output = result['output'].strip()
+    if len(output) > MAX_OUTPUT_CHARS:
+        output = '...\n' + output[-MAX_OUTPUT_CHARS:]
+    reason = {
+        'failed': '测试失败',
+        'error': f'测试无法运行 (退出码 {result["returncode"]})',
+        'timeout': '测试超时或超出 CPU 时间限制',
+    }[result['status']]
+    # 测试输出含耗时等每轮都会变化的内容,缺陷去重与收敛判断按 status + tests 进行 (见 review_shards.defect_key)
+    defect = {
+        'severity': 'high',
+        'category': 'test',
+        'file': result['file'],
+        'status': result['status'],
+        'tests': sorted(set(FAILED_TEST_PATTERN.findall(result['output']))),
+        'description': f'{reason}: {result["file"]}\n{output}',
+        'recommendation': '根据测试输出与回溯修复被测代码 (测试本身有误时修正测试)'
+    }
+    if result['file'] in test_sources:
+        defect['test_code'] = test_sources[result['file']][:MAX_OUTPUT_CHARS]
+    return defect
+
+
+def verify(code_blocks: List[Tuple[str, str]], tests: Dict, work_dir: str,
+           pool: Optional[SandboxPool] = None) -> Dict:
+    """
+    在本地运行测试验证代码
+
+    Args:
+        code_blocks: 要验证的代码块
+        tests: 审查结果中的 tests 字段 (files / run_command / expected_result)
+        work_dir: 本次验证的独立工作目录
+        pool: 测试进程池,默认为进程内共享的池
+
+    Returns:
+        {'passed', 'skipped', 'defects', 'results', 'elapsed'};
+        没有可运行的 Python 测试或未安装 pytest 时 skipped 为原因
+    """
+    started_at = time.perf_counter()
+    if importlib.util.find_spec('pytest') is None:
+        return {'passed': True, 'skipped': '未安装 pytest', 'defects': [], 'results': [], 'elapsed': 0.0}
+
+    # 续跑时工作目录可能残留上次的文件
+    shutil.rmtree(work_dir, ignore_errors=True)
+    os.makedirs(work_dir, exist_ok=True)
+    test_paths = materialize(code_blocks, tests, work_dir)
+    if not test_paths:
+        return {'passed': True, 'skipped': '没有可运行的 Python 测试文件', 'defects': [], 'results': [],
+                'elapsed': 0.0}
+
+    results = (pool or SandboxPool.shared()).map(work_dir, test_paths)
+    test_sources = {normalize_path(f['path']): f.get('content') or '' for f in (tests or {}).get('files') or []
+                    if isinstance(f, dict) and f.get('path')}
+    defects = [_failure_defect(r, test_sources) for r in results if r['status'] in ('failed', 'error', 'timeout')]
+    return {
+        'passed': not defects,
+        'skipped': None,
+        'defects': defects,
+        'results': [{k: v for k, v in r.items() if k != 'output'} for r in results],
+        'elapsed': round(time.perf_counter() - started_at, 3)
+    }
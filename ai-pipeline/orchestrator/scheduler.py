@@ -0,0 +1,361 @@
+# scheduler.py
+# 阶段调度器:把流水线各阶段表示为依赖图,依赖满足即并行执行,并记录每个阶段的耗时
+import importlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+
+class PipelineAbort(RuntimeError):
+    """阶段主动终止流水线 (如未生成任何代码),不属于程序错误"""
+
+
+class StageTimeoutError(TimeoutError):
+    """阶段执行超过超时时间"""
+
+
+class Stage:
+    """
+    流水线中的一个阶段 (依赖图节点)
+
+    func 接收调度上下文 (PipelineContext),返回值保存在 ctx.results[name]。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[[Any], Any],
+        deps: Sequence[str] = (),
+        kind: Optional[str] = None,
+        limit: Optional[int] = None,
+        timeout: Optional[float] = None,
+        required: bool = True
+    ):
+        """
+        Args:
+            name: 阶段名称 (唯一)
+            func: 阶段函数 func(ctx)
+            deps: 依赖的阶段名称,依赖阶段及其派生的阶段全部成功后才会执行
+            kind: 阶段类别 (并发限制按类别计算),默认与名称相同
+            limit: 同一类别同时执行的最大阶段数
+            timeout: 超时秒数 (从开始执行计时),为空时使用调度器默认值
+            required: 必需阶段失败会终止流水线;非必需阶段失败只跳过依赖它的阶段
+        """
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.kind = kind or name
+        self.limit = limit
+        self.timeout = timeout
+        self.required = required
+
+
+class StageRecord:
+    """阶段的执行状态与耗时"""
+
+    def __init__(self, stage: Stage, parent: Optional[str]):
+        self.stage = stage
+        self.parent = parent
+        self.children: List[str] = []
+        self.status = 'pending'  # pending / running / ok / failed / timeout / skipped
+        self.error: Optional[BaseException] = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+
+# 插件注册的阶段 (PIPELINE_PLUGINS 中的模块导入时调用 register_stage)
+_registry: List[Stage] = []
+_loaded_plugins = set()
+
+
+def register_stage(name: str, deps: Sequence[str] = (), **options) -> Callable:
+    """
+    注册自定义阶段的装饰器,与内置阶段同名时替换内置阶段
+
+    示例:
+        @register_stage('lint', deps=['write'], required=False)
+        def lint(ctx):
+            ...
+    """
+    def decorator(func: Callable[[Any], Any]) -> Callable[[Any], Any]:
+        _registry[:] = [s for s in _registry if s.name != name]
+        _registry.append(Stage(name, func, deps, **options))
+        return func
+    return decorator
+
+
+def registered_stages() -> List[Stage]:
+    """加载 PIPELINE_PLUGINS (逗号分隔的模块名) 并返回已注册的自定义阶段"""
+    for module in os.getenv('PIPELINE_PLUGINS', '').split(','):
+        module = module.strip()
+        if module and module not in _loaded_plugins:
+            importlib.import_module(module)
+            _loaded_plugins.add(module)
+    return list(_registry)
+
+
+class StageScheduler:
+    """
+    依赖图调度器
+
+    - 依赖全部成功的阶段立即在独立线程中执行,无依赖关系的阶段并行
+    - 阶段执行中可以用 spawn() 派生后续阶段 (如审查未通过时派生修复与复审),
+      依赖某阶段的节点会等待它派生的阶段全部完成
+    - 并发按阶段类别限制 (Stage.limit / PIPELINE_STAGE_LIMITS),总并发为 PIPELINE_MAX_WORKERS
+    - 阶段超时 (Stage.timeout / PIPELINE_STAGE_TIMEOUT) 记为失败;线程无法强制中止,
+      超时阶段的结果会被丢弃
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, default_timeout: Optional[float] = None,
+                 limits: Optional[Dict[str, int]] = None, listener: Optional[Callable[[Dict], None]] = None,
+                 stop: Optional[threading.Event] = None):
+        """
+        Args:
+            max_workers: 同时执行的最大阶段数 (PIPELINE_MAX_WORKERS, 默认 4)
+            default_timeout: 阶段默认超时秒数 (PIPELINE_STAGE_TIMEOUT, 默认 0 表示不限)
+            limits: 各类别的并发上限 (PIPELINE_STAGE_LIMITS, JSON 对象,如 {"review": 2})
+            listener: 阶段事件回调,接收 {'event': stage_started / stage_finished, 'stage', ...}
+                      (用于服务模式的进度事件流,回调中的异常会被忽略)
+            stop: 中止信号,设置后不再启动新的阶段,等待执行中的阶段结束后抛出 PipelineAbort
+                  (如任务队列中 worker 的租约已被回收)
+        """
+        self.listener = listener
+        self.stop = stop
+        self.max_workers = max_workers or int(os.getenv('PIPELINE_MAX_WORKERS', '4'))
+        if default_timeout is None:
+            default_timeout = float(os.getenv('PIPELINE_STAGE_TIMEOUT', '0'))
+        self.default_timeout = default_timeout or None
+        self.limits: Dict[str, int] = {}
+        self._env_limits = limits if limits is not None else json.loads(os.getenv('PIPELINE_STAGE_LIMITS') or '{}')
+        self.records: Dict[str, StageRecord] = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._started_at: Optional[float] = None
+        self.elapsed: Optional[float] = None
+
+    def add(self, stage: Stage, parent: Optional[str] = None):
+        """添加阶段"""
+        with self._lock:
+            if stage.name in self.records:
+                raise ValueError(f'阶段名称重复: {stage.name}')
+            self.records[stage.name] = StageRecord(stage, parent)
+            if parent:
+                self.records[parent].children.append(stage.name)
+            limit = self._env_limits.get(stage.kind, stage.limit)
+            if limit:
+                self.limits[stage.kind] = int(limit)
+
+    def spawn(self, stage: Stage):
+        """在阶段执行过程中派生后续阶段 (作为当前阶段的子阶段)"""
+        self.add(stage, parent=getattr(self._local, 'current', None))
+
+    def run(self, ctx: Any) -> Dict[str, Any]:
+        """
+        执行所有阶段直到完成
+
+        Args:
+            ctx: 调度上下文,需要有 results 字典属性;调度器会设置 ctx.scheduler
+
+        Returns:
+            各阶段的返回值 {阶段名称: 返回值}
+
+        Raises:
+            必需阶段抛出的第一个异常 (等待其余执行中的阶段结束后抛出)
+        """
+        ctx.scheduler = self
+        self._started_at = time.perf_counter()
+        running: Dict[Future, str] = {}
+        failure: Optional[BaseException] = None
+
+        while True:
+            if failure is None and self.stop is not None and self.stop.is_set():
+                print('✗ 收到中止信号,不再启动新的阶段')
+                failure = PipelineAbort('运行已被中止')
+            if failure is None:
+                for name in self._ready(running):
+                    running[self._submit(name, ctx)] = name
+
+            if not running:
+                break
+
+            done, _ = wait(list(running), timeout=self._next_deadline(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                record = self.records[name]
+                error = future.exception()
+                if error is None:
+                    ctx.results[name] = future.result()
+                    record.status = 'ok'
+                else:
+                    record.status, record.error = 'failed', error
+                    failure = failure or self._report_failure(record)
+                self._emit_finished(record)
+
+            for future, name in list(running.items()):
+                record = self.records[name]
+                timeout = record.stage.timeout or self.default_timeout
+                if timeout and record.started_at is not None and \
+                        time.perf_counter() - record.started_at > timeout:
+                    running.pop(future)
+                    record.status, record.finished_at = 'timeout', time.perf_counter()
+                    record.error = StageTimeoutError(f'阶段 {name} 超时 ({timeout:g}s)')
+                    failure = failure or self._report_failure(record)
+                    self._emit_finished(record)
+
+        self.elapsed = time.perf_counter() - self._started_at
+        with self._lock:
+            for record in self.records.values():
+                if record.status == 'pending':
+                    record.status = 'skipped'
+        if failure is not None:
+            raise failure
+        return ctx.results
+
+    def _submit(self, name: str, ctx: Any) -> Future:
+        """在独立的守护线程中执行阶段 (超时的阶段不会占用后续阶段的线程)"""
+        record = self.records[name]
+        future: Future = Future()
+
+        def target():
+            self._local.current = name
+            record.started_at = time.perf_counter()
+            self._emit({'event': 'stage_started', 'stage': name, 'kind': record.stage.kind,
+                        'parent': record.parent})
+            result, error = None, None
+            try:
+                result = record.stage.func(ctx)
+            except BaseException as e:
+                error = e
+            if record.status != 'timeout':
+                record.finished_at = time.perf_counter()
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        future.set_running_or_notify_cancel()
+        threading.Thread(target=target, name=f'stage-{name}', daemon=True).start()
+        return future
+
+    def _emit(self, event: Dict):
+        if self.listener is None:
+            return
+        try:
+            self.listener(event)
+        except Exception:
+            pass
+
+    def _emit_finished(self, record: StageRecord):
+        elapsed = None
+        if record.started_at is not None and record.finished_at is not None:
+            elapsed = round(record.finished_at - record.started_at, 3)
+        self._emit({'event': 'stage_finished', 'stage': record.stage.name, 'status': record.status,
+                    'elapsed': elapsed, 'error': str(record.error) if record.error else None})
+
+    def _report_failure(self, record: StageRecord) -> Optional[BaseException]:
+        """输出阶段失败信息;必需阶段返回其异常 (用于终止调度)"""
+        if isinstance(record.error, PipelineAbort):
+            return record.error
+        if record.stage.required:
+            print(f'✗ 阶段 {record.stage.name} 失败: {str(record.error)}')
+            return record.error
+        print(f'⚠️  阶段 {record.stage.name} 失败 (非必需,跳过依赖它的阶段): {str(record.error)}')
+        return None
+
+    def _outcome(self, name: str, child: bool = False) -> Optional[bool]:
+        """
+        阶段及其派生阶段是否全部成功,尚未完成时返回 None
+
+        派生的非必需阶段失败不影响父阶段的结果,但依赖它的阶段会被跳过。
+        """
+        record = self.records.get(name)
+        if record is None:
+            raise ValueError(f'未知的依赖阶段: {name}')
+        if record.status in ('pending', 'running'):
+            return None
+        if record.status != 'ok':
+            return child and not record.stage.required
+        outcomes = [self._outcome(name, child=True) for name in record.children]
+        if None in outcomes:
+            return None
+        return all(outcomes)
+
+    def _ready(self, running: Dict[Future, str]) -> List[str]:
+        """可以开始执行的阶段 (依赖已成功,且未超出总并发与类别并发限制)"""
+        with self._lock:
+            active: Dict[str, int] = {}
+            for name in running.values():
+                kind = self.records[name].stage.kind
+                active[kind] = active.get(kind, 0) + 1
+
+            ready = []
+            for name, record in self.records.items():
+                if record.status != 'pending':
+                    continue
+                outcomes = [self._outcome(dep) for dep in record.stage.deps]
+                if False in outcomes:
+                    record.status = 'skipped'
+                    continue
+                if None in outcomes:
+                    continue
+                kind = record.stage.kind
+                if len(running) + len(ready) >= self.max_workers:
+                    break
+                if kind in self.limits and active.get(kind, 0) >= self.limits[kind]:
+                    continue
+                record.status = 'running'
+                active[kind] = active.get(kind, 0) + 1
+                ready.append(name)
+            return ready
+
+    def _next_deadline(self, running: Dict[Future, str]) -> Optional[float]:
+        """距最近一个阶段超时的秒数,用于等待时及时检查超时"""
+        now = time.perf_counter()
+        remaining = []
+        for name in running.values():
+            record = self.records[name]
+            timeout = record.stage.timeout or self.default_timeout
+            if timeout:
+                # 线程刚启动、尚未开始计时的阶段按当前时间估算
+                started = record.started_at if record.started_at is not None else now
+                remaining.append(max(0.0, started + timeout - now) + 0.01)
+        return min(remaining) if remaining else None
+
+    def timeline(self) -> List[Dict]:
+        """各阶段的状态与耗时 (相对调度开始时间的秒数),按开始时间排序"""
+        items = []
+        base = self._started_at or 0.0
+        for name, record in self.records.items():
+            start = record.started_at - base if record.started_at is not None else None
+            end = record.finished_at - base if record.finished_at is not None else None
+            items.append({
+                'stage': name,
+                'kind': record.stage.kind,
+                'parent': record.parent,
+                'deps': record.stage.deps,
+                'status': record.status,
+                'start': round(start, 3) if start is not None else None,
+                'end': round(end, 3) if end is not None else None,
+                'elapsed': round(end - start, 3) if start is not None and end is not None else None,
+                'error': str(record.error) if record.error else None,
+            })
+        return sorted(items, key=lambda item: (item['start'] is None, item['start'] or 0))
+
+    def format_timeline(self) -> str:
+        """格式化阶段耗时,用于控制台输出"""
+        icons = {'ok': '✓', 'failed': '✗', 'timeout': '✗', 'skipped': '-', 'pending': '-', 'running': '…'}
+        lines = []
+        busy = 0.0
+        for item in self.timeline():
+            if item['start'] is None:
+                lines.append(f'  {icons[item["status"]]} {item["stage"]:<18} {item["status"]}')
+                continue
+            busy += item['elapsed'] or 0.0
+            elapsed = f'{item["elapsed"]:.2f}s' if item['elapsed'] is not None else '-'
+            lines.append(f'  {icons[item["status"]]} {item["stage"]:<18} {item["start"]:>7.2f}s 开始  耗时 {elapsed}')
+        if self.elapsed is not None:
+            lines.append(f'  总耗时 {self.elapsed:.2f}s (各阶段耗时合计 {busy:.2f}s)')
+        return '\n'.join(lines)
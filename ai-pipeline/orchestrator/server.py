@@ -0,0 +1,473 @@
+# server.py
+# 服务模式:在本机常驻的 HTTP 服务中运行流水线,复用已导入的模块、长连接 LLM 客户端与提示词模板,
+# 提供任务提交、进度事件流 (SSE) 与产物下载接口,CI 可以直接提交任务而无需启动新进程
+import io
+import json
+import os
+import re
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+
+from llm_client import LLMClient
+from runs import create_run_dir
+
+PROMPT_DIR = 'orchestrator/prompts'
+# 请求体上限 (字节)
+MAX_BODY_BYTES = 1024 * 1024
+# 事件流的心跳间隔 (秒),保持连接不被代理断开
+HEARTBEAT_SECONDS = 15
+FINISHED_STATUSES = ('passed', 'failed', 'aborted', 'error')
+# 每个任务的控制台输出写入运行目录下的该文件 (与批量模式的进程 worker 一致)
+JOB_LOG_FILE = 'pipeline.log'
+
+
+class JobOutput(io.TextIOBase):
+    """
+    按线程分流的 stdout / stderr
+
+    并发任务共用一个进程,print 输出按当前线程绑定的任务日志分流,未绑定的线程写入原来的控制台。
+    install() 之后,线程在启动时继承创建者的绑定 (调度器的阶段线程),提交到线程池的任务
+    在执行时使用提交者的绑定 (共享线程池的 worker 线程因此不会固定写入某一个任务的日志)。
+    """
+
+    _installed: Optional['JobOutput'] = None
+    _install_lock = threading.Lock()
+
+    def __init__(self, console):
+        self.console = console
+        self._local = threading.local()
+
+    def current(self):
+        """当前线程绑定的日志文件 (未绑定时为 None)"""
+        return getattr(self._local, 'stream', None)
+
+    def bind(self, stream):
+        """绑定当前线程的输出目标,返回之前的绑定"""
+        previous = self.current()
+        self._local.stream = stream
+        return previous
+
+    def _target(self):
+        stream = self.current()
+        return stream if stream is not None and not stream.closed else self.console
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def wrap(self, fn):
+        """把调用方的绑定带到执行 fn 的线程"""
+        stream = self.current()
+        if stream is None:
+            return fn
+
+        def bound(*args, **kwargs):
+            previous = self.bind(stream)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.bind(previous)
+        return bound
+
+    @classmethod
+    def install(cls) -> 'JobOutput':
+        """替换 sys.stdout / sys.stderr 并让新线程与线程池任务继承绑定 (进程内只安装一次)"""
+        with cls._install_lock:
+            if cls._installed is not None:
+                return cls._installed
+            output = cls(sys.stdout)
+            thread_start = threading.Thread.start
+            pool_submit = ThreadPoolExecutor.submit
+
+            def start(thread, *args, **kwargs):
+                thread.run = output.wrap(thread.run)
+                return thread_start(thread, *args, **kwargs)
+
+            def submit(executor, fn, /, *args, **kwargs):
+                return pool_submit(executor, output.wrap(fn), *args, **kwargs)
+
+            threading.Thread.start = start
+            ThreadPoolExecutor.submit = submit
+            sys.stdout = sys.stderr = output
+            cls._installed = output
+            return output
+
+
+class Job:
+    """服务中的一次流水线运行: 请求参数、状态与进度事件"""
+
+    def __init__(self, job_id: str, request: Dict, output_dir: str):
+        self.id = job_id
+        self.request = request
+        self.output_dir = output_dir
+        self.status = 'queued'
+        self.outcome: Optional[Dict] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.events: List[Dict] = []
+        self._cond = threading.Condition()
+
+    def emit(self, event: Dict):
+        """追加一个进度事件 (由流水线各线程调用)"""
+        with self._cond:
+            self.events.append(dict(event, seq=len(self.events), time=round(time.time(), 3)))
+            self._cond.notify_all()
+
+    def finish(self, status: str, outcome: Optional[Dict] = None):
+        with self._cond:
+            self.status, self.outcome, self.finished_at = status, outcome, time.time()
+            self._cond.notify_all()
+
+    def wait_events(self, after: int, timeout: float) -> Tuple[List[Dict], bool]:
+        """
+        等待序号 >= after 的事件
+
+        Returns:
+            (新事件, 任务是否已结束)
+        """
+        with self._cond:
+            if len(self.events) <= after and self.status not in FINISHED_STATUSES:
+                self._cond.wait(timeout)
+            return self.events[after:], self.status in FINISHED_STATUSES
+
+    def summary(self) -> Dict:
+        return {
+            'id': self.id,
+            'status': self.status,
+            'requirement': self.request['requirement'],
+            'output_dir': self.output_dir,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'events': len(self.events),
+            'outcome': self.outcome,
+        }
+
+
+class PipelineServer:
+    """
+    常驻的流水线服务
+
+    启动时创建 LLM 客户端并预加载提示词模板;所有任务共用该客户端 (连接池、限流、重试统计与端点路由),
+    最多 workers 个任务同时运行,其余任务排队。任务输出写入 <输出根目录>/runs/<run ID>/,
+    控制台输出写入其中的 pipeline.log。
+
+    已结束的任务超过保留时间或数量上限后从内存中移除 (运行目录保留在磁盘上),
+    移除后查询该任务返回 404。
+    """
+
+    def __init__(self, workers: Optional[int] = None, output_root: Optional[str] = None,
+                 client: Optional[LLMClient] = None, token: Optional[str] = None,
+                 job_ttl: Optional[float] = None, max_finished: Optional[int] = None):
+        """
+        Args:
+            workers: 同时运行的任务数 (PIPELINE_SERVER_WORKERS, 默认 2)
+            output_root: 输出根目录 (为空时使用 PIPELINE_OUTPUT_ROOT)
+            client: 常驻的 LLM 客户端,为空时按 LLM_PROVIDER 创建
+            token: 访问令牌 (PIPELINE_SERVER_TOKEN),设置后请求须带 Authorization: Bearer <token>
+            job_ttl: 已结束任务的保留时间,秒 (PIPELINE_SERVER_JOB_TTL, 默认 3600)
+            max_finished: 已结束任务的保留数量上限 (PIPELINE_SERVER_MAX_FINISHED, 默认 100)
+        """
+        from orchestrator import load_prompt
+
+        self.workers = max(1, workers or int(os.getenv('PIPELINE_SERVER_WORKERS', '2')))
+        self.output_root = output_root
+        self.token = token if token is not None else os.getenv('PIPELINE_SERVER_TOKEN') or None
+        self.job_ttl = job_ttl if job_ttl is not None else float(os.getenv('PIPELINE_SERVER_JOB_TTL', '3600'))
+        self.max_finished = max_finished if max_finished is not None else \
+            int(os.getenv('PIPELINE_SERVER_MAX_FINISHED', '100'))
+        self.output = JobOutput.install()
+        self.client = client or LLMClient(provider=os.getenv('LLM_PROVIDER', 'openai'))
+        self.jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pipeline-job')
+        self.started_at = time.time()
+
+        # 预加载提示词模板 (load_prompt 按修改时间缓存)
+        if os.path.isdir(PROMPT_DIR):
+            for name in sorted(os.listdir(PROMPT_DIR)):
+                if name.endswith('.txt'):
+                    load_prompt(os.path.join(PROMPT_DIR, name))
+
+    def submit(self, request: Dict) -> Job:
+        """
+        提交任务
+
+        Args:
+            request: {"requirement": "...", "max_iterations": 2, "stream": false, "fanout": false}
+
+        Raises:
+            ValueError: 请求参数无效
+        """
+        if not isinstance(request, dict) or not str(request.get('requirement') or '').strip():
+            raise ValueError('缺少 requirement')
+        max_iterations = request.get('max_iterations', 2)
+        if not isinstance(max_iterations, int) or max_iterations < 0:
+            raise ValueError('max_iterations 须为非负整数')
+        request = {
+            'requirement': str(request['requirement']),
+            'max_iterations': max_iterations,
+            'stream': request.get('stream'),
+            'fanout': request.get('fanout'),
+        }
+
+        run_id, output_dir = create_run_dir(self.output_root)
+        job = Job(run_id, request, output_dir)
+        with self._lock:
+            self._evict()
+            self.jobs[job.id] = job
+        job.emit({'event': 'job_queued', 'id': job.id})
+        self._executor.submit(self._run, job)
+        return job
+
+    def _run(self, job: Job):
+        from orchestrator import main
+
+        job.status, job.started_at = 'running', time.time()
+        log = open(os.path.join(job.output_dir, JOB_LOG_FILE), 'w', encoding='utf-8')
+        previous = self.output.bind(log)
+        try:
+            outcome = main(job.request['requirement'], job.request['max_iterations'],
+                           stream=job.request['stream'], fanout=job.request['fanout'],
+                           output_dir=job.output_dir, client=self.client, on_event=job.emit)
+            job.finish(outcome['status'], outcome)
+        except Exception as e:
+            traceback.print_exc()
+            job.emit({'event': 'run_finished', 'status': 'error', 'error': str(e)})
+            job.finish('error', {'status': 'error', 'passed': False, 'error': str(e)})
+        finally:
+            self.output.bind(previous)
+            log.close()
+        print(f'{"✓" if job.status == "passed" else "✗"} 任务 {job.id}: {job.status} '
+              f'({job.finished_at - job.started_at:.1f}s)')
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        """移除超过保留时间或数量上限的已结束任务 (调用方持有 _lock)"""
+        now = time.time()
+        finished = sorted((job for job in self.jobs.values() if job.status in FINISHED_STATUSES),
+                          key=lambda job: job.finished_at)
+        expired = [job for job in finished if now - job.finished_at > self.job_ttl]
+        overflow = finished[:max(0, len(finished) - self.max_finished)]
+        for job in expired + overflow:
+            self.jobs.pop(job.id, None)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def list(self) -> List[Job]:
+        with self._lock:
+            self._evict()
+            return sorted(self.jobs.values(), key=lambda job: job.created_at)
+
+    def stats(self) -> Dict:
+        """服务状态: 任务计数与常驻客户端的连接 / 重试 / 缓存统计"""
+        counts: Dict[str, int] = {}
+        for job in self.list():
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            'status': 'ok',
+            'uptime': round(time.time() - self.started_at, 1),
+            'workers': self.workers,
+            'jobs': counts,
+            'connections': self.client.connection_stats(),
+            'retries': self.client.retry_stats(),
+            'cache': self.client.cache_stats(),
+        }
+
+    def shutdown(self):
+        """停止接收任务并等待运行中的任务结束"""
+        self._executor.shutdown(wait=True)
+
+
+def artifact_path(output_dir: str, relative: str) -> Optional[str]:
+    """运行目录中的产物文件路径 (拒绝目录之外的路径)"""
+    root = os.path.realpath(output_dir)
+    path = os.path.realpath(os.path.join(root, relative))
+    if not path.startswith(root + os.sep) or not os.path.isfile(path):
+        return None
+    return path
+
+
+def list_artifacts(output_dir: str) -> List[Dict]:
+    """运行目录中的全部文件 (相对路径与大小)"""
+    items = []
+    for directory, _, names in os.walk(output_dir):
+        for name in sorted(names):
+            if name.endswith('.tmp'):
+                continue
+            full_path = os.path.join(directory, name)
+            items.append({'path': os.path.relpath(full_path, output_dir).replace(os.sep, '/'),
+                          'size': os.path.getsize(full_path)})
+    return sorted(items, key=lambda item: item['path'])
+
+
+class PipelineRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP 接口
+
+    - GET  /health                          服务状态
+    - POST /jobs                            提交任务,返回 202 与任务信息
+    - GET  /jobs                            任务列表
+    - GET  /jobs/<id>                       任务状态与运行结果
+    - GET  /jobs/<id>/events?after=<seq>    进度事件流 (text/event-stream),任务结束后关闭
+    - GET  /jobs/<id>/artifacts             产物列表
+    - GET  /jobs/<id>/artifacts/<path>      下载产物文件
+    """
+
+    server_version = 'AIPipeline/1.0'
+    pipeline: PipelineServer = None
+
+    def log_message(self, format, *args):
+        # 流水线本身输出较多,访问日志只在 DEBUG 模式下打印
+        if os.getenv('DEBUG', 'false').lower() == 'true':
+            super().log_message(format, *args)
+
+    def _send_json(self, status: int, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self) -> bool:
+        token = self.pipeline.token
+        if token and self.headers.get('Authorization') != f'Bearer {token}':
+            self._send_json(401, {'error': '未授权'})
+            return False
+        return True
+
+    def _job(self, job_id: str) -> Optional[Job]:
+        job = self.pipeline.get(job_id)
+        if job is None:
+            self._send_json(404, {'error': f'任务不存在: {job_id}'})
+        return job
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        if urlparse(self.path).path != '/jobs':
+            self._send_json(404, {'error': '未知的接口'})
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY_BYTES:
+            self._send_json(413, {'error': '请求体过大'})
+            return
+        try:
+            request = json.loads(self.rfile.read(length) or b'{}')
+            job = self.pipeline.submit(request)
+        except (ValueError, UnicodeDecodeError) as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        self._send_json(202, job.summary())
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        url = urlparse(self.path)
+        parts = [unquote(p) for p in url.path.strip('/').split('/')] if url.path.strip('/') else []
+
+        if parts == ['health']:
+            self._send_json(200, self.pipeline.stats())
+        elif parts == ['jobs']:
+            self._send_json(200, [job.summary() for job in self.pipeline.list()])
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            job = self._job(parts[1])
+            if job:
+                self._send_json(200, job.summary())
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'events':
+            job = self._job(parts[1])
+            if job:
+                after = parse_qs(url.query).get('after', ['0'])[0]
+                self._stream_events(job, int(after) if re.fullmatch(r'\d+', after) else 0)
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'artifacts':
+            job = self._job(parts[1])
+            if job:
+                self._send_json(200, list_artifacts(job.output_dir))
+        elif len(parts) > 3 and parts[0] == 'jobs' and parts[2] == 'artifacts':
+            job = self._job(parts[1])
+            if job:
+                self._send_artifact(job, '/'.join(parts[3:]))
+        else:
+            self._send_json(404, {'error': '未知的接口'})
+
+    def _stream_events(self, job: Job, after: int):
+        """以 Server-Sent Events 推送进度事件,任务结束且事件发送完毕后关闭连接"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            while True:
+                events, finished = job.wait_events(after, HEARTBEAT_SECONDS)
+                for event in events:
+                    payload = json.dumps(event, ensure_ascii=False)
+                    self.wfile.write(f'id: {event["seq"]}\nevent: {event["event"]}\ndata: {payload}\n\n'
+                                     .encode('utf-8'))
+                after += len(events)
+                if not events:
+                    self.wfile.write(b': heartbeat\n\n')
+                self.wfile.flush()
+                if finished and after >= len(job.events):
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _send_artifact(self, job: Job, relative: str):
+        path = artifact_path(job.output_dir, relative)
+        if path is None:
+            self._send_json(404, {'error': f'产物不存在: {relative}'})
+            return
+        with open(path, 'rb') as f:
+            body = f.read()
+        content_type = 'application/json' if path.endswith('.json') else 'text/plain'
+        self.send_response(200)
+        self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(host: Optional[str] = None, port: Optional[int] = None, workers: Optional[int] = None,
+          output_root: Optional[str] = None):
+    """
+    启动服务 (阻塞,Ctrl+C 停止)
+
+    Args:
+        host: 监听地址 (PIPELINE_SERVER_HOST, 默认 127.0.0.1,只接受本机连接)
+        port: 监听端口 (PIPELINE_SERVER_PORT, 默认 8765)
+        workers: 同时运行的任务数 (PIPELINE_SERVER_WORKERS, 默认 2)
+        output_root: 输出根目录
+    """
+    host = host or os.getenv('PIPELINE_SERVER_HOST', '127.0.0.1')
+    port = port or int(os.getenv('PIPELINE_SERVER_PORT', '8765'))
+    pipeline = PipelineServer(workers=workers, output_root=output_root)
+    handler = type('Handler', (PipelineRequestHandler,), {'pipeline': pipeline})
+    httpd = ThreadingHTTPServer((host, port), handler)
+    httpd.daemon_threads = True
+    print(f'✓ 流水线服务已启动: http://{host}:{httpd.server_address[1]} '
+          f'(同时运行 {pipeline.workers} 个任务' + (',已启用访问令牌)' if pipeline.token else ')'))
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print('\n正在停止服务,等待运行中的任务结束...')
+    finally:
+        httpd.server_close()
+        pipeline.shutdown()
@@ -0,0 +1,207 @@
+# static_gate.py
+# 本地静态检查:在 LLM 审查之前检查已写入的文件 (Python 编译、pyflakes、项目内导入、JSON / JSONC / YAML 解析),
+# 发现硬性错误时直接作为缺陷交给修复步骤,省去一次审查调用
+import ast
+import json
+import os
+import re
+import sys
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set
+
+from fanout import normalize_path
+
+# 与 CI 中 flake8 --select=E9,F63,F7,F82 对应的 pyflakes 消息 (E9 即语法错误,由编译检查覆盖)
+HARD_PYFLAKES_MESSAGES = {
+    'AssertTuple': 'F631', 'IsLiteral': 'F632', 'InvalidPrintSyntax': 'F633', 'IfTuple': 'F634',
+    'BreakOutsideLoop': 'F701', 'ContinueOutsideLoop': 'F702', 'YieldOutsideFunction': 'F704',
+    'ReturnOutsideFunction': 'F706', 'DefaultExceptNotLast': 'F707',
+    'UndefinedName': 'F821', 'UndefinedExport': 'F822', 'UndefinedLocal': 'F823',
+}
+YAML_SUFFIXES = ('.yaml', '.yml')
+# 允许注释与尾逗号的 JSON (JSONC) 配置文件,去掉注释与尾逗号后再解析
+JSONC_PATTERN = re.compile(r'(^|/)(tsconfig[^/]*|jsconfig[^/]*|devcontainer|\.eslintrc|\.babelrc)\.json$|(^|/)\.vscode/')
+# JSON 字符串、注释与尾逗号 (字符串原样保留,避免误删字符串中的 // 或 /*)
+JSONC_TOKENS = re.compile(r'("(?:\\.|[^"\\])*")|//[^\n]*|/\*[\s\S]*?\*/|,(?=\s*[}\]])')
+
+
+def _defect(path: str, code: str, description: str, recommendation: str, line: Optional[int] = None) -> Dict:
+    """与审查结果格式一致的缺陷"""
+    defect = {
+        'severity': 'high',
+        'category': 'static',
+        'file': path,
+        'description': f'{code}: {description}' + (f' (第 {line} 行)' if line else ''),
+        'recommendation': recommendation
+    }
+    if line:
+        defect['line'] = line
+    return defect
+
+
+def _pyflakes_defects(path: str, tree: ast.AST) -> List[Dict]:
+    """pyflakes 检查,只保留 HARD_PYFLAKES_MESSAGES 中的错误 (未安装 pyflakes 时跳过)"""
+    try:
+        from pyflakes import checker
+    except ImportError:
+        return []
+    defects = []
+    for message in checker.Checker(tree, filename=path).messages:
+        code = HARD_PYFLAKES_MESSAGES.get(type(message).__name__)
+        if code:
+            defects.append(_defect(path, code, message.message % message.message_args,
+                                   '修正未定义的名称或无效的语句', getattr(message, 'lineno', None)))
+    return defects
+
+
+class ProjectIndex:
+    """已写入文件的模块索引,用于检查项目内的导入能否解析"""
+
+    def __init__(self, paths: List[str]):
+        self.modules: Set[str] = set()
+        self.packages: Set[str] = set()
+        for path in paths:
+            if not path.endswith('.py'):
+                continue
+            parts = path[:-3].split('/')
+            if parts[-1] == '__init__':
+                parts = parts[:-1]
+            for i in range(1, len(parts)):
+                self.packages.add('.'.join(parts[:i]))
+            if parts:
+                self.modules.add('.'.join(parts))
+        # src 布局: src/app/... 以 app 导入
+        for name in list(self.modules | self.packages):
+            if name.startswith('src.'):
+                (self.modules if name in self.modules else self.packages).add(name[4:])
+        # 项目的顶层名称 (只检查导入这些名称的绝对导入,第三方库与标准库不检查)
+        self.roots = {name.split('.')[0] for name in self.modules | self.packages}
+
+    def exists(self, module: str) -> bool:
+        return module in self.modules or module in self.packages
+
+
+def _import_defects(path: str, tree: ast.AST, index: ProjectIndex) -> List[Dict]:
+    """项目内的导入 (绝对导入项目顶层包,或相对导入) 指向不存在的模块时报告"""
+    package = path.split('/')[:-1]
+    defects = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            targets = [alias.name for alias in node.names if alias.name.split('.')[0] in index.roots]
+        elif isinstance(node, ast.ImportFrom) and node.level:
+            up = node.level - 1
+            if up >= len(package):
+                defects.append(_defect(path, 'E0402', '相对导入超出了项目的顶层包', '检查相对导入的层级', node.lineno))
+                continue
+            # from . import name 中的 name 可能是子模块,也可能是包中定义的名称,只检查包本身
+            base = package[:len(package) - up]
+            targets = ['.'.join(base + ([node.module] if node.module else []))]
+        elif isinstance(node, ast.ImportFrom) and node.module.split('.')[0] in index.roots:
+            targets = [node.module]
+        else:
+            continue
+        for target in targets:
+            if target and not index.exists(target):
+                defects.append(_defect(path, 'E0401', f'无法解析的项目内导入: {target}',
+                                       '补充缺失的模块文件,或修正导入路径', node.lineno))
+    return defects
+
+
+def check_file(path: str, full_path: str, index: ProjectIndex) -> List[Dict]:
+    """
+    检查单个文件
+
+    Args:
+        path: 项目内的相对路径 (用于报告)
+        full_path: 已写入的文件路径
+        index: 项目模块索引
+
+    Returns:
+        硬性错误列表 (审查缺陷格式)
+    """
+    try:
+        with open(full_path, 'r', encoding='utf-8') as f:
+            source = f.read()
+    except (OSError, UnicodeDecodeError) as e:
+        return [_defect(path, 'E902', f'无法读取文件: {str(e)}', '重新生成该文件')]
+
+    if path.endswith('.py'):
+        try:
+            # 编译 AST 还能发现解析阶段不报告的错误 (如函数外的 return、nonlocal 使用错误)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', SyntaxWarning)
+                tree = ast.parse(source, filename=path)
+                compile(tree, path, 'exec')
+        except SyntaxError as e:
+            return [_defect(path, 'E999', f'语法错误: {e.msg}', '修正语法错误', e.lineno)]
+        except ValueError as e:
+            return [_defect(path, 'E999', f'无法编译: {str(e)}', '修正文件内容')]
+        return _pyflakes_defects(path, tree) + _import_defects(path, tree, index)
+
+    if path.endswith('.json'):
+        if JSONC_PATTERN.search(path):
+            source = JSONC_TOKENS.sub(lambda m: m.group(1) or '', source)
+        try:
+            json.loads(source)
+        except json.JSONDecodeError as e:
+            return [_defect(path, 'JSON', f'JSON 格式错误: {e.msg}', '修正 JSON 格式', e.lineno)]
+
+    if path.endswith(YAML_SUFFIXES):
+        try:
+            import yaml
+        except ImportError:
+            return []
+        try:
+            list(yaml.safe_load_all(source))
+        except yaml.YAMLError as e:
+            mark = getattr(e, 'problem_mark', None)
+            return [_defect(path, 'YAML', f'YAML 格式错误: {getattr(e, "problem", None) or str(e)}',
+                            '修正 YAML 格式', mark.line + 1 if mark else None)]
+    return []
+
+
+def gate_enabled() -> bool:
+    """是否启用审查前的本地静态检查 (PIPELINE_STATIC_GATE,默认 true)"""
+    return os.getenv('PIPELINE_STATIC_GATE', 'true').lower() != 'false'
+
+
+def run_static_gate(code_dir: str, paths: List[str], workers: Optional[int] = None) -> Dict:
+    """
+    并行检查已写入代码目录的文件
+
+    Args:
+        code_dir: 代码目录
+        paths: 要检查的文件 (相对路径)
+        workers: 并行检查的线程数 (PIPELINE_STATIC_GATE_WORKERS, 默认 8)
+
+    Returns:
+        {'passed', 'defects', 'checked', 'elapsed'}
+    """
+    workers = max(1, workers or int(os.getenv('PIPELINE_STATIC_GATE_WORKERS', '8')))
+    # 与 write_files_from_codeblock 一致,跳过不安全的路径 (这些文件没有被写入)
+    paths = [normalize_path(path) for path in paths if '..' not in path and not path.startswith('/')]
+    index = ProjectIndex(paths)
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='gate') as pool:
+        results = list(pool.map(lambda p: check_file(p, os.path.join(code_dir, p), index), paths))
+    defects = [defect for file_defects in results for defect in file_defects]
+    return {
+        'passed': not defects,
+        'defects': defects,
+        'checked': len(paths),
+        'elapsed': round(time.perf_counter() - started_at, 3)
+    }
+
+
+if __name__ == '__main__':
+    # 手动检查一个目录: python orchestrator/static_gate.py <目录>
+    root = sys.argv[1] if len(sys.argv) > 1 else '.'
+    files = [os.path.relpath(os.path.join(d, f), root).replace(os.sep, '/')
+             for d, _, names in os.walk(root) for f in names if f.endswith(('.py', '.json') + YAML_SUFFIXES)]
+    report = run_static_gate(root, files)
+    for item in report['defects']:
+        print(f'{item["file"]}: {item["description"]}')
+    print(f'检查 {report["checked"]} 个文件, {len(report["defects"])} 个错误 ({report["elapsed"]}s)')
+    sys.exit(0 if report['passed'] else 1)
@@ -0,0 +1,144 @@
+# streaming.py
+# 流式响应处理:增量解析代码块,边生成边写文件,并统计首 token / 首文件耗时
+import re
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from continuation import LLMText
+
+# 与 orchestrator.parse_code_blocks 使用同一格式:
+# 代码块首行为 # path: ..., // path: ... 或 <!-- path: ... -->
+CODE_BLOCK_PATTERN = re.compile(
+    r'```(?:[a-zA-Z0-9]*)\n(?:#|//|<!--)\s*path:\s*(.+?)(?:-->)?\n([\s\S]*?)```',
+    re.MULTILINE
+)
+
+
+class CodeBlockStreamParser:
+    """
+    增量代码块解析器
+
+    每次 feed 一段文本,只要某个带路径标记的代码块的结束 ``` 已经到达,
+    就立即返回该代码块,无需等待完整响应。
+    """
+
+    def __init__(self):
+        self.buffer = ''
+        self.blocks: List[Tuple[str, str]] = []
+        self._pos = 0
+
+    def feed(self, text: str) -> List[Tuple[str, str]]:
+        """
+        追加一段流式文本
+
+        Args:
+            text: 新到达的文本片段
+
+        Returns:
+            本次新完成的代码块列表 [(路径, 内容), ...]
+        """
+        self.buffer += text
+        # 只有出现反引号时才可能闭合代码块,避免每个 token 都重新扫描
+        if '`' not in text:
+            return []
+
+        completed = []
+        while True:
+            match = CODE_BLOCK_PATTERN.search(self.buffer, self._pos)
+            if not match:
+                break
+            path = match.group(1).strip()
+            content = match.group(2).strip()
+            completed.append((path, content))
+            self._pos = match.end()
+            print(f'  发现代码块: {path} ({len(content)} 字符)')
+
+        self.blocks.extend(completed)
+        return completed
+
+
+class StreamCancelled(Exception):
+    """流式调用已被取消 (单次调用超时后已由重试取代)"""
+
+
+class StreamResult:
+    """一次流式调用的结果、耗时统计与自动续写次数"""
+
+    def __init__(self, text: str, blocks: List[Tuple[str, str]], timing: Dict[str, Optional[float]],
+                 continuations: int = 0):
+        self.text = text
+        self.blocks = blocks
+        self.timing = timing
+        self.continuations = continuations
+
+
+def collect_stream(
+    chunks: Iterable[str],
+    on_block: Optional[Callable[[str, str], None]] = None,
+    started_at: Optional[float] = None,
+    cancel: Optional[threading.Event] = None
+) -> StreamResult:
+    """
+    消费流式响应,增量解析代码块并回调
+
+    Args:
+        chunks: 文本片段迭代器 (如 LLMClient.stream_claude 的返回值)
+        on_block: 每解析出一个完整代码块时的回调 (路径, 内容),通常用于立即写文件
+        started_at: 请求发起时间 (time.perf_counter()),为空时以调用本函数的时间为准
+        cancel: 取消信号,设置后关闭流 (断开连接) 并不再回调
+
+    Returns:
+        StreamResult,timing 包含 time_to_first_token / time_to_first_file / total (秒);
+        chunks 为 LLMClient 返回的 TextStream 时同时带回续写次数
+
+    Raises:
+        StreamCancelled: 接收过程中被取消
+    """
+    started_at = started_at if started_at is not None else time.perf_counter()
+    parser = CodeBlockStreamParser()
+    parts = []
+    first_token = None
+    first_file = None
+
+    try:
+        for chunk in chunks:
+            if cancel is not None and cancel.is_set():
+                raise StreamCancelled()
+            if first_token is None:
+                first_token = time.perf_counter() - started_at
+            parts.append(chunk)
+            for path, content in parser.feed(chunk):
+                if on_block:
+                    on_block(path, content)
+                if first_file is None:
+                    first_file = time.perf_counter() - started_at
+    except StreamCancelled:
+        close = getattr(chunks, 'close', None)
+        if close:
+            close()
+        raise
+
+    timing = {
+        'time_to_first_token': _round(first_token),
+        'time_to_first_file': _round(first_file),
+        'total': _round(time.perf_counter() - started_at),
+    }
+    # 文本带上续写信息,TokenBudget.record 会计入续写请求的提示词
+    text = LLMText(''.join(parts), getattr(chunks, 'finish_reason', None), getattr(chunks, 'continuations', 0),
+                   getattr(chunks, 'continuation_prompt_tokens', 0), getattr(chunks, 'continuation_error', None))
+    return StreamResult(text, parser.blocks, timing, text.continuations)
+
+
+def format_timing(timing: Dict[str, Optional[float]]) -> str:
+    """格式化耗时统计,用于控制台输出"""
+    def fmt(value):
+        return f'{value:.2f}s' if value is not None else '-'
+
+    return (f'首 token {fmt(timing.get("time_to_first_token"))}, '
+            f'首文件 {fmt(timing.get("time_to_first_file"))}, '
+            f'总计 {fmt(timing.get("total"))}')
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 3) if value is not None else None
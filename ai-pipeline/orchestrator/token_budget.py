@@ -0,0 +1,219 @@
+# token_budget.py
+# Token 估算与预算:按上下文窗口剩余空间确定 max_tokens,并生成每个阶段的 token 报告
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+# 常见模型的上下文窗口 (按模型名前缀匹配,越具体的前缀越靠前)
+CONTEXT_WINDOWS: List[Tuple[str, int]] = [
+    ('gpt-4o', 128000),
+    ('gpt-4-turbo', 128000),
+    ('gpt-4-1106', 128000),
+    ('gpt-4-0125', 128000),
+    ('gpt-4-32k', 32768),
+    ('gpt-4.1', 1000000),
+    ('gpt-4', 8192),
+    ('gpt-3.5-turbo', 16385),
+    ('o1', 200000),
+    ('o3', 200000),
+    ('claude', 200000),
+    ('deepseek', 64000),
+    ('glm-4', 128000),
+    ('qwen-max', 32768),
+    ('qwen-turbo', 131072),
+    ('qwen', 32768),
+]
+DEFAULT_CONTEXT_WINDOW = 32768
+
+# 启发式估算系数 (按 cl100k 分词在本项目提示词 / 生成代码上的表现取偏保守的值):
+# ASCII 文本与代码约 3.5 字符 / token,中文等非 ASCII 字符约 1 token / 字符
+ASCII_CHARS_PER_TOKEN = 3.5
+NON_ASCII_TOKENS_PER_CHAR = 1.0
+# 每次请求的消息格式开销 (角色标记、系统提示词等)
+REQUEST_OVERHEAD_TOKENS = 64
+
+_encodings: Dict[str, object] = {}
+_encodings_lock = threading.Lock()
+
+
+class PromptTooLargeError(ValueError):
+    """提示词超出模型上下文窗口,剩余空间不足以生成输出"""
+
+
+def _encoding(model: Optional[str]):
+    """获取 tiktoken 编码器;未安装或无法加载 (如离线环境下载不到词表) 时返回 None"""
+    key = model or ''
+    with _encodings_lock:
+        if key in _encodings:
+            return _encodings[key]
+        try:
+            import tiktoken
+            try:
+                encoding = tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding('cl100k_base')
+            except KeyError:
+                encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception:
+            encoding = None
+        _encodings[key] = encoding
+        return encoding
+
+
+def heuristic_tokens(text: str) -> int:
+    """不依赖分词器的 token 估算"""
+    if not text:
+        return 0
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    non_ascii = len(text) - ascii_chars
+    return int(ascii_chars / ASCII_CHARS_PER_TOKEN + non_ascii * NON_ASCII_TOKENS_PER_CHAR) + 1
+
+
+def count_tokens(text: str, model: Optional[str] = None) -> Tuple[int, str]:
+    """
+    估算文本的 token 数
+
+    Args:
+        text: 文本
+        model: 模型名 (用于选择分词器)
+
+    Returns:
+        (token 数, 估算方式 'tiktoken' / 'heuristic')
+    """
+    encoding = _encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text or '', disallowed_special=())), 'tiktoken'
+    return heuristic_tokens(text), 'heuristic'
+
+
+def context_window(model: str) -> int:
+    """模型的上下文窗口大小 (LLM_CONTEXT_WINDOW 可统一覆盖)"""
+    override = os.getenv('LLM_CONTEXT_WINDOW')
+    if override:
+        return int(override)
+    name = (model or '').lower().split('/')[-1]
+    for prefix, window in CONTEXT_WINDOWS:
+        if name.startswith(prefix):
+            return window
+    return DEFAULT_CONTEXT_WINDOW
+
+
+class TokenBudget:
+    """
+    一次流水线运行的 token 预算与报告
+
+    每次调用前用 plan() 估算提示词 token 数,并按上下文窗口剩余空间收缩 max_tokens;
+    调用后用 record() 按 plan() 返回的条目编号记录输出 token 数 (同一阶段的并发调用互不混淆)。
+    report() / format() 按阶段汇总。
+    """
+
+    def __init__(self, safety_margin: Optional[int] = None, min_output: Optional[int] = None):
+        """
+        Args:
+            safety_margin: 为估算误差预留的 token 数 (LLM_TOKEN_SAFETY_MARGIN, 默认 256)
+            min_output: 剩余空间低于该值时视为提示词过大 (LLM_MIN_OUTPUT_TOKENS, 默认 512)
+        """
+        self.safety_margin = safety_margin if safety_margin is not None else \
+            int(os.getenv('LLM_TOKEN_SAFETY_MARGIN', '256'))
+        self.min_output = min_output if min_output is not None else \
+            int(os.getenv('LLM_MIN_OUTPUT_TOKENS', '512'))
+        self.entries: List[Dict] = []
+        self._lock = threading.Lock()
+
+    def plan(self, stage: str, prompt: str, max_tokens: int, models: List[str]) -> Tuple[int, int]:
+        """
+        确定一次调用的 max_tokens
+
+        Args:
+            stage: 阶段名称 (srs / code / review / fix)
+            prompt: 完整提示词
+            max_tokens: 该阶段期望的最大输出 token 数
+            models: 本次调用可能使用的模型 (多端点路由时取上下文窗口最小者)
+
+        Returns:
+            (实际使用的 max_tokens, 条目编号);条目编号传给 record()
+
+        Raises:
+            PromptTooLargeError: 提示词超出上下文窗口
+        """
+        model = min(models, key=context_window) if models else ''
+        window = context_window(model)
+        prompt_tokens, method = count_tokens(prompt, model)
+        prompt_tokens += REQUEST_OVERHEAD_TOKENS
+        available = window - prompt_tokens - self.safety_margin
+
+        if available < self.min_output:
+            raise PromptTooLargeError(
+                f'{stage} 阶段提示词约 {prompt_tokens} tokens,超出模型 {model} 的上下文窗口 '
+                f'({window} tokens,至少需要为输出保留 {self.min_output} tokens)'
+            )
+
+        sized = min(max_tokens, available)
+        if sized < max_tokens:
+            print(f'⚠️  {stage} 阶段提示词约 {prompt_tokens} tokens,max_tokens 由 {max_tokens} 收缩为 {sized}')
+
+        with self._lock:
+            entry_id = len(self.entries)
+            self.entries.append({
+                'stage': stage,
+                'model': model,
+                'method': method,
+                'context_window': window,
+                'prompt_tokens': prompt_tokens,
+                'requested_max_tokens': max_tokens,
+                'max_tokens': sized,
+                'completion_tokens': None,
+            })
+        return sized, entry_id
+
+    def record(self, entry_id: int, response: str):
+        """
+        记录一次调用的输出 token 数
+
+        响应带有自动续写信息 (continuation.LLMText) 时,续写请求的提示词 token 数计入该次调用的输入。
+
+        Args:
+            entry_id: plan() 返回的条目编号
+            response: 模型输出
+        """
+        with self._lock:
+            entry = self.entries[entry_id]
+            entry['completion_tokens'] = count_tokens(response, entry['model'])[0]
+            extra = getattr(response, 'continuation_prompt_tokens', 0)
+            if extra:
+                entry['prompt_tokens'] += extra
+                entry['continuation_prompt_tokens'] = extra
+
+    def report(self) -> Dict:
+        """
+        按阶段汇总的 token 报告
+
+        Returns:
+            {'stages': {阶段: {calls, prompt_tokens, completion_tokens, max_tokens}}, 'total': {...}, 'calls': [...]}
+        """
+        with self._lock:
+            entries = [dict(e) for e in self.entries]
+
+        stages: Dict[str, Dict[str, int]] = {}
+        total = {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+        for entry in entries:
+            stage = stages.setdefault(entry['stage'], {
+                'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'max_tokens': 0
+            })
+            stage['calls'] += 1
+            stage['prompt_tokens'] += entry['prompt_tokens']
+            stage['completion_tokens'] += entry['completion_tokens'] or 0
+            stage['max_tokens'] = max(stage['max_tokens'], entry['max_tokens'])
+            total['calls'] += 1
+            total['prompt_tokens'] += entry['prompt_tokens']
+            total['completion_tokens'] += entry['completion_tokens'] or 0
+        return {'stages': stages, 'total': total, 'calls': entries}
+
+    def format(self) -> str:
+        """格式化 token 报告,用于控制台输出"""
+        report = self.report()
+        # 中文字符占两列,表头的对齐宽度相应减小
+        lines = [f'{"阶段":<8}{"调用":>4}{"输入 tokens":>12}{"输出 tokens":>12}']
+        for name, stage in report['stages'].items():
+            lines.append(f'{name:<10}{stage["calls"]:>6}{stage["prompt_tokens"]:>14}{stage["completion_tokens"]:>14}')
+        total = report['total']
+        lines.append(f'{"合计":<8}{total["calls"]:>6}{total["prompt_tokens"]:>14}{total["completion_tokens"]:>14}')
+        return '\n'.join(lines)
@@ -190,8 +190,11 @@ def save_intermediate_result(data: dict, step: str, output_dir: str) -> str:
     filepath = os.path.join(output_dir, f'{step}.json')
 
     try:
-        with open(filepath, 'w', encoding='utf-8') as f:
+        # 先写临时文件再替换,中断或并发读取时不会出现写了一半的结果
+        tmp_path = f'{filepath}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, filepath)
         print(f'✓ 已保存中间结果: {filepath}')
         return filepath
     except Exception as e:
@@ -40,23 +40,120 @@ if os.getenv('DEBUG', 'false').lower() == 'true':
 # 导入并运行主程序
 sys.path.insert(0, os.path.join(script_dir, 'orchestrator'))
 from orchestrator import main
+from batch import load_jobs, run_batch
+from job_queue import JobQueue, QueueFullError, enqueue, run_workers
+from server import serve
 import argparse
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='AI 自动化代码流水线 - 从需求到可运行代码'
     )
-    parser.add_argument(
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
         '--requirement',
-        required=True,
         help='用户需求描述'
     )
+    source.add_argument(
+        '--batch',
+        metavar='JSONL',
+        help='批量模式: 每行一个需求的 JSONL 文件'
+    )
+    source.add_argument(
+        '--resume',
+        metavar='RUN_DIR',
+        help='续跑: 复用运行目录中已完成的步骤结果,从第一个未完成的步骤继续'
+    )
+    source.add_argument(
+        '--worker',
+        action='store_true',
+        help='队列 worker: 从持久化任务队列中认领并运行任务 (崩溃后由其他 worker 续跑)'
+    )
+    source.add_argument(
+        '--serve',
+        action='store_true',
+        help='服务模式: 在本机启动 HTTP 服务,常驻 LLM 客户端并通过接口提交任务'
+    )
     parser.add_argument(
         '--max-iterations',
         type=int,
         default=2,
         help='最大修复迭代次数 (默认: 2)'
     )
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        default=None,
+        help='流式生成代码,代码块闭合即写入文件 (也可设置 LLM_STREAM=true)'
+    )
+    parser.add_argument(
+        '--fanout',
+        action='store_true',
+        default=None,
+        help='按任务分组并行生成代码 (也可设置 LLM_CODEGEN_FANOUT=true)'
+    )
+    parser.add_argument(
+        '--from-step',
+        help='与 --resume 一起使用: 从该步骤起重新执行 (srs / code / review / fix,或 review_1 / fix_2 ...)'
+    )
+    parser.add_argument(
+        '--output-root',
+        help='输出根目录,每次运行写入其中的 runs/<run ID>/ (也可设置 PIPELINE_OUTPUT_ROOT)'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='批量模式同时运行的需求数 (默认: 4,也可设置 PIPELINE_BATCH_WORKERS);服务模式与队列 worker 同时运行的任务数 (默认: 2)'
+    )
+    parser.add_argument(
+        '--executor',
+        choices=['thread', 'process'],
+        help='批量模式的 worker 类型 (默认: thread,也可设置 PIPELINE_BATCH_EXECUTOR)'
+    )
+    parser.add_argument(
+        '--enqueue',
+        action='store_true',
+        help='与 --requirement / --batch 一起使用: 提交到持久化任务队列而不是立即运行'
+    )
+    parser.add_argument(
+        '--priority',
+        type=int,
+        default=0,
+        help='入队任务的优先级 (越大越先运行,默认: 0)'
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        help='服务模式的监听端口 (默认: 8765,也可设置 PIPELINE_SERVER_PORT)'
+    )
+    parser.add_argument(
+        '--max-in-flight',
+        type=int,
+        help='批量模式与队列 worker 同时进行的 LLM 请求数上限 (也可设置 PIPELINE_BATCH_MAX_IN_FLIGHT / PIPELINE_QUEUE_MAX_IN_FLIGHT)'
+    )
 
     args = parser.parse_args()
-    main(args.requirement, args.max_iterations)
+    if args.from_step and not args.resume:
+        parser.error('--from-step 需要与 --resume 一起使用')
+    if args.enqueue and not (args.requirement or args.batch):
+        parser.error('--enqueue 需要与 --requirement 或 --batch 一起使用')
+    if args.enqueue:
+        jobs = load_jobs(args.batch) if args.batch else [{
+            'requirement': args.requirement, 'max_iterations': args.max_iterations,
+            'stream': args.stream, 'fanout': args.fanout
+        }]
+        try:
+            enqueue(jobs, JobQueue(root=args.output_root), priority=args.priority)
+        except QueueFullError as e:
+            print(f'✗ {str(e)}')
+            sys.exit(1)
+    elif args.worker:
+        run_workers(JobQueue(root=args.output_root), workers=args.workers, max_in_flight=args.max_in_flight)
+    elif args.serve:
+        serve(port=args.port, workers=args.workers, output_root=args.output_root)
+    elif args.batch:
+        run_batch(args.batch, workers=args.workers, executor=args.executor, output_root=args.output_root,
+                  max_in_flight=args.max_in_flight)
+    else:
+        main(args.requirement, args.max_iterations, stream=args.stream, fanout=args.fanout,
+             output_root=args.output_root, resume=args.resume, from_step=args.from_step)
@@ -30,11 +30,30 @@ if os.getenv('DEBUG', '').lower() == 'true':
 # Run orchestrator
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'orchestrator'))
 from orchestrator import main
+from batch import run_batch
 import argparse
 
-parser = argparse.ArgumentParser()
-parser.add_argument('--requirement', required=True)
-parser.add_argument('--max-iterations', type=int, default=2)
-args = parser.parse_args()
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--requirement')
+    source.add_argument('--batch')
+    source.add_argument('--resume')
+    parser.add_argument('--max-iterations', type=int, default=2)
+    parser.add_argument('--stream', action='store_true', default=None)
+    parser.add_argument('--fanout', action='store_true', default=None)
+    parser.add_argument('--from-step')
+    parser.add_argument('--output-root')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--executor', choices=['thread', 'process'])
+    parser.add_argument('--max-in-flight', type=int)
+    args = parser.parse_args()
+    if args.from_step and not args.resume:
+        parser.error('--from-step requires --resume')
 
-main(args.requirement, args.max_iterations)
+    if args.batch:
+        run_batch(args.batch, workers=args.workers, executor=args.executor, output_root=args.output_root,
+                  max_in_flight=args.max_in_flight)
+    else:
+        main(args.requirement, args.max_iterations, stream=args.stream, fanout=args.fanout,
+             output_root=args.output_root, resume=args.resume, from_step=args.from_step)